@@ -0,0 +1,191 @@
+import collections
+import contextlib
+import csv
+import functools
+import io
+import os
+import tempfile
+import xml.etree.ElementTree as XmlTree
+import zipfile
+from itertools import islice
+from timeit import default_timer as timer
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from aces_pies_data.management.import_utils import get_file_obj_from_zip, get_csv_lines
+from aces_pies_data.models import Brand
+from aces_pies_data.util.dci_pipe_reader import DciPipeReader
+from aces_pies_data.util.aces_pies_parsing import PiesFileParser, ElementTreeEngine, LxmlEngine, lxml_etree, AcesFileParser, ColumnarFitmentNormaliser, consolidate_fitment_values, numpy
+
+
+class Command(BaseCommand):
+    """
+        This command is used for development purposes only
+        Microbenchmarks for the parsing code paths.  They run against a DCI zip or an extracted data file, or against a generated file when none is given.
+    """
+    help = 'Benchmarks aces pies parsing code paths for development purposes only'
+    benchmarks = {
+        'pies_decoder': 'benchmark_pies_decoder',
+        'pies_engines': 'benchmark_pies_engines',
+        'aces_normaliser': 'benchmark_aces_normaliser',
+        'dci_reader': 'benchmark_dci_reader',
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(self.benchmarks.keys()))
+        parser.add_argument('--file', dest='file_path', help='DCI zip or extracted data file to benchmark against')
+        parser.add_argument('--items', type=int, default=5000, help='Number of items or rows to benchmark')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best run is reported')
+
+    def handle(self, *args, **options):
+        if settings.ENVIRONMENT == "prod":
+            raise EnvironmentError("This is a test command that cannot be run in a production environment")
+        getattr(self, self.benchmarks[options['benchmark']])(options)
+
+    def benchmark_pies_decoder(self, options):
+        """
+        Items/sec of the single pass PiesItemDecoder against PiesFileParser._parse_xml_item on the same parsed elements
+        """
+        with self.open_data_file(options, "pies") as pies_xml_file:
+            pies_file_parser = PiesFileParser(pies_xml_file, "BENCH")
+            xml_items = list(islice((xml_elem for event, xml_elem in XmlTree.iterparse(pies_xml_file) if xml_elem.tag == pies_file_parser.item_tag), options['items']))
+        if not xml_items:
+            raise CommandError("No items found to benchmark")
+        item_decoder = pies_file_parser.item_decoder
+        if [item_decoder.decode(xml_item) for xml_item in xml_items] != [pies_file_parser._parse_xml_item(xml_item) for xml_item in xml_items]:
+            raise CommandError("PiesItemDecoder output differs from _parse_xml_item")
+        self.report(len(xml_items), 'items', options['repeat'], {
+            '_parse_xml_item': lambda: [pies_file_parser._parse_xml_item(xml_item) for xml_item in xml_items],
+            'PiesItemDecoder': lambda: [item_decoder.decode(xml_item) for xml_item in xml_items]
+        })
+
+    def benchmark_pies_engines(self, options):
+        """
+        Items/sec of a full PiesFileParser pass over the same file with every available xml engine, so the engine can be picked per deployment
+        """
+        engine_names = [ElementTreeEngine.name]
+        if lxml_etree is not None:
+            engine_names.append(LxmlEngine.name)
+        else:
+            self.stdout.write("lxml is not installed, only the etree engine is benchmarked")
+        with self.open_data_file(options, "pies") as pies_xml_file:
+            pies_xml_bytes = pies_xml_file.read()
+
+        def parse_products(engine_name):
+            return PiesFileParser(io.BytesIO(pies_xml_bytes), "BENCH", engine=engine_name).get_brand_data()['product_data']
+
+        def consume_products(engine_name):
+            collections.deque(parse_products(engine_name), maxlen=0)
+
+        num_items = 0
+        for engine_products in zip(*[parse_products(engine_name) for engine_name in engine_names]):
+            num_items += 1
+            if any(product_data != engine_products[0] for product_data in engine_products):
+                raise CommandError(f"Engines produced different data for {engine_products[0]['part_number']}")
+        self.report(num_items, 'items', options['repeat'], {
+            f"{engine_name} engine": functools.partial(consume_products, engine_name) for engine_name in engine_names
+        })
+
+    def benchmark_aces_normaliser(self, options):
+        """
+        Rows/sec of the dict and columnar aces normalisers over the same rows, sorted up front so only consolidation is timed
+        """
+        if numpy is None:
+            raise CommandError("numpy is not installed, the columnar normaliser is not available")
+        fitment_columns = AcesFileParser.fitment_columns
+        with self.open_data_file(options, "aces") as aces_file:
+            fitment_values = sorted(islice(DciPipeReader(aces_file, fitment_columns, AcesFileParser.fitment_converters), options['items']), key=lambda values: values[0])
+        if not fitment_values:
+            raise CommandError("No rows found to benchmark")
+        # never saved, the normalisers only hand the brand through to storage
+        brand_record = Brand(name="Benchmark", short_name="BENCH")
+
+        def consume_fitment(normaliser):
+            collections.deque(consolidate_fitment_values(fitment_values, brand_record, 30, normaliser), maxlen=0)
+
+        def get_storage(normaliser):
+            for parsed_fitment in consolidate_fitment_values(fitment_values, brand_record, 30, normaliser):
+                yield [parsed_fitment.make_storage, parsed_fitment.model_storage, parsed_fitment.sub_model_storage, parsed_fitment.engine_storage, parsed_fitment.vehicle_storage, parsed_fitment.part_fitment_storage]
+
+        for dict_storage, columnar_storage in zip(get_storage("dict"), get_storage(ColumnarFitmentNormaliser.name)):
+            if dict_storage != columnar_storage:
+                raise CommandError("ColumnarFitmentNormaliser output differs from the dict normaliser")
+        self.report(len(fitment_values), 'rows', options['repeat'], {
+            f"{normaliser} normaliser": functools.partial(consume_fitment, normaliser) for normaliser in ("dict", ColumnarFitmentNormaliser.name)
+        })
+
+    def benchmark_dci_reader(self, options):
+        """
+        Rows/sec reading the aces fitment columns with csv.DictReader over get_csv_lines, the way the files used to be read, against DciPipeReader
+        """
+        fitment_columns = AcesFileParser.fitment_columns
+        with self.open_data_file(options, "aces") as aces_file:
+            aces_bytes = b"".join(islice(aces_file, options['items'] + 1))
+
+        def read_dict_rows():
+            reader = csv.DictReader(get_csv_lines(io.BytesIO(aces_bytes)), delimiter='|', quoting=csv.QUOTE_NONE)
+            collections.deque((tuple(fitment_row[col] for col in fitment_columns) for fitment_row in reader), maxlen=0)
+
+        def read_pipe_rows(converters):
+            collections.deque(DciPipeReader(io.BytesIO(aces_bytes), fitment_columns, converters), maxlen=0)
+
+        num_rows = aces_bytes.count(b"\n") - 1
+        self.report(num_rows, 'rows', options['repeat'], {
+            'DictReader': read_dict_rows,
+            'DciPipeReader': functools.partial(read_pipe_rows, None),
+            'DciPipeReader converted': functools.partial(read_pipe_rows, AcesFileParser.fitment_converters)
+        })
+
+    def report(self, num_units, unit_name, repeat, candidates):
+        """
+        Times every candidate, keeps the best of repeat runs and prints the throughput relative to the first candidate
+        """
+        baseline_rate = None
+        for name, candidate in candidates.items():
+            best_time = None
+            for _ in range(repeat):
+                start = timer()
+                candidate()
+                run_time = timer() - start
+                if best_time is None or run_time < best_time:
+                    best_time = run_time
+            rate = num_units / best_time
+            if baseline_rate is None:
+                baseline_rate = rate
+            self.stdout.write(f"{name:<24} {rate:>14,.0f} {unit_name}/sec {rate / baseline_rate:>8.2f}x")
+
+    @contextlib.contextmanager
+    def open_data_file(self, options, import_type):
+        """
+        Opens the data file for import_type in binary mode.  Zip files are read the same way the import does, with no file a synthetic one is generated.
+        """
+        file_path = options['file_path']
+        if file_path and zipfile.is_zipfile(file_path):
+            with zipfile.ZipFile(file_path) as zip_file:
+                with zip_file.open(get_file_obj_from_zip(zip_file, import_type)) as data_file:
+                    yield data_file
+        elif file_path:
+            with open(file_path, 'rb') as data_file:
+                yield data_file
+        else:
+            # test helpers are only needed when generating data, keep them out of the module imports
+            from aces_pies_data.tests import factories
+            file_descriptor, synthetic_file_path = tempfile.mkstemp()
+            try:
+                with os.fdopen(file_descriptor, 'wb') as synthetic_file:
+                    self.write_synthetic_file(factories, synthetic_file, import_type, options['items'])
+                with open(synthetic_file_path, 'rb') as data_file:
+                    yield data_file
+            finally:
+                os.remove(synthetic_file_path)
+
+    @staticmethod
+    def write_synthetic_file(factories, synthetic_file, import_type, num_items):
+        if import_type == "pies":
+            factories.write_pies_xml(synthetic_file, num_items)
+        elif import_type == "aces":
+            # parts average about a dozen rows
+            factories.write_aces_flat_file(synthetic_file, factories.get_aces_rows(num_items // 12 + 1)[:num_items])
+        else:
+            raise CommandError(f"No synthetic {import_type} file available, pass --file")
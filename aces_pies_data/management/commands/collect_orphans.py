@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand
+
+from aces_pies_data.util.orphan_collector import OrphanCollector
+
+
+class Command(BaseCommand):
+    """
+    Deletes attributes, attribute values, vehicles, vehicle years, engines and digital assets that nothing refers to any more.
+    import_aces_pies runs the same collection after every import, this is for running it on its own.
+    """
+    help = 'Deletes lookup rows no product refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Maximum number of rows deleted per statement')
+
+    def handle(self, *args, **options):
+        orphan_collector = OrphanCollector(batch_size=options['batch_size'])
+        reclaimed = orphan_collector.collect()
+        if not orphan_collector.stats:
+            self.stdout.write("An import is in progress, nothing was collected")
+            return
+        for model_name, num_deleted in reclaimed.items():
+            self.stdout.write(f"{model_name}: {num_deleted} rows reclaimed in {orphan_collector.stats[model_name]['seconds']:.2f} seconds")
+        self.stdout.write(f"Reclaimed {sum(reclaimed.values())} rows")
@@ -1,24 +1,31 @@
 import datetime
-import io
+import functools
 import re
 import traceback
-import zipfile
 
 import pytz
 import sys
 
-from googleapiclient.http import MediaIoBaseDownload
-
-from aces_pies_data.management.import_utils import get_file_obj_from_zip, get_csv_lines, parse_file_name, with_retries
+from aces_pies_data.management.drive_prefetcher import DrivePrefetcher
+from aces_pies_data.management.import_scheduler import BrandImportScheduler, get_brand_chains
+from aces_pies_data.management.import_utils import get_file_obj_from_zip, get_zip_member_hash, open_zip, parse_file_name, with_backoff
 from aces_pies_data.models import ImportTracking, ImportTrackingType
 from aces_pies_data.util.aces_pies_parsing import PiesFileParser, AcesFileParser
 from aces_pies_data.util.aces_pies_storage import PiesDataStorage, AcesDataStorage, PiesCategoryDataStorage
+from aces_pies_data.util.import_checkpoint import CheckpointMismatch, ImportCheckpoint
+from aces_pies_data.util.orphan_collector import OrphanCollector
+from aces_pies_data.util.parsed_data_cache import ParsedDataCache, CachedAcesFileParser, get_cached_brand_data
 from . import build_google_service
+from django.conf import settings
 from django.core.management import BaseCommand
+from django.db import InterfaceError, OperationalError, connections
 import logging
 
 logger = logging.getLogger('AcesPiesJob')
 
+# errors storing a file that store_data_file retries, the connection dropped or the checkpoint no longer matched the file
+store_retry_errors = (OperationalError, InterfaceError, CheckpointMismatch)
+
 
 class Command(BaseCommand):
     """
@@ -28,44 +35,25 @@ class Command(BaseCommand):
     help = 'Imports aces pies data from a google drive folder'
 
     def handle(self, *args, **options):
-        with_retries(self.do_import, logger)
+        # failures are retried per drive call and per file store, a failed brand is resumed from its checkpoints by the next run
+        self.do_import()
 
     def do_import(self):
-        drive_service = build_google_service('drive', 'v3', ['https://www.googleapis.com/auth/drive'])
+        drive_service = get_drive_service()
         files_to_process = self.get_files_to_process(drive_service)
         files_to_parse = files_to_process['files_to_parse']
         files_to_archive = files_to_process['files_to_archive']
         pending_folder_id = files_to_process['pending_folder_id']
         archived_folder_id = files_to_process['archived_folder_id']
-        for file_info in files_to_parse:
-            brand_short_name = file_info['brand_short_name']
-            import_type = file_info['import_type']
-            import_action = ImportTracking.objects.get_import_action(brand_short_name, file_info['date'], import_type)
-            file_name = file_info['file']['name']
-            logger.info(f"Determining if file {file_name} should be parsed")
-            with TrackingRecord(import_type, import_action, brand_short_name, file_name):
-                if import_action == ImportTracking.DO_IMPORT:
-                    def on_complete():
-                        archive_file(drive_service, file_info['file']['id'], pending_folder_id, archived_folder_id)
-
-                    logger.info(f"Downloading file {file_name} for {import_type} parsing")
-                    file_bytes = self.download_file(drive_service, file_info['file']['id'])
-                    with zipfile.ZipFile(file_bytes) as zip_file:
-                        file_obj = get_file_obj_from_zip(zip_file, import_type)
-                        with zip_file.open(file_obj) as data_file:
-                            if import_type == "pies":
-                                pies_file_parser = PiesFileParser(data_file, brand_short_name)
-                                PiesDataStorage(pies_file_parser.get_brand_data()).store_brand_data(on_complete)
-                            elif import_type == "pies_flat":
-                                PiesCategoryDataStorage(get_csv_lines(data_file), brand_short_name).store_category_data(on_complete)
-                            elif import_type == "aces":
-                                aces_file_parser = AcesFileParser(get_csv_lines(data_file), brand_short_name)
-                                AcesDataStorage(aces_file_parser).store_brand_fitment(on_complete)
-                elif import_action == ImportTracking.DO_ARCHIVE:
-                    logger.info(f"Archiving file {file_name}")
-                    archive_file(drive_service, file_info['file']['id'], pending_folder_id, archived_folder_id)
-                else:
-                    logger.info(f"Skipping import of file {file_name}.  Check if there is any part data or category data yet")
+        import_brand = functools.partial(import_brand_files, pending_folder_id=pending_folder_id, archived_folder_id=archived_folder_id)
+        brand_chains = get_brand_chains(files_to_parse)
+        brand_import_scheduler = BrandImportScheduler(import_brand, settings.IMPORT_BRAND_PROCESSES)
+        if brand_import_scheduler.runs_in_process(brand_chains):
+            # one prefetcher over every brand, the first file of a brand downloads while the last file of the brand before it is imported
+            with get_drive_prefetcher([file_info for file_infos in brand_chains.values() for file_info in file_infos]) as drive_prefetcher:
+                num_imported = BrandImportScheduler(functools.partial(import_brand, drive_prefetcher=drive_prefetcher)).run(brand_chains)
+        else:
+            num_imported = brand_import_scheduler.run(brand_chains)
 
         for file_to_archive in files_to_archive:
             file_name = file_to_archive['file']['name']
@@ -76,19 +64,135 @@ class Command(BaseCommand):
                 logger.info(f"Archiving file {file_name}")
                 archive_file(drive_service, file_to_archive['file']['id'], pending_folder_id, archived_folder_id)
 
+        if num_imported and settings.ORPHAN_GC_BATCH_SIZE:
+            self.collect_orphans()
+
+    def collect_orphans(self):
+        """
+        Deletes the attributes, vehicles and assets the imported files stopped using.  A failure is logged and left for the next run, the imports themselves are complete.
+        Nothing is collected while another run is still importing, see ImportInProgressLock.
+        """
+        logger.info("Collecting orphaned lookup rows")
+        orphan_collector = OrphanCollector(batch_size=settings.ORPHAN_GC_BATCH_SIZE)
+        try:
+            reclaimed = orphan_collector.collect()
+        except Exception:
+            logger.exception("Collecting orphaned lookup rows failed")
+            return
+        orphan_collector.log_stats(logger)
+        logger.info(f"Reclaimed {sum(reclaimed.values())} orphaned rows")
+
+    def import_file(self, drive_service, drive_prefetcher, file_info, pending_folder_id, archived_folder_id):
+        """
+        Imports, archives or skips one pending file depending on its tracking state, files that are not imported are released from drive_prefetcher
+        Returns:
+            True if the file was imported
+        """
+        brand_short_name = file_info['brand_short_name']
+        import_type = file_info['import_type']
+        import_action = ImportTracking.objects.get_import_action(brand_short_name, file_info['date'], import_type)
+        file_name = file_info['file']['name']
+        imported = False
+        logger.info(f"Determining if file {file_name} should be parsed")
+        with TrackingRecord(import_type, import_action, brand_short_name, file_name) as tracking_record:
+            if import_action == ImportTracking.DO_IMPORT:
+                def on_complete():
+                    archive_file(drive_service, file_info['file']['id'], pending_folder_id, archived_folder_id)
+
+                logger.info(f"Downloading file {file_name} for {import_type} parsing")
+                with drive_prefetcher.get_file(file_info) as zip_bytes, open_zip(zip_bytes, drive_prefetcher.is_on_disk(file_info)) as zip_file:
+                    file_obj = get_file_obj_from_zip(zip_file, import_type)
+                    content_hash = get_zip_member_hash(zip_file, file_obj)
+                    tracking_record.content_hash = content_hash
+                    if ImportTracking.objects.is_content_unchanged(brand_short_name, import_type, content_hash):
+                        logger.info(f"File {file_name} is identical to the last {import_type} import, archiving without parsing")
+                        tracking_record.import_action = ImportTracking.DO_ARCHIVE
+                        archive_file(drive_service, file_info['file']['id'], pending_folder_id, archived_folder_id)
+                    else:
+                        self.store_data_file(zip_file, file_obj, tracking_record, on_complete)
+                        imported = True
+            elif import_action == ImportTracking.DO_ARCHIVE:
+                drive_prefetcher.release(file_info)
+                logger.info(f"Archiving file {file_name}")
+                archive_file(drive_service, file_info['file']['id'], pending_folder_id, archived_folder_id)
+            else:
+                drive_prefetcher.release(file_info)
+                logger.info(f"Skipping import of file {file_name}.  Check if there is any part data or category data yet")
+        return imported
+
+    def store_data_file(self, zip_file, file_obj, tracking_record, on_complete):
+        """
+        Stores the data file of a zip, resuming after the chunks committed by a failed import of the same content.
+        When the database fails the file is stored again after a backoff, from the chunks committed so far, instead of restarting the whole import.
+        """
+        import_type = tracking_record.tracking_type.name
+        # saved up front so an import that is killed part way through can be resumed too
+        tracking_record.save(update_fields=["content_hash"])
+        # pies_flat chunks are cheap to store again and are not checkpointed
+        if import_type != "pies_flat":
+            ImportCheckpoint.resume(tracking_record)
+
+        def store():
+            for connection in connections.all():
+                # a connection dropped by the last attempt is not reopened by Django until it is closed
+                if connection.connection is not None and not connection.is_usable():
+                    connection.close()
+            checkpoint = ImportCheckpoint(tracking_record.id) if import_type != "pies_flat" else None
+            try:
+                with zip_file.open(file_obj) as data_file:
+                    self.import_data_file(data_file, tracking_record.brand_short_name, import_type, tracking_record.content_hash, on_complete, checkpoint)
+            except CheckpointMismatch:
+                checkpoint.reset()
+                raise
+
+        with_backoff(store, logger, store_retry_errors, settings.IMPORT_STORE_ATTEMPTS, settings.IMPORT_STORE_RETRY_SECONDS)
+
+    def import_data_file(self, data_file, brand_short_name, import_type, content_hash, on_complete, checkpoint=None):
+        """
+        Parses and stores data_file.  Parsed pies and aces data is cached until it has been stored, so when storing fails with an error that is retried the retry starts from the cache.
+        Any other error leaves the rest of the file unparsed.
+        Chunks committed to checkpoint are not stored again.
+        """
+        if import_type == "pies_flat":
+            PiesCategoryDataStorage(data_file, brand_short_name).store_category_data(on_complete)
+            return
+        parsed_data_cache = ParsedDataCache(settings.PARSED_DATA_CACHE_DIR, brand_short_name, import_type, content_hash)
+        try:
+            if import_type == "pies":
+                pies_file_parser = PiesFileParser(data_file, brand_short_name, processes=settings.PIES_PARSE_PROCESSES, engine=settings.PIES_XML_ENGINE)
+                PiesDataStorage(get_cached_brand_data(parsed_data_cache, pies_file_parser), pipeline_queue_size=settings.IMPORT_PIPELINE_QUEUE_SIZE, checkpoint=checkpoint).store_brand_data(on_complete)
+            elif import_type == "aces":
+                aces_file_parser = None
+                if not parsed_data_cache.is_cached():
+                    aces_file_parser = AcesFileParser(data_file, brand_short_name, sort_engine=settings.ACES_SORT_ENGINE, sort_run_size=settings.ACES_SORT_RUN_SIZE, sort_temp_dir=settings.ACES_SORT_TEMP_DIR,
+                                                      processes=settings.ACES_PARSE_PROCESSES, partitions=settings.ACES_PARSE_PARTITIONS, normaliser=settings.ACES_NORMALISER)
+                AcesDataStorage(
+                    CachedAcesFileParser(parsed_data_cache, brand_short_name, aces_file_parser), fitment_diff=settings.ACES_FITMENT_DIFF, pipeline_queue_size=settings.IMPORT_PIPELINE_QUEUE_SIZE,
+                    checkpoint=checkpoint
+                ).store_brand_fitment(on_complete)
+        except store_retry_errors:
+            parsed_data_cache.finish()
+            raise
+        except Exception:
+            parsed_data_cache.discard()
+            raise
+        parsed_data_cache.clear()
+
     def get_files_to_process(self, drive_service):
         logging.info("Retrieving files to import")
-        pending_data_folder_result = drive_service.files().list(q="name = 'pending data'").execute()
-        archived_data_folder_result = drive_service.files().list(q="name = 'archived data'").execute()
+        pending_data_folder_result = drive_service.files().list(q="name = 'pending data'").execute(num_retries=settings.DRIVE_NUM_RETRIES)
+        archived_data_folder_result = drive_service.files().list(q="name = 'archived data'").execute(num_retries=settings.DRIVE_NUM_RETRIES)
         pending_data_folder_id = pending_data_folder_result['files'][0]['id']
         archived_data_folder_id = archived_data_folder_result['files'][0]['id']
         query = f"'{pending_data_folder_id}' in parents"
         page_size = 1000
-        pending_files_request = drive_service.files().list(q=query, pageSize=page_size).execute()
+        # size lets the prefetcher keep its downloads within the disk budget
+        fields = "nextPageToken, files(id, name, size)"
+        pending_files_request = drive_service.files().list(q=query, pageSize=page_size, fields=fields).execute(num_retries=settings.DRIVE_NUM_RETRIES)
         pending_files = pending_files_request['files']
         next_token = pending_files_request.get('nextPageToken', None)
         while next_token:
-            pending_files_request = drive_service.files().list(pageToken=next_token, pageSize=page_size, q=query).execute()
+            pending_files_request = drive_service.files().list(pageToken=next_token, pageSize=page_size, q=query, fields=fields).execute(num_retries=settings.DRIVE_NUM_RETRIES)
             pending_files += pending_files_request['files']
             next_token = pending_files_request.get('nextPageToken', None)
 
@@ -131,16 +235,6 @@ class Command(BaseCommand):
             'archived_folder_id': archived_data_folder_id
         }
 
-    def download_file(self, drive_service, file_id):
-        request = drive_service.files().get_media(fileId=file_id)
-        file_bytes = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_bytes, request, chunksize=2048 * 2048)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk(num_retries=10)
-            logger.info(f'Downloaded {file_id} {int(status.progress() * 100)}%')
-        return file_bytes
-
 
 class TrackingRecord(object):
     def __init__(self, tracking_type, import_action, brand_short_name, file_name):
@@ -152,14 +246,51 @@ class TrackingRecord(object):
     def __enter__(self):
         tracking_type_record = ImportTrackingType.objects.get_or_create(name=self.tracking_type)[0]
         self.tracking_record = ImportTracking.objects.create(brand_short_name=self.brand_short_name, import_action=self.import_action, tracking_type=tracking_type_record, file_name=self.file_name)
+        return self.tracking_record
 
     def __exit__(self, *args):
         if sys.exc_info()[0]:
             self.tracking_record.stack_trace = traceback.format_exc()
         else:
             self.tracking_record.end_date = datetime.datetime.now(pytz.timezone("UTC"))
-        self.tracking_record.save()
+        # the checkpoint fields are written by ImportCheckpoint as chunks commit
+        self.tracking_record.save(update_fields=["import_action", "content_hash", "stack_trace", "end_date", "updated_on"])
+
+
+def get_drive_service():
+    return build_google_service('drive', 'v3', ['https://www.googleapis.com/auth/drive'])
+
+
+def get_drive_prefetcher(file_infos):
+    """
+    Returns:
+        A DrivePrefetcher of file_infos configured from settings
+    """
+    return DrivePrefetcher(get_drive_service, file_infos, settings.DRIVE_PREFETCH_FILES, settings.DRIVE_PREFETCH_DISK_MB * 1024 * 1024, settings.DRIVE_DOWNLOAD_TEMP_DIR,
+                           settings.DRIVE_SPOOL_MAX_MB * 1024 * 1024)
+
+
+def import_brand_files(brand_short_name, file_infos, pending_folder_id, archived_folder_id, drive_prefetcher=None):
+    """
+    Imports the pending files of one brand in order, run by BrandImportScheduler in a worker process or the main one.
+    Each call builds its own drive service, http connections cannot be shared between processes.
+    Args:
+        drive_prefetcher: Prefetcher shared by the brands imported in the main process, file_infos have to be in its files in the same order.  None builds one for just this brand
+    Returns:
+        The number of files imported
+    """
+    if drive_prefetcher is None:
+        with get_drive_prefetcher(file_infos) as drive_prefetcher:
+            return import_brand_files(brand_short_name, file_infos, pending_folder_id, archived_folder_id, drive_prefetcher)
+    drive_service = get_drive_service()
+    command = Command()
+    num_imported = 0
+    for file_info in file_infos:
+        if command.import_file(drive_service, drive_prefetcher, file_info, pending_folder_id, archived_folder_id):
+            num_imported += 1
+    return num_imported
 
 
 def archive_file(drive_service, file_id, pending_folder_id, archived_folder_id):
-    drive_service.files().update(fileId=file_id, addParents=archived_folder_id, removeParents=pending_folder_id).execute()
+    # execute backs off exponentially on rate limits and server errors
+    drive_service.files().update(fileId=file_id, addParents=archived_folder_id, removeParents=pending_folder_id).execute(num_retries=settings.DRIVE_NUM_RETRIES)
@@ -1,12 +1,11 @@
 import os
 import re
-import zipfile
 
 from django.conf import settings
 from django.core.management import BaseCommand
 import logging
 
-from aces_pies_data.management.import_utils import get_file_obj_from_zip, get_csv_lines, parse_file_name
+from aces_pies_data.management.import_utils import get_file_obj_from_zip, open_zip, parse_file_name
 from aces_pies_data.util.aces_pies_parsing import PiesFileParser, AcesFileParser
 from aces_pies_data.util.aces_pies_storage import PiesDataStorage, PiesCategoryDataStorage, AcesDataStorage
 
@@ -31,18 +30,19 @@ class Command(BaseCommand):
         files_to_parse = self.get_files_to_process()
         for file_info in files_to_parse:
             with open(file_info['file_path'], 'rb') as file:
-                with zipfile.ZipFile(file) as zip_file:
+                with open_zip(file) as zip_file:
                     import_type = file_info['import_type']
                     brand_short_name = file_info['brand_short_name']
                     file_obj = get_file_obj_from_zip(zip_file, import_type)
                     with zip_file.open(file_obj) as data_file:
                         if import_type == "pies":
-                            pies_file_parser = PiesFileParser(data_file, brand_short_name)
+                            pies_file_parser = PiesFileParser(data_file, brand_short_name, processes=settings.PIES_PARSE_PROCESSES, engine=settings.PIES_XML_ENGINE)
                             PiesDataStorage(pies_file_parser.get_brand_data()).store_brand_data()
                         elif import_type == "pies_flat":
-                            PiesCategoryDataStorage(get_csv_lines(data_file), brand_short_name).store_category_data()
+                            PiesCategoryDataStorage(data_file, brand_short_name).store_category_data()
                         elif import_type == "aces":
-                            aces_file_parser = AcesFileParser(get_csv_lines(data_file), brand_short_name)
+                            aces_file_parser = AcesFileParser(data_file, brand_short_name, sort_engine=settings.ACES_SORT_ENGINE, sort_run_size=settings.ACES_SORT_RUN_SIZE, sort_temp_dir=settings.ACES_SORT_TEMP_DIR,
+                                                              processes=settings.ACES_PARSE_PROCESSES, partitions=settings.ACES_PARSE_PARTITIONS, normaliser=settings.ACES_NORMALISER)
                             AcesDataStorage(aces_file_parser).store_brand_fitment()
 
     def get_files_to_process(self):
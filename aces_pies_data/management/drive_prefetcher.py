@@ -0,0 +1,233 @@
+import logging
+import tempfile
+import threading
+from timeit import default_timer as timer
+
+from googleapiclient.http import MediaIoBaseDownload
+
+logger = logging.getLogger('AcesPiesJob')
+
+download_chunk_size = 2048 * 2048
+
+
+def download_drive_file(drive_service, file_id, file_obj, should_stop=None):
+    """
+    Downloads a drive file into file_obj in chunks
+    Args:
+        drive_service: Drive v3 service
+        file_id: Id of the file to download
+        file_obj: Binary file object the content is written to
+        should_stop: Callable checked between chunks, the download is abandoned when it returns True
+    Returns:
+        False if the download was abandoned
+    """
+    request = drive_service.files().get_media(fileId=file_id)
+    downloader = MediaIoBaseDownload(file_obj, request, chunksize=download_chunk_size)
+    done = False
+    while done is False:
+        if should_stop and should_stop():
+            return False
+        status, done = downloader.next_chunk(num_retries=10)
+        logger.info(f'Downloaded {file_id} {int(status.progress() * 100)}%')
+    return True
+
+
+class _Download(object):
+    def __init__(self, held_bytes):
+        self.held_bytes = held_bytes
+        self.file = None
+        self.error = None
+        self.done = False
+        self.released = False
+
+
+class DrivePrefetcher(object):
+    """
+    Downloads the files of an import in a background thread while the current file is parsed and stored, so download time overlaps import time.
+    Files are spooled to temp files, kept in memory up to spool_max_bytes and moved to disk past it, so large zips are never held in memory.  The thread stays at most prefetch_files files ahead of the file being imported,
+    and only starts a download ahead while the files it holds, plus the size drive reports for the next one, fit in disk_budget_bytes.
+    The file being imported is always downloaded, whatever the budget.
+    Files have to be taken in order with get_file or passed over with release, the background thread uses its own drive service as http connections are not thread safe.
+    With prefetch_files 0 get_file downloads on the calling thread.
+    """
+    def __init__(self, get_drive_service, file_infos, prefetch_files=1, disk_budget_bytes=2 * 1024 ** 3, temp_dir=None, spool_max_bytes=64 * 1024 ** 2):
+        """
+        Args:
+            get_drive_service: Callable returning a new drive v3 service
+            file_infos: File infos as returned by get_files_to_process, in the order they are imported
+            prefetch_files: Number of files downloaded ahead of the one being imported
+            disk_budget_bytes: Maximum bytes of downloaded files waiting to be imported
+            temp_dir: Directory the downloads are spooled to, defaults to the system temp directory
+            spool_max_bytes: Size past which a download moves from memory to disk
+        """
+        self.get_drive_service = get_drive_service
+        self.file_infos = list(file_infos)
+        self.file_ids = [file_info['file']['id'] for file_info in self.file_infos]
+        self.prefetch_files = prefetch_files
+        self.disk_budget_bytes = disk_budget_bytes
+        self.temp_dir = temp_dir
+        self.spool_max_bytes = spool_max_bytes
+        self.downloads = [None] * len(self.file_infos)
+        self.file_ids_on_disk = set()
+        self.position = 0
+        self.held_bytes = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.stats = {
+            'files': 0,
+            'bytes': 0,
+            'download_seconds': 0.0,
+            'wait_seconds': 0.0
+        }
+        self._thread = None
+        self._drive_service = None
+
+    def __enter__(self):
+        if self.prefetch_files and self.file_infos:
+            self._thread = threading.Thread(target=self._download_files, name="drive prefetcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self._thread:
+            self._thread.join()
+        for download in self.downloads:
+            if download and download.file and not download.released:
+                download.file.close()
+        logger.info(
+            f"Downloaded {self.stats['files']} files, {self.stats['bytes']} bytes in {self.stats['download_seconds']} seconds, "
+            f"imports waited {self.stats['wait_seconds']} seconds for downloads"
+        )
+
+    def get_file(self, file_info):
+        """
+        Waits for the download of file_info to finish, files before it that were not taken are released
+        Returns:
+            The spooled temp file holding the content, positioned at the start, open it with open_zip and is_on_disk.  The caller closes it.
+        """
+        start = timer()
+        if not self.prefetch_files:
+            self._drive_service = self._drive_service or self.get_drive_service()
+            temp_file = self._download(self._drive_service, file_info['file']['id'])
+            self.stats['wait_seconds'] += timer() - start
+            return temp_file
+        with self.condition:
+            idx = self._move_to(file_info)
+            self.condition.wait_for(lambda: self.downloads[idx] is not None and self.downloads[idx].done)
+            download = self.downloads[idx]
+            download.released = True
+            self.held_bytes -= download.held_bytes
+            self.condition.notify_all()
+        self.stats['wait_seconds'] += timer() - start
+        if download.error:
+            raise download.error
+        return download.file
+
+    def is_on_disk(self, file_info):
+        """
+        Returns:
+            True if the download of file_info went past spool_max_bytes and was moved to disk, so it can be memory mapped
+        """
+        return file_info['file']['id'] in self.file_ids_on_disk
+
+    def release(self, file_info):
+        """
+        Passes over file_info without importing it, its download is discarded
+        """
+        if not self.prefetch_files:
+            return
+        with self.condition:
+            idx = self._move_to(file_info)
+            self._release(idx)
+            self.position = idx + 1
+            self.condition.notify_all()
+
+    def _move_to(self, file_info):
+        idx = self.file_ids.index(file_info['file']['id'])
+        for skipped_idx in range(self.position, idx):
+            self._release(skipped_idx)
+        self.position = idx
+        self.condition.notify_all()
+        return idx
+
+    def _release(self, idx):
+        download = self.downloads[idx]
+        if download and not download.released:
+            download.released = True
+            # a download still in progress is closed by the background thread when it finishes
+            if download.done:
+                self.held_bytes -= download.held_bytes
+                if download.file:
+                    download.file.close()
+
+    def _can_start(self, idx, expected_bytes):
+        if self.stopped or idx < self.position or idx == self.position:
+            return True
+        return idx <= self.position + self.prefetch_files and (self.held_bytes == 0 or self.held_bytes + expected_bytes <= self.disk_budget_bytes)
+
+    def _download_files(self):
+        drive_service = None
+        for idx, file_info in enumerate(self.file_infos):
+            expected_bytes = int(file_info['file'].get('size') or 0)
+            with self.condition:
+                self.condition.wait_for(lambda: self._can_start(idx, expected_bytes))
+                if self.stopped:
+                    return
+                if idx < self.position:
+                    continue
+                download = self.downloads[idx] = _Download(expected_bytes)
+                self.held_bytes += expected_bytes
+            temp_file, error = None, None
+            try:
+                drive_service = drive_service or self.get_drive_service()
+                temp_file = self._download(drive_service, file_info['file']['id'])
+            except Exception as e:
+                logger.exception(f"Prefetching {file_info['file']['name']} failed")
+                error = e
+            with self.condition:
+                download.file, download.error, download.done = temp_file, error, True
+                actual_bytes = self._get_size(temp_file) if temp_file else 0
+                if download.released:
+                    if temp_file:
+                        temp_file.close()
+                    self.held_bytes -= download.held_bytes
+                else:
+                    self.held_bytes += actual_bytes - download.held_bytes
+                    download.held_bytes = actual_bytes
+                self.condition.notify_all()
+
+    def _download(self, drive_service, file_id):
+        """
+        Returns:
+            A spooled temp file with the content of file_id positioned at the start, None if the prefetcher was stopped first
+        """
+        start = timer()
+        temp_file = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes, dir=self.temp_dir)
+        try:
+            if not download_drive_file(drive_service, file_id, temp_file, lambda: self.stopped):
+                temp_file.close()
+                return None
+        except Exception:
+            temp_file.close()
+            raise
+        size = self._get_size(temp_file)
+        if size > self.spool_max_bytes:
+            # already moved by the write that went past max size, rollover makes sure of it
+            temp_file.rollover()
+            self.file_ids_on_disk.add(file_id)
+        self.stats['files'] += 1
+        self.stats['bytes'] += size
+        self.stats['download_seconds'] += timer() - start
+        temp_file.seek(0)
+        return temp_file
+
+    @staticmethod
+    def _get_size(temp_file):
+        position = temp_file.tell()
+        temp_file.seek(0, 2)
+        size = temp_file.tell()
+        temp_file.seek(position)
+        return size
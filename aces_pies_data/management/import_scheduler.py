@@ -0,0 +1,137 @@
+import logging
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from timeit import default_timer as timer
+
+import django
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from aces_pies_data.util.orphan_collector import ImportInProgressLock
+
+logger = logging.getLogger('AcesPiesJob')
+
+# A brand's categories come from pies_flat, its products from pies and its fitment from aces, see ImportTrackingManager.get_import_action
+import_type_order = ("pies_flat", "pies", "aces")
+
+
+def get_brand_chains(files_to_parse):
+    """
+    Args:
+        files_to_parse: File infos as returned by get_files_to_process
+    Returns:
+        Dict of brand short name to the file infos of the brand in import order, brands keep the order they first appear in
+    """
+    brand_chains = dict()
+    for file_info in files_to_parse:
+        brand_chains.setdefault(file_info['brand_short_name'], list()).append(file_info)
+    for file_infos in brand_chains.values():
+        file_infos.sort(key=lambda file_info: import_type_order.index(file_info['import_type']))
+    return brand_chains
+
+
+class BrandImportLock(object):
+    """
+    Session level PostgreSQL advisory lock on a brand, so two workers or two overlapping cron runs never import the same brand at once.
+    The lock is only tried, acquired tells whether the brand can be imported.  Other databases have no advisory locks and always acquire.
+    """
+    def __init__(self, brand_short_name, using=DEFAULT_DB_ALIAS):
+        self.brand_short_name = brand_short_name
+        self.using = using
+        self.lock_key = zlib.crc32(f"import_aces_pies:{brand_short_name}".encode("utf-8"))
+        self.acquired = False
+
+    def __enter__(self):
+        connection = connections[self.using]
+        if connection.vendor != "postgresql":
+            self.acquired = True
+            return self
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_key])
+            self.acquired = cursor.fetchone()[0]
+        return self
+
+    def __exit__(self, *args):
+        connection = connections[self.using]
+        if self.acquired and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [self.lock_key])
+        self.acquired = False
+
+
+def import_brand_chain(import_brand, brand_short_name, file_infos):
+    """
+    Runs import_brand for one brand while holding its lock and ImportInProgressLock, in a worker process or the main one.
+    Returns:
+        The number of files import_brand imported, 0 if another process holds the brand
+    """
+    start = timer()
+    # the lookup caches of the brand's imports must not be collected from under them by another run finishing first
+    with ImportInProgressLock(), BrandImportLock(brand_short_name) as brand_lock:
+        if not brand_lock.acquired:
+            logger.warning(f"Brand {brand_short_name} is being imported by another process, skipping its files")
+            return 0
+        num_imported = import_brand(brand_short_name, file_infos)
+    logger.info(f"Finished {len(file_infos)} files of brand {brand_short_name} in {timer() - start} seconds")
+    return num_imported
+
+
+class BrandImportScheduler(object):
+    """
+    Imports the file chains of several brands.  Files of a brand are imported in order, brands run in a pool of worker processes.
+    Brands do share the lookup tables of categories, attributes, digital assets and vehicles.  Each chunk is stored while holding the shared tables lock, see lock_shared_tables,
+    so workers take turns writing and only downloading and parsing run in parallel.  Wall clock time gains are bounded by that, which is why one process stays the default.
+    A failed brand does not stop the others, the first failure is raised once every brand has finished.
+    """
+    def __init__(self, import_brand, processes=1):
+        """
+        Args:
+            import_brand: Picklable callable taking a brand short name and its file infos, returning the number of files imported
+            processes: Number of brands imported at once, 1 imports them one after another in this process
+        """
+        self.import_brand = import_brand
+        self.processes = processes
+
+    def run(self, brand_chains):
+        """
+        Args:
+            brand_chains: Dict of brand short name to file infos in import order, as returned by get_brand_chains
+        Returns:
+            The number of files imported
+        """
+        start = timer()
+        brand_results = dict()
+        if self.runs_in_process(brand_chains):
+            for brand_short_name, file_infos in brand_chains.items():
+                brand_results[brand_short_name] = self._get_result(lambda: import_brand_chain(self.import_brand, brand_short_name, file_infos), brand_short_name)
+        else:
+            # forked workers must not share the parent's database connections, each opens its own
+            connections.close_all()
+            # django.setup is needed for spawned (non forked) workers
+            with ProcessPoolExecutor(max_workers=min(self.processes, len(brand_chains)), initializer=django.setup) as executor:
+                brand_futures = {
+                    executor.submit(import_brand_chain, self.import_brand, brand_short_name, file_infos): brand_short_name for brand_short_name, file_infos in brand_chains.items()
+                }
+                for brand_future in as_completed(brand_futures):
+                    brand_short_name = brand_futures[brand_future]
+                    brand_results[brand_short_name] = self._get_result(brand_future.result, brand_short_name)
+        failed_brands = [brand_short_name for brand_short_name, brand_result in brand_results.items() if isinstance(brand_result, Exception)]
+        num_imported = sum(brand_result for brand_result in brand_results.values() if not isinstance(brand_result, Exception))
+        logger.info(f"Imported {num_imported} files of {len(brand_chains)} brands with {self.processes} processes in {timer() - start} seconds, {len(failed_brands)} brands failed")
+        if failed_brands:
+            raise RuntimeError(f"Import failed for brands {', '.join(failed_brands)}") from brand_results[failed_brands[0]]
+        return num_imported
+
+    def runs_in_process(self, brand_chains):
+        """
+        Returns:
+            True if run imports brand_chains one after another in this process, import_brand then does not need to be picklable
+        """
+        return self.processes <= 1 or len(brand_chains) <= 1
+
+    @staticmethod
+    def _get_result(get_brand_result, brand_short_name):
+        try:
+            return get_brand_result()
+        except Exception as e:
+            logger.exception(f"Import of brand {brand_short_name} failed")
+            return e
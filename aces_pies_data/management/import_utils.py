@@ -1,4 +1,9 @@
+import contextlib
+import hashlib
+import io
+import mmap
 import time
+import zipfile
 import re
 import datetime
 import pytz
@@ -18,6 +23,52 @@ def get_file_obj_from_zip(zip_file, import_type):
     raise ValueError(f"No file found for {import_type}")
 
 
+class _ZipMemoryMap(mmap.mmap):
+    """
+    Read only memory map of a zip, zipfile expects its file to tell whether it is seekable
+    """
+    def seekable(self):
+        return True
+
+
+@contextlib.contextmanager
+def open_zip(zip_bytes, memory_map=True):
+    """
+    Opens a zip held in a binary file object.  Zips in a file on disk are memory mapped, so members are decompressed straight from the page cache
+    and memory use does not grow with the size of the archive.
+    Args:
+        zip_bytes: Binary file object holding the zip, it stays open
+        memory_map: False reads zip_bytes as it is, pass it for a spooled temp file still held in memory as asking it for its fileno moves it to disk, see DrivePrefetcher.is_on_disk
+    Returns:
+        A context manager giving the ZipFile
+    """
+    zip_map = None
+    if memory_map:
+        try:
+            zip_map = _ZipMemoryMap(zip_bytes.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, ValueError):
+            # not a real file, or an empty one that zipfile rejects below
+            zip_map = None
+    try:
+        with zipfile.ZipFile(zip_map if zip_map is not None else zip_bytes) as zip_file:
+            yield zip_file
+    finally:
+        if zip_map is not None:
+            zip_map.close()
+
+
+def get_zip_member_hash(zip_file, file_obj, block_size=1024 * 1024):
+    """
+    Returns:
+        The sha256 hex digest of the uncompressed data of file_obj, zips are rebuilt for every send so only the member data is stable
+    """
+    member_hash = hashlib.sha256()
+    with zip_file.open(file_obj) as data_file:
+        for block in iter(lambda: data_file.read(block_size), b''):
+            member_hash.update(block)
+    return member_hash.hexdigest()
+
+
 def get_csv_lines(csv_file):
     for line in csv_file:
         yield line.decode("utf-8")
@@ -62,3 +113,27 @@ def with_retries(fn, logger, max_attempts=10):
             last_exception = e
     if last_exception:
         raise last_exception
+
+
+def with_backoff(fn, logger, retry_on=(Exception,), max_attempts=5, base_seconds=1.0, max_seconds=300.0):
+    """
+    Calls fn until it succeeds, sleeping base_seconds after the first failure and twice as long after each one that follows, up to max_seconds.
+    Args:
+        fn: Operation to retry, it is called again from scratch
+        logger: Logger failed attempts are logged to
+        retry_on: Exception types that are retried, others are raised straight away
+        max_attempts: Attempts before the last exception is raised
+    Returns:
+        The result of fn
+    """
+    attempt = 1
+    while True:
+        try:
+            return fn()
+        except retry_on:
+            if attempt >= max_attempts:
+                raise
+            delay = min(max_seconds, base_seconds * 2 ** (attempt - 1))
+            logger.exception(f"Attempt {attempt} of {max_attempts} failed, trying again in {delay} seconds")
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0002_auto_20180208_2308'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importtracking',
+            name='content_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
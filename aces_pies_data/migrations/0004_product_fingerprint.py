@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0003_importtracking_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='fingerprint',
+            field=models.CharField(max_length=40, null=True),
+        ),
+    ]
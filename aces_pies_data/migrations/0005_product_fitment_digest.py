@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0004_product_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='fitment_digest',
+            field=models.CharField(max_length=40, null=True),
+        ),
+    ]
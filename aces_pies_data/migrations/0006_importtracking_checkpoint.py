@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0005_product_fitment_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importtracking',
+            name='chunks_committed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importtracking',
+            name='last_part_number',
+            field=models.CharField(max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+
+def merge_records(model_cls, keep_id, duplicate_ids):
+    """
+    Points every row referencing duplicate_ids at keep_id and deletes the duplicates.
+    A referencing row that would then repeat a unique_together of its model is merged into the row it repeats the same way.
+    """
+    for relation in model_cls._meta.related_objects:
+        related_model = relation.related_model
+        field = relation.field
+        referencing_rows = related_model.objects.filter(**{f"{field.attname}__in": duplicate_ids})
+        unique_keys = [
+            [related_model._meta.get_field(name).attname for name in unique_together] for unique_together in related_model._meta.unique_together if field.name in unique_together
+        ]
+        if not unique_keys:
+            referencing_rows.update(**{field.attname: keep_id})
+            continue
+        for referencing_row in referencing_rows:
+            setattr(referencing_row, field.attname, keep_id)
+            for unique_key in unique_keys:
+                stored_row = related_model.objects.filter(**{attname: getattr(referencing_row, attname) for attname in unique_key}).exclude(id=referencing_row.id).first()
+                if stored_row:
+                    merge_records(related_model, stored_row.id, [referencing_row.id])
+                    break
+            else:
+                related_model.objects.filter(id=referencing_row.id).update(**{field.attname: keep_id})
+    model_cls.objects.filter(id__in=duplicate_ids).delete()
+
+
+def merge_duplicates(model_cls, key_fields):
+    """
+    Merges the rows of model_cls with the same values in key_fields into the oldest of them, a NULL matches a NULL
+    """
+    record_ids = dict()
+    for record in model_cls.objects.order_by("id").values_list("id", *key_fields):
+        record_ids.setdefault(tuple(record[1:]), list()).append(record[0])
+    for duplicate_ids in record_ids.values():
+        if len(duplicate_ids) > 1:
+            merge_records(model_cls, duplicate_ids[0], duplicate_ids[1:])
+
+
+def merge_shared_lookups(apps, schema_editor):
+    # Brands imported in parallel could create the same lookup row twice before the names were unique
+    for model_name in ("DigitalAssetType", "ImportTrackingType", "FuelType", "FuelDelivery", "EngineAspiration"):
+        merge_duplicates(apps.get_model("aces_pies_data", model_name), ("name",))
+    # and unique_together never matched the NULL columns of engines and vehicles
+    merge_duplicates(apps.get_model("aces_pies_data", "VehicleEngine"), ("configuration", "liters", "fuel_type_id", "fuel_delivery_id", "aspiration_id", "engine_code"))
+    merge_duplicates(apps.get_model("aces_pies_data", "Vehicle"), ("make_id", "model_id", "sub_model_id", "engine_id"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0006_importtracking_checkpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_shared_lookups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aces_pies_data', '0007_merge_duplicate_lookups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='digitalassettype',
+            name='name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='importtrackingtype',
+            name='name',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='fueltype',
+            name='name',
+            field=models.CharField(max_length=20, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='fueldelivery',
+            name='name',
+            field=models.CharField(max_length=10, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='engineaspiration',
+            name='name',
+            field=models.CharField(max_length=12, unique=True),
+        ),
+    ]
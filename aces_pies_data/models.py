@@ -13,7 +13,7 @@ class Base(models.Model):
 
 
 class DigitalAssetType(Base):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, unique=True)
 
 
 class DigitalAsset(Base):
@@ -51,6 +51,10 @@ class Product(Base):
     map_price = models.DecimalField(max_digits=7, decimal_places=2, null=True, db_index=True)
     retail_price = models.DecimalField(max_digits=7, decimal_places=2, null=True, db_index=True)
     category = models.ForeignKey(Category, on_delete=models.PROTECT)
+    # Hash of the parsed product data it was last stored from, products with the same fingerprint are skipped on import
+    fingerprint = models.CharField(max_length=40, null=True)
+    # Digest of the consolidated aces fitment last stored for the product, parts with the same digest are skipped on import
+    fitment_digest = models.CharField(max_length=40, null=True)
 
     class Meta:
         unique_together = ("part_number", "brand",)
@@ -115,7 +119,7 @@ class ProductDigitalAsset(Base):
 
 
 class ImportTrackingType(Base):
-    name = models.CharField(max_length=50, db_index=True)
+    name = models.CharField(max_length=50, unique=True)
 
 
 class ImportTrackingManager(models.Manager):
@@ -129,6 +133,42 @@ class ImportTrackingManager(models.Manager):
                 return ImportTracking.DO_IMPORT
             return ImportTracking.NO_ACTION
 
+    def is_content_unchanged(self, brand_short_name, import_type, content_hash):
+        """
+        DCI often sends byte identical files under a new date, those do not need parsing again.
+        A pies file also depends on the categories of the last pies_flat import, and an aces file on the products of the last pies import,
+        so a file only counts as unchanged if the file it depends on has not been imported since.
+        Returns:
+            True if content_hash matches the data of the last completed import of import_type for the brand
+        """
+        last_completed_import = self.filter(brand_short_name=brand_short_name, tracking_type__name=import_type, import_action=ImportTracking.DO_IMPORT, end_date__isnull=False).order_by("-start_date").first()
+        if not last_completed_import or last_completed_import.content_hash != content_hash:
+            return False
+        dependent_import_type = ImportTracking.import_dependencies.get(import_type)
+        if dependent_import_type:
+            return not self.filter(brand_short_name=brand_short_name, tracking_type__name=dependent_import_type, import_action=ImportTracking.DO_IMPORT, end_date__isnull=False,
+                                   start_date__gt=last_completed_import.start_date).exists()
+        return True
+
+    def get_resumable_import(self, brand_short_name, import_type, content_hash, exclude_id=None):
+        """
+        An import that failed part way through can be resumed by a later import of the same content, unless the file it depends on has been imported since it started,
+        its committed chunks were stored against the data that import replaced.
+        Returns:
+            The last failed import of content_hash for the brand with committed chunks, None if there is none to resume
+        """
+        failed_import = self.filter(brand_short_name=brand_short_name, tracking_type__name=import_type, import_action=ImportTracking.DO_IMPORT, end_date__isnull=True, content_hash=content_hash,
+                                    chunks_committed__gt=0).exclude(id=exclude_id).order_by("-start_date").first()
+        if not failed_import:
+            return None
+        if self.filter(brand_short_name=brand_short_name, tracking_type__name=import_type, end_date__isnull=False, start_date__gt=failed_import.start_date).exists():
+            return None
+        dependent_import_type = ImportTracking.import_dependencies.get(import_type)
+        if dependent_import_type and self.filter(brand_short_name=brand_short_name, tracking_type__name=dependent_import_type, import_action=ImportTracking.DO_IMPORT, end_date__isnull=False,
+                                                 start_date__gt=failed_import.start_date).exists():
+            return None
+        return failed_import
+
 
 class ImportTracking(Base):
     DO_IMPORT = 1
@@ -140,6 +180,10 @@ class ImportTracking(Base):
         (DO_ARCHIVE, 'Archive'),
         (NO_ACTION, 'No Action'),
     )
+    import_dependencies = {
+        "pies": "pies_flat",
+        "aces": "pies"
+    }
 
     tracking_type = models.ForeignKey(ImportTrackingType, on_delete=models.PROTECT, related_name="tracking_records")
     import_action = models.IntegerField(choices=action_choices, default=1, db_index=True)
@@ -148,6 +192,11 @@ class ImportTracking(Base):
     brand_short_name = models.CharField(max_length=10, db_index=True)
     start_date = models.DateTimeField(auto_now_add=True, db_index=True)
     end_date = models.DateTimeField(db_index=True, null=True)
+    # sha256 of the data file inside the zip, the manifest used to skip files that were already imported
+    content_hash = models.CharField(max_length=64, db_index=True, null=True)
+    # chunks of the file committed so far and the last part number of the last one, the checkpoint a failed import is resumed from
+    chunks_committed = models.IntegerField(default=0)
+    last_part_number = models.CharField(max_length=50, null=True)
     objects = ImportTrackingManager()
 
 
@@ -172,15 +221,15 @@ class VehicleSubModel(Base):
 
 
 class FuelType(Base):
-    name = models.CharField(max_length=20)
+    name = models.CharField(max_length=20, unique=True)
 
 
 class FuelDelivery(Base):
-    name = models.CharField(max_length=10)
+    name = models.CharField(max_length=10, unique=True)
 
 
 class EngineAspiration(Base):
-    name = models.CharField(max_length=12)
+    name = models.CharField(max_length=12, unique=True)
 
 
 class VehicleEngine(Base):
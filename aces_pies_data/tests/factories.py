@@ -0,0 +1,192 @@
+"""
+Builders for synthetic DCI files used by the tests.
+The real production files are too large to keep in the repository, these generate files with the same structure.
+"""
+import random
+
+PIES_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<PIES xmlns="http://www.autocare.org" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Header>
+    <PIESVersion>6.7</PIESVersion>
+    <SubmissionType>FULL</SubmissionType>
+    <BlanketEffectiveDate>2018-01-01</BlanketEffectiveDate>
+  </Header>
+  <MarketingCopy>
+    <MarketCopy>
+      <MarketCopyContent>{brand_name} marketing copy</MarketCopyContent>
+      <DigitalAssets>
+        <DigitalFileInformation>
+          <FileName>logo.jpg</FileName>
+          <AssetType>LGO</AssetType>
+          <FileSize>1024</FileSize>
+          <URI>http://fake.logo.com/logo.jpg</URI>
+        </DigitalFileInformation>
+      </DigitalAssets>
+    </MarketCopy>
+  </MarketingCopy>
+  <Items>
+"""
+
+PIES_ITEM = """    <Item MaintenanceType="A">
+      <HazardousMaterialCode>N</HazardousMaterialCode>
+      <PartNumber>{part_number}</PartNumber>
+      <BrandAAIAID>TEST</BrandAAIAID>
+      <BrandLabel>{brand_name}</BrandLabel>
+      <ItemLevelGTIN GTINQualifier="UP">00000000{idx:06d}</ItemLevelGTIN>
+      <Descriptions>
+        <Description MaintenanceType="A" DescriptionCode="DES" LanguageCode="EN">Short description {idx}</Description>
+        <Description MaintenanceType="A" DescriptionCode="EXT" LanguageCode="EN">Extended description {idx}</Description>
+        <Description MaintenanceType="A" DescriptionCode="FAB" LanguageCode="EN" Sequence="2">Second feature {idx}</Description>
+        <Description MaintenanceType="A" DescriptionCode="FAB" LanguageCode="EN" Sequence="1">First feature {idx}</Description>
+      </Descriptions>
+      <Prices>
+        <Pricing MaintenanceType="A" PriceType="RET">
+          <PriceSheetNumber>1</PriceSheetNumber>
+          <Price UOM="PE">{retail_price}</Price>
+        </Pricing>
+        <Pricing MaintenanceType="A" PriceType="RMP">
+          <PriceSheetNumber>1</PriceSheetNumber>
+          <Price UOM="PE">{map_price}</Price>
+        </Pricing>
+      </Prices>
+      <ExtendedInformation>
+        <ExtendedProductInformation MaintenanceType="A" EXPICode="EMS">{ems}</ExtendedProductInformation>
+        <ExtendedProductInformation MaintenanceType="A" EXPICode="LIF">{lif}</ExtendedProductInformation>
+        <ExtendedProductInformation MaintenanceType="A" EXPICode="PTS">{part_number}-NEW</ExtendedProductInformation>
+      </ExtendedInformation>
+      <ProductAttributes>
+        <ProductAttribute MaintenanceType="A" AttributeID="color finish" LanguageCode="EN"> Black {idx} </ProductAttribute>
+        <ProductAttribute MaintenanceType="A" AttributeID="material" LanguageCode="EN">Steel</ProductAttribute>
+      </ProductAttributes>
+      <Packages>
+        <Package MaintenanceType="A">
+          <PackageUOM>EA</PackageUOM>
+          <QuantityofEaches>1</QuantityofEaches>
+          <Dimensions UOM="IN">
+            <Height>{height}</Height>
+            <Width>5.00</Width>
+            <Length>6.00</Length>
+          </Dimensions>
+          <Weights UOM="PG">
+            <Weight>1.50</Weight>
+            <DimensionalWeight>2.25</DimensionalWeight>
+          </Weights>
+        </Package>
+        <Package MaintenanceType="A">
+          <PackageUOM>CA</PackageUOM>
+          <QuantityofEaches>12</QuantityofEaches>
+        </Package>
+      </Packages>
+      <DigitalAssets>
+        <DigitalFileInformation MaintenanceType="A" LanguageCode="EN">
+          <FileName>{part_number}_main.jpg</FileName>
+          <AssetType>P04</AssetType>
+          <FileType>JPG</FileType>
+          <FileSize>{file_size}</FileSize>
+          <URI>http://fake.image.com/{part_number}_main.jpg</URI>
+          <Country>US</Country>
+        </DigitalFileInformation>
+        <DigitalFileInformation MaintenanceType="A" LanguageCode="EN">
+          <FileName>{part_number}_side.jpg</FileName>
+          <AssetType>P01</AssetType>
+          <FileType>JPG</FileType>
+          <FileSize>not a size</FileSize>
+          <URI>http://fake.image.com/{part_number}_side.jpg</URI>
+        </DigitalFileInformation>
+        <DigitalFileInformation MaintenanceType="A" LanguageCode="EN">
+          <FileName>{part_number}_install.pdf</FileName>
+          <AssetType>INS</AssetType>
+          <FileType>PDF</FileType>
+          <FileSize>2048</FileSize>
+          <URI>http://fake.docs.com/{part_number}_install.pdf</URI>
+        </DigitalFileInformation>
+        <DigitalFileInformation MaintenanceType="A" LanguageCode="EN">
+          <FileName>{part_number}.zip</FileName>
+          <AssetType>ZZZ</AssetType>
+          <URI>http://fake.docs.com/{part_number}.zip</URI>
+        </DigitalFileInformation>
+      </DigitalAssets>
+    </Item>
+"""
+
+PIES_FOOTER = """  </Items>
+  <Trailer>
+    <ItemCount>{num_items}</ItemCount>
+    <TransactionDate>2018-01-01</TransactionDate>
+  </Trailer>
+</PIES>
+"""
+
+
+def write_pies_xml(pies_file, num_items, brand_name="Test Brand", part_prefix="TB"):
+    """
+    Writes a PIES 6.7 document with num_items items to the binary file object pies_file
+    """
+    pies_file.write(PIES_HEADER.format(brand_name=brand_name).encode("utf-8"))
+    for idx in range(num_items):
+        pies_file.write(PIES_ITEM.format(
+            idx=idx, part_number=f"{part_prefix}{idx:07d}", brand_name=brand_name, retail_price=f"{10 + idx % 90}.499", map_price=f"{9 + idx % 90}.25",
+            ems=idx % 3, lif=(2, 7, 8, 9)[idx % 4], height=f"{1 + idx % 7}.125", file_size=1000 + idx
+        ).encode("utf-8"))
+    pies_file.write(PIES_FOOTER.format(num_items=num_items).encode("utf-8"))
+
+
+ACES_COLUMNS = (
+    'exppartno', 'brandaaiaid', 'catcode', 'year', 'make', 'model', 'submodel', 'engtype', 'liter', 'fuel', 'fueldel', 'asp', 'engvin', 'engdesg', 'dciptdescr', 'expldescr', 'vqdescr', 'fndescr'
+)
+
+ACES_VEHICLES = (
+    # make, model, submodel, engtype, liter, fuel, fueldel, asp, engdesg
+    ('Ford', 'Mustang', 'GT', 'V8', '5.0', 'GAS', 'FI', 'N', 'Coyote'),
+    ('Ford', 'Mustang', '', 'L4', '2.3', 'GAS', 'FI', 'T', ''),
+    ('Ford', 'F-150', 'XLT', 'V6', '3.5', 'GAS', 'FI', 'T', 'EcoBoost'),
+    ('Chevrolet', 'Camaro', 'SS', 'V8', '6.2', 'GAS', 'FI', 'N', 'LT1'),
+    ('Chevrolet', 'Silverado 1500', '', '', '', '', '', '', ''),
+    ('Dodge', 'Challenger', 'R/T', 'V8', '5.7', 'GAS', 'FI', 'N', 'Hemi'),
+    ('Dodge', 'Challenger', 'SRT Hellcat', 'V8', '6.2', 'GAS', 'FI', 'S', 'Hellcat'),
+    ('Subaru', 'WRX', 'STI', 'H4', '2.5', 'GAS', 'FI', 'T', 'EJ257'),
+)
+
+
+def get_aces_rows(num_parts, part_prefix="TB", seed=0):
+    """
+    Returns:
+        A list of aces flat file rows as dicts.  Every part fits a few vehicles over year ranges with gaps, some parts also have an ALL row
+    """
+    randomizer = random.Random(seed)
+    rows = list()
+    for part_idx in range(num_parts):
+        part_number = f"{part_prefix}{part_idx:07d}"
+        for vehicle in randomizer.sample(ACES_VEHICLES, 3):
+            make, model, submodel, engtype, liter, fuel, fueldel, asp, engdesg = vehicle
+            start_year = randomizer.randint(1990, 2010)
+            years = [year for year in range(start_year, start_year + randomizer.randint(1, 8)) if year % 7 != part_idx % 7]
+            fitment_note = randomizer.choice(('', 'With Manual Transmission', 'Without Sunroof'))
+            for year in years:
+                rows.append({
+                    'exppartno': part_number, 'brandaaiaid': 'TEST', 'catcode': '1234', 'year': str(year), 'make': make, 'model': model, 'submodel': submodel, 'engtype': engtype, 'liter': liter,
+                    'fuel': fuel, 'fueldel': fueldel, 'asp': asp, 'engvin': randomizer.choice(('', 'A', 'B')), 'engdesg': engdesg, 'dciptdescr': 'Part', 'expldescr': '',
+                    'vqdescr': fitment_note, 'fndescr': '' if year % 2 else 'Check Fitment'
+                })
+        if part_idx % 10 == 0:
+            rows.append({column: '' for column in ACES_COLUMNS})
+            rows[-1].update({'exppartno': part_number, 'year': 'ALL', 'make': 'ALL', 'model': 'ALL'})
+    return rows
+
+
+def write_aces_flat_file(aces_file, rows):
+    """
+    Writes rows in the pipe delimited n1parts.txt layout to the binary file object aces_file
+    """
+    aces_file.write(("|".join(ACES_COLUMNS) + "\r\n").encode("utf-8"))
+    for row in rows:
+        aces_file.write(("|".join(row[column] for column in ACES_COLUMNS) + "\r\n").encode("utf-8"))
+
+
+def write_pies_flat_file(pies_flat_file, num_items, part_prefix="TB", categories=("Brake Pad", "Brake Rotor", "Spark Plug")):
+    """
+    Writes the pipe delimited piesdata67.txt layout for the parts of write_pies_xml to the binary file object pies_flat_file
+    """
+    pies_flat_file.write(b"PartNumber|BrandAAIAID|partterminologyname\r\n")
+    for idx in range(num_items):
+        pies_flat_file.write(f"{part_prefix}{idx:07d}|TEST|{categories[idx % len(categories)]}\r\n".encode("utf-8"))
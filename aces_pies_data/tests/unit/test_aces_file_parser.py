@@ -0,0 +1,211 @@
+import io
+import os
+import random
+
+import pytest
+
+from aces_pies_data.models import Brand
+from aces_pies_data.tests.factories import get_aces_rows, write_aces_flat_file
+from aces_pies_data.util.aces_pies_parsing import AcesFileParser, ColumnarFitmentNormaliser, consolidate_fitment_values
+from aces_pies_data.util.external_sort import ExternalSort, HashPartitioner, read_row_blocks
+
+
+def get_unsorted_rows(num_rows):
+    randomizer = random.Random(7)
+    # the second value is the input position so stability can be checked
+    return [(f"P{randomizer.randint(0, num_rows // 4):05d}", idx) for idx in range(num_rows)]
+
+
+def test_external_sort_merges_runs():
+    rows = get_unsorted_rows(1000)
+    external_sort = ExternalSort(run_size=64)
+    assert list(external_sort.sort(iter(rows))) == sorted(rows, key=lambda row: row[0])
+    assert external_sort.stats['runs'] == 16
+    assert external_sort.stats['bytes_spilled'] > 0
+    assert not external_sort.stats['was_sorted']
+
+
+def test_external_sort_skips_sorting_sorted_input():
+    rows = sorted(get_unsorted_rows(1000))
+    external_sort = ExternalSort(run_size=64)
+    assert list(external_sort.sort(iter(rows))) == rows
+    assert external_sort.stats['was_sorted']
+    assert external_sort.stats['sort_seconds'] == 0
+
+
+def test_external_sort_does_not_spill_single_run():
+    rows = get_unsorted_rows(1000)
+    external_sort = ExternalSort(run_size=1000)
+    assert list(external_sort.sort(iter(rows))) == sorted(rows, key=lambda row: row[0])
+    assert external_sort.stats['runs'] == 0
+    assert external_sort.stats['bytes_spilled'] == 0
+
+
+def get_fitment_chunks(aces_rows, **parser_kwargs):
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, aces_rows)
+    aces_file.seek(0)
+    fitment_chunks = list()
+    for parsed_fitment in AcesFileParser(aces_file, "TB", **parser_kwargs).get_fitment_data():
+        fitment_chunks.append({
+            'parts': sorted(parsed_fitment.part_fitment_storage['storage_objects']),
+            'part_fitment': parsed_fitment.part_fitment_storage['storage_objects'],
+            'vehicles': parsed_fitment.vehicle_storage['storage_objects'],
+            'engines': parsed_fitment.engine_storage['storage_objects']
+        })
+    return fitment_chunks
+
+
+@pytest.mark.django_db
+def test_external_sort_engine_matches_sqlite_engine(tmp_path):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(120)
+    random.Random(3).shuffle(aces_rows)
+    sqlite_chunks = get_fitment_chunks(aces_rows, sort_engine="sqlite", sort_temp_dir=str(tmp_path))
+    external_chunks = get_fitment_chunks(aces_rows, sort_engine="external", sort_run_size=100, sort_temp_dir=str(tmp_path))
+    assert len(external_chunks) == 12
+    assert external_chunks == sqlite_chunks
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("sort_engine", ["external", "sqlite"])
+def test_sort_stats_are_reported(tmp_path, sort_engine):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(20)
+    random.Random(3).shuffle(aces_rows)
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, aces_rows)
+    aces_lines = io.TextIOWrapper(io.BytesIO(aces_file.getvalue()), encoding="utf-8", newline='')
+    aces_file_parser = AcesFileParser(aces_lines, "TB", sort_engine=sort_engine, sort_run_size=50, sort_temp_dir=str(tmp_path))
+    list(aces_file_parser.get_fitment_data())
+    assert aces_file_parser.sort_stats['rows'] == len(aces_rows)
+    assert aces_file_parser.sort_stats['bytes_spilled'] > 0
+    assert aces_file_parser.sort_stats['sort_seconds'] > 0
+
+
+def test_hash_partitioner_keeps_keys_together(tmp_path):
+    rows = get_unsorted_rows(5000)
+    with HashPartitioner(8, temp_dir=str(tmp_path)) as hash_partitioner:
+        partitioned_rows = list()
+        for partition_path in hash_partitioner.partition(iter(rows)):
+            with open(partition_path, 'rb') as partition_file:
+                partitioned_rows.append(list(read_row_blocks(partition_file)))
+        assert hash_partitioner.stats['rows'] == len(rows)
+    assert os.listdir(tmp_path) == []
+    assert sorted(row for partition_rows in partitioned_rows for row in partition_rows) == sorted(rows)
+    key_partitions = dict()
+    for partition, partition_rows in enumerate(partitioned_rows):
+        # rows keep their input order within a partition
+        assert partition_rows == sorted(partition_rows, key=lambda row: row[1])
+        for key, idx in partition_rows:
+            assert key_partitions.setdefault(key, partition) == partition
+
+
+def test_hash_partitioner_hands_out_full_segments_while_reading(tmp_path):
+    rows = get_unsorted_rows(5000)
+    rows_read = list()
+
+    def read_rows():
+        for row in rows:
+            rows_read.append(row)
+            yield row
+    with HashPartitioner(2, temp_dir=str(tmp_path)) as hash_partitioner:
+        segments = list()
+        for partition, segment_path in hash_partitioner.partition_segments(read_rows(), segment_rows=700):
+            with open(segment_path, 'rb') as segment_file:
+                segments.append((partition, len(rows_read), list(read_row_blocks(segment_file))))
+    # the first segment is full long before the last row is read
+    assert segments[0][1] < len(rows)
+    assert all(len(segment_rows) == 700 for partition, num_read, segment_rows in segments if num_read < len(rows))
+    for partition in range(2):
+        partition_rows = [row for segment_partition, num_read, segment_rows in segments if segment_partition == partition for row in segment_rows]
+        assert partition_rows == sorted(partition_rows, key=lambda row: row[1])
+    assert sorted(row for partition, num_read, segment_rows in segments for row in segment_rows) == sorted(rows)
+    assert os.listdir(tmp_path) == []
+
+
+def get_part_fitment(fitment_chunks):
+    part_fitment = dict()
+    for fitment_chunk in fitment_chunks:
+        for part_number in fitment_chunk['parts']:
+            assert part_number not in part_fitment
+            # vehicle years are collected over every part in a chunk, so they depend on how parts were chunked
+            part_fitment[part_number] = (fitment_chunk['part_fitment'][part_number], {
+                fitment['vehicle']: {key: value for key, value in fitment_chunk['vehicles'][fitment['vehicle']].items() if key != 'years'} for fitment in fitment_chunk['part_fitment'][part_number].values()
+            })
+    return part_fitment
+
+
+@pytest.mark.django_db
+def test_parallel_parse_matches_sequential_parse(tmp_path):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(120)
+    random.Random(3).shuffle(aces_rows)
+    sequential_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path))
+    parallel_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path), processes=2, partitions=5)
+    assert all(len(fitment_chunk['parts']) <= 10 for fitment_chunk in parallel_chunks)
+    assert get_part_fitment(parallel_chunks) == get_part_fitment(sequential_chunks)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.django_db
+def test_parallel_parse_merges_sorted_runs_in_a_stable_order(tmp_path):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(120)
+    random.Random(3).shuffle(aces_rows)
+    sequential_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path))
+    # several runs per partition
+    parallel_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path), processes=2, partitions=3, sort_run_size=40)
+    assert get_part_fitment(parallel_chunks) == get_part_fitment(sequential_chunks)
+    # chunks come in the same order every time, checkpoints rely on it
+    assert [fitment_chunk['parts'] for fitment_chunk in get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path), processes=2, partitions=3, sort_run_size=40)] == \
+        [fitment_chunk['parts'] for fitment_chunk in parallel_chunks]
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.django_db
+def test_parallel_parse_stops_workers_when_storage_stops(tmp_path):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, get_aces_rows(300))
+    aces_file.seek(0)
+    aces_file_parser = AcesFileParser(aces_file, "TB", sort_temp_dir=str(tmp_path), processes=2, partitions=2)
+    fitment_chunks = aces_file_parser.get_fitment_data(1)
+    next(fitment_chunks)
+    # the workers are blocked on their full queues, closing must not wait for them to finish
+    fitment_chunks.close()
+    assert os.listdir(tmp_path) == []
+
+
+def get_storage(parsed_fitment):
+    return {
+        storage_name: getattr(parsed_fitment, storage_name)
+        for storage_name in ('make_storage', 'model_storage', 'sub_model_storage', 'engine_storage', 'vehicle_storage', 'part_fitment_storage', 'fitment_digests')
+    }
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("part_fitment_chunks", [1, 7, 30])
+def test_columnar_normaliser_matches_dict_normaliser(part_fitment_chunks):
+    brand_record = Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(150)
+    # parts that only fit ALL are skipped without counting towards a chunk
+    aces_rows.extend([dict(aces_row, exppartno=f"TB{part_idx:07d}A") for part_idx, aces_row in enumerate(aces_rows) if aces_row['year'] == 'ALL'])
+    fitment_values = sorted((tuple(aces_row[column] for column in AcesFileParser.fitment_columns) for aces_row in aces_rows), key=lambda values: values[0])
+    dict_chunks = [get_storage(parsed_fitment) for parsed_fitment in consolidate_fitment_values(fitment_values, brand_record, part_fitment_chunks)]
+    columnar_normaliser = ColumnarFitmentNormaliser(brand_record, part_fitment_chunks, chunks_per_batch=3)
+    columnar_chunks = [get_storage(parsed_fitment) for parsed_fitment in columnar_normaliser.get_fitment_data(fitment_values)]
+    assert len(columnar_chunks) == len(dict_chunks)
+    for columnar_chunk, dict_chunk in zip(columnar_chunks, dict_chunks):
+        assert columnar_chunk == dict_chunk
+
+
+@pytest.mark.django_db
+def test_parallel_parse_with_columnar_normaliser(tmp_path):
+    Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_rows = get_aces_rows(60)
+    random.Random(3).shuffle(aces_rows)
+    sequential_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path))
+    parallel_chunks = get_fitment_chunks(aces_rows, sort_temp_dir=str(tmp_path), processes=2, partitions=3, normaliser="columnar")
+    assert get_part_fitment(parallel_chunks) == get_part_fitment(sequential_chunks)
@@ -0,0 +1,305 @@
+import io
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from aces_pies_data.models import Attribute, DigitalAsset, Product, ProductAttribute, ProductDigitalAsset, ProductFitment, ProductPackaging, Vehicle, VehicleMake, VehicleYear
+from aces_pies_data.tests.factories import get_aces_rows, write_aces_flat_file, write_pies_flat_file, write_pies_xml
+from aces_pies_data.util.aces_pies_parsing import AcesFileParser, PiesFileParser, get_product_fingerprint
+from aces_pies_data.util.aces_pies_storage import AcesDataStorage, PiesCategoryDataStorage, PiesDataStorage
+
+
+def store_pies(num_items, **storage_kwargs):
+    pies_flat_file = io.BytesIO()
+    write_pies_flat_file(pies_flat_file, num_items)
+    pies_flat_file.seek(0)
+    PiesCategoryDataStorage(pies_flat_file, "TB").store_category_data()
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, num_items)
+    pies_file.seek(0)
+    pies_data_storage = PiesDataStorage(PiesFileParser(pies_file, "TB").get_brand_data(), **storage_kwargs)
+    pies_data_storage.store_brand_data()
+    return pies_data_storage
+
+
+def store_aces(aces_rows, **storage_kwargs):
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, aces_rows)
+    aces_file.seek(0)
+    aces_data_storage = AcesDataStorage(AcesFileParser(aces_file, "TB"), **storage_kwargs)
+    aces_data_storage.store_brand_fitment()
+    return aces_data_storage
+
+
+def get_part_stats(aces_data_storage):
+    return {stat: aces_data_storage.fitment_stats[stat] for stat in ('unchanged_parts', 'changed_parts')}
+
+
+def get_fitment():
+    return set(ProductFitment.objects.values_list("product__part_number", "vehicle_id", "start_year", "end_year", "fitment_info_1", "fitment_info_2"))
+
+
+@pytest.mark.django_db
+def test_store_pies_relations():
+    pies_data_storage = store_pies(12)
+    assert Product.objects.count() == 12
+    assert ProductAttribute.objects.count() == 24
+    assert ProductDigitalAsset.objects.count() == 36
+    packaging = ProductPackaging.objects.values_list("product_quantity", "weight", "dimensional_weight", "length", "width")
+    assert set(packaging) == {(1, Decimal("1.50"), Decimal("2.25"), Decimal("6.00"), Decimal("5.00"))}
+    assert len(packaging) == 12
+    # sqlite falls back to bulk_create
+    assert pies_data_storage.bulk_loader.engine == "bulk_create"
+    assert {table: table_stats['rows'] for table, table_stats in pies_data_storage.bulk_loader.stats.items()} == {
+        ProductAttribute._meta.db_table: 24, ProductDigitalAsset._meta.db_table: 36, ProductPackaging._meta.db_table: 12
+    }
+
+
+@pytest.mark.django_db
+def test_store_aces_fitment():
+    store_pies(12)
+    aces_rows = get_aces_rows(15)
+    aces_data_storage = store_aces(aces_rows)
+    # parts without a product are not stored
+    assert not ProductFitment.objects.filter(product__part_number__gte="TB0000012").exists()
+    fitment = get_fitment()
+    vehicle_years = set(VehicleYear.objects.values_list("vehicle_id", "year"))
+    assert aces_data_storage.bulk_loader.stats[ProductFitment._meta.db_table]['rows'] == len(fitment)
+    # storing the same file again stores nothing new and keeps the years
+    store_aces(aces_rows)
+    assert get_fitment() == fitment
+    assert set(VehicleYear.objects.values_list("vehicle_id", "year")) == vehicle_years
+
+
+@pytest.mark.django_db
+def test_vehicle_dimensions_are_cached_for_the_import():
+    store_pies(70)
+    aces_data_storage = store_aces(get_aces_rows(70))
+    dimension_stats = aces_data_storage.dimension_cache.get_stats()
+    # every dimension is only missed once, later chunks find it in memory
+    assert dimension_stats['makes']['misses'] == VehicleMake.objects.count()
+    assert dimension_stats['vehicles']['misses'] == Vehicle.objects.count()
+    assert dimension_stats['vehicle_years']['misses'] == VehicleYear.objects.count()
+    assert all(dimension_stats[dimension]['hits'] > 0 for dimension in ('makes', 'models', 'engines', 'vehicles', 'vehicle_years'))
+    # a new import finds the stored dimensions in the database
+    fitment = get_fitment()
+    ProductFitment.objects.all().delete()
+    Product.objects.update(fitment_digest=None)
+    aces_data_storage = store_aces(get_aces_rows(70))
+    assert get_fitment() == fitment
+    assert aces_data_storage.dimension_cache.get_stats()['vehicles']['misses'] == Vehicle.objects.count()
+
+
+@pytest.mark.django_db
+def test_pies_chunk_queries_do_not_grow_with_products():
+    new_product_storage = store_pies(200)
+    existing_product_storage = store_pies(200)
+    # categories, product ids and asset types are loaded once, a chunk costs the same whatever its parts
+    assert len(set(new_product_storage.chunk_query_counts[1:])) == 1
+    assert max(new_product_storage.chunk_query_counts) < 30
+    assert len(set(existing_product_storage.chunk_query_counts)) == 1
+    assert Product.objects.count() == 200
+
+
+@pytest.mark.django_db
+def test_pies_storage_needs_categories():
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 5)
+    pies_file.seek(0)
+    with pytest.raises(RuntimeError):
+        PiesDataStorage(PiesFileParser(pies_file, "TB").get_brand_data()).store_brand_data()
+
+
+def test_product_fingerprint_is_stable():
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 3)
+    pies_file.seek(0)
+    product_data = list(PiesFileParser(pies_file, "TB").get_brand_data()['product_data'])
+    fingerprints = [get_product_fingerprint(product) for product in product_data]
+    assert len(set(fingerprints)) == 3
+    reordered_product = dict(reversed(list(product_data[0].items())))
+    assert get_product_fingerprint(reordered_product) == fingerprints[0]
+    product_data[0]['attributes'][0]['value'] = "Red"
+    assert get_product_fingerprint(product_data[0]) != fingerprints[0]
+
+
+@pytest.mark.django_db
+def test_unchanged_products_are_skipped():
+    assert store_pies(12).product_stats == {'unchanged': 0, 'updated': 0, 'created': 12}
+    assert store_pies(15).product_stats == {'unchanged': 12, 'updated': 0, 'created': 3}
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 15)
+    pies_file.seek(0)
+    brand_data = PiesFileParser(pies_file, "TB").get_brand_data()
+    product_data = list(brand_data['product_data'])
+    product_data[4]['name'] = "Renamed part"
+    brand_data['product_data'] = iter(product_data)
+    pies_data_storage = PiesDataStorage(brand_data)
+    pies_data_storage.store_brand_data()
+    assert pies_data_storage.product_stats == {'unchanged': 14, 'updated': 1, 'created': 0}
+    product_record = Product.objects.get(part_number="TB0000004")
+    assert product_record.name == "Renamed part"
+    assert product_record.fingerprint == product_data[4]['fingerprint']
+
+
+@pytest.mark.django_db
+def test_products_without_fingerprint_are_unchanged():
+    store_pies(12)
+    fingerprints = dict(Product.objects.values_list("part_number", "fingerprint"))
+    updated_on = dict(Product.objects.values_list("part_number", "updated_on"))
+    # as left by the migration that added fingerprints
+    Product.objects.update(fingerprint=None)
+    Product.objects.filter(part_number="TB0000004").update(name="Stored name")
+    pies_data_storage = store_pies(12)
+    assert pies_data_storage.product_stats == {'unchanged': 11, 'updated': 1, 'created': 0}
+    assert dict(Product.objects.values_list("part_number", "fingerprint")) == fingerprints
+    assert Product.objects.get(part_number="TB0000004").name != "Stored name"
+    assert {part_number for part_number, product_updated_on in Product.objects.values_list("part_number", "updated_on") if product_updated_on != updated_on[part_number]} == {"TB0000004"}
+    assert store_pies(12).product_stats == {'unchanged': 12, 'updated': 0, 'created': 0}
+
+
+@pytest.mark.django_db
+def test_unchanged_fitment_is_skipped_by_digest():
+    store_pies(12)
+    aces_rows = get_aces_rows(12)
+    aces_data_storage = store_aces(aces_rows)
+    assert get_part_stats(aces_data_storage) == {'unchanged_parts': 0, 'changed_parts': 12}
+    fitment = get_fitment()
+    assert Product.objects.filter(fitment_digest__isnull=True).count() == 0
+    aces_data_storage = store_aces(aces_rows)
+    assert get_part_stats(aces_data_storage) == {'unchanged_parts': 12, 'changed_parts': 0}
+    assert aces_data_storage.bulk_loader.stats == dict()
+    assert get_fitment() == fitment
+    # only the changed part is compared and stored again
+    changed_rows = [dict(aces_row, vqdescr="Changed Note") if aces_row['exppartno'] == "TB0000003" else aces_row for aces_row in aces_rows]
+    aces_data_storage = store_aces(changed_rows)
+    assert get_part_stats(aces_data_storage) == {'unchanged_parts': 11, 'changed_parts': 1}
+    assert set(ProductFitment.objects.filter(product__part_number="TB0000003").values_list("fitment_info_1", flat=True)) == {"Changed Note"}
+    assert {fitment_row for fitment_row in get_fitment() if fitment_row[0] != "TB0000003"} == {fitment_row for fitment_row in fitment if fitment_row[0] != "TB0000003"}
+
+
+@pytest.mark.django_db
+def test_set_fitment_diff_matches_python_diff():
+    store_pies(20)
+    aces_rows = get_aces_rows(20)
+    changed_rows = get_aces_rows(20, seed=1)
+    store_aces(aces_rows)
+    store_aces(changed_rows)
+    python_fitment = get_fitment()
+    ProductFitment.objects.all().delete()
+    Product.objects.update(fitment_digest=None)
+    store_aces(aces_rows, fitment_diff="set")
+    aces_data_storage = store_aces(changed_rows, fitment_diff="set")
+    assert get_fitment() == python_fitment
+    fitment_stats = aces_data_storage.fitment_stats
+    assert fitment_stats['inserted'] > 0 and fitment_stats['deleted'] > 0
+    assert ProductFitment.objects.count() == len(python_fitment)
+
+
+@pytest.mark.django_db
+def test_digital_asset_url_is_stored_once_across_types():
+    store_pies(3)
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 3)
+    pies_file.seek(0)
+    brand_data = PiesFileParser(pies_file, "TB").get_brand_data()
+    product_data = list(brand_data['product_data'])
+    stored_url = product_data[0]['digital_assets'][0]['url']
+    new_url = "http://fake.docs.com/shared.pdf"
+    # an image url stored before listed as an install sheet, and a new url listed as an image and an install sheet in one chunk
+    product_data[1]['digital_assets'][2]['url'] = stored_url
+    product_data[1]['digital_assets'][1]['url'] = new_url
+    product_data[2]['digital_assets'][2]['url'] = new_url
+    product_assets = sorted((digital_asset['display_sequence'], digital_asset['url']) for digital_asset in product_data[1]['digital_assets'])
+    brand_data['product_data'] = iter(product_data)
+    PiesDataStorage(brand_data).store_brand_data()
+    assert DigitalAsset.objects.filter(url__in=(stored_url, new_url)).count() == 2
+    product_record = Product.objects.get(part_number=product_data[1]['part_number'])
+    assert sorted(product_record.digital_assets.values_list("display_sequence", "digital_asset__url")) == product_assets
+    assert Product.objects.get(part_number=product_data[2]['part_number']).digital_assets.filter(digital_asset__url=new_url).count() == 1
+
+
+@pytest.mark.django_db
+def test_changed_relations_are_applied_row_by_row():
+    store_pies(120)
+    kept_attribute_ids = set(ProductAttribute.objects.filter(attribute__name="Material").values_list("id", flat=True))
+    kept_asset_ids = set(ProductDigitalAsset.objects.filter(display_sequence=0).values_list("id", flat=True))
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 120)
+    pies_file.seek(0)
+    brand_data = PiesFileParser(pies_file, "TB").get_brand_data()
+    product_data = list(brand_data['product_data'])
+    # every chunk of 50 has a different number of changed products
+    changed_products = product_data[:50] + product_data[50:55] + product_data[100:120]
+    for product in changed_products:
+        # a finish of another product in the same category, so no new attribute values are created
+        product['attributes'][0]['value'] = f"Black {int(product['part_number'][2:]) % 3}"
+        product['features'].append("Third feature")
+        product['digital_assets'] = [digital_asset for digital_asset in product['digital_assets'] if digital_asset['display_sequence'] != 2]
+        product['packages'][0]['height'] = Decimal("9.50")
+    brand_data['product_data'] = iter(product_data)
+    pies_data_storage = PiesDataStorage(brand_data)
+    pies_data_storage.store_brand_data()
+    assert pies_data_storage.product_stats == {'unchanged': 45, 'updated': 75, 'created': 0}
+    # applying the changes of a chunk costs the same whatever the number of products in it
+    assert len(pies_data_storage.relation_query_counts) == 3
+    assert len(set(pies_data_storage.relation_query_counts)) == 1
+    # rows that did not change are kept
+    assert set(ProductAttribute.objects.filter(attribute__name="Material").values_list("id", flat=True)) == kept_attribute_ids
+    assert set(ProductDigitalAsset.objects.filter(display_sequence=0).values_list("id", flat=True)) == kept_asset_ids
+    changed_part_numbers = {product['part_number'] for product in changed_products}
+    for product_record in Product.objects.prefetch_related("attributes__value", "features", "digital_assets", "packages"):
+        is_changed = product_record.part_number in changed_part_numbers
+        part_idx = int(product_record.part_number[2:])
+        assert {product_attribute.value.value for product_attribute in product_record.attributes.all()} == {f"Black {part_idx % 3 if is_changed else part_idx}", "Steel"}
+        assert [feature.name for feature in product_record.features.all()][2:] == (["Third feature"] if is_changed else [])
+        assert len(product_record.digital_assets.all()) == (2 if is_changed else 3)
+        assert (product_record.packages.all()[0].height == Decimal("9.50")) == is_changed
+        assert len(product_record.packages.all()) == 1
+    # attributes still in use are kept
+    assert Attribute.objects.count() == 6
+
+
+@pytest.mark.django_db
+def test_changed_products_are_updated_in_one_statement():
+    store_pies(120)
+    updated_on = dict(Product.objects.values_list("part_number", "updated_on"))
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 120)
+    pies_file.seek(0)
+    brand_data = PiesFileParser(pies_file, "TB").get_brand_data()
+    product_data = list(brand_data['product_data'])
+    # the whole catalog changes price, a few parts are renamed as well
+    for product in product_data:
+        product['retail_price'] += 1
+    product_data[3]['name'] = "Renamed part"
+    brand_data['product_data'] = iter(product_data)
+    pies_data_storage = PiesDataStorage(brand_data)
+    with CaptureQueriesContext(connection) as captured_queries:
+        pies_data_storage.store_brand_data()
+    product_updates = [query['sql'] for query in captured_queries.captured_queries if query['sql'].startswith(f'UPDATE "{Product._meta.db_table}"')]
+    assert len(product_updates) == 3
+    assert all('"retail_price"' in sql and '"updated_on"' in sql and '"map_price"' not in sql for sql in product_updates)
+    assert ['"name"' in sql for sql in product_updates] == [True, False, False]
+    assert len(set(pies_data_storage.chunk_query_counts[1:])) == 1
+    for product_record in Product.objects.all():
+        assert product_record.retail_price == product_data[int(product_record.part_number[2:])]['retail_price']
+        assert product_record.updated_on > updated_on[product_record.part_number]
+    assert Product.objects.get(part_number="TB0000003").name == "Renamed part"
+
+
+@pytest.mark.django_db
+def test_pipelined_storage_matches_lockstep_storage():
+    pies_data_storage = store_pies(120, pipeline_queue_size=2)
+    assert pies_data_storage.product_stats['created'] == 120
+    assert len(pies_data_storage.chunk_query_counts) == 3
+    aces_rows = get_aces_rows(120)
+    store_aces(aces_rows)
+    fitment = get_fitment()
+    ProductFitment.objects.all().delete()
+    Product.objects.update(fitment_digest=None)
+    aces_data_storage = store_aces(aces_rows, pipeline_queue_size=2)
+    assert get_fitment() == fitment
+    assert aces_data_storage.fitment_stats['changed_parts'] == 120
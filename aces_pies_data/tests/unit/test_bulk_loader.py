@@ -0,0 +1,73 @@
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+
+from aces_pies_data.models import Brand, Category, Product, ProductFitment, Vehicle, VehicleMake, VehicleModel, VehicleYear
+from aces_pies_data.util.bulk_loader import BulkLoader, format_copy_rows
+
+postgresql = pytest.mark.skipif(connection.vendor != "postgresql", reason="needs a PostgreSQL server, set test_db_host")
+
+
+def load_fitment_with_nulls(bulk_loader):
+    brand_record = Brand.objects.create(name="Test Brand", short_name="TB")
+    product_record = Product.objects.create(part_number="TB1", name="Brake Pad", brand=brand_record, category=Category.objects.create(name="Brake Pad"))
+    make_record = VehicleMake.objects.create(name="Ford")
+    vehicle_record = Vehicle.objects.create(make=make_record, model=VehicleModel.objects.create(name="Mustang", make=make_record))
+    fitment_fields = ('product_id', 'vehicle_id', 'start_year', 'end_year', 'fitment_info_1', 'fitment_info_2')
+    rows = [(product_record.id, vehicle_record.id, 2009, 2011, None, None), (product_record.id, vehicle_record.id, 2009, 2011, "Manual", None)]
+    assert bulk_loader.load(ProductFitment, fitment_fields, rows + rows) == 2
+    # a unique constraint does not match NULLs, the stored rows are found anyway
+    assert bulk_loader.load(ProductFitment, fitment_fields, rows + [(product_record.id, vehicle_record.id, 2012, 2014, None, None)]) == 1
+    assert ProductFitment.objects.count() == 3
+
+
+def test_copy_rows_are_escaped():
+    copy_file = format_copy_rows([(1, None, Decimal("2.50"), "Tab\there"), (2, "Back\\slash", "Line\r\nbreak", "")])
+    assert copy_file.read() == "1\t\\N\t2.50\tTab\\there\n2\tBack\\\\slash\tLine\\r\\nbreak\t\n"
+
+
+@pytest.mark.django_db
+def test_load_skips_conflicting_rows():
+    make_record = VehicleMake.objects.create(name="Ford")
+    vehicle_record = Vehicle.objects.create(make=make_record, model=VehicleModel.objects.create(name="Mustang", make=make_record))
+    VehicleYear.objects.create(vehicle=vehicle_record, year=2010)
+    bulk_loader = BulkLoader()
+    bulk_loader.load(VehicleYear, ('vehicle_id', 'year'), [(vehicle_record.id, year) for year in (2009, 2010, 2011, 2011)])
+    assert sorted(VehicleYear.objects.values_list("year", flat=True)) == [2009, 2010, 2011]
+    assert bulk_loader.stats[VehicleYear._meta.db_table]['inserted'] == 2
+    assert all(VehicleYear.objects.values_list("created_on", flat=True))
+    assert bulk_loader.load(VehicleYear, ('vehicle_id', 'year'), []) == 0
+    assert bulk_loader.stats[VehicleYear._meta.db_table]['rows'] == 4
+
+
+@pytest.mark.django_db
+def test_sync_replaces_rows_in_scope():
+    make_record = VehicleMake.objects.create(name="Ford")
+    vehicle_records = [Vehicle.objects.create(make=make_record, model=VehicleModel.objects.create(name=name, make=make_record)) for name in ("Mustang", "Focus", "Fiesta")]
+    for vehicle_record in vehicle_records:
+        VehicleYear.objects.bulk_create([VehicleYear(vehicle=vehicle_record, year=year) for year in (2009, 2010)])
+    bulk_loader = BulkLoader()
+    first_id, second_id, third_id = [vehicle_record.id for vehicle_record in vehicle_records]
+    # the third vehicle is out of scope, the second loses all its years
+    synced = bulk_loader.sync(VehicleYear, ('vehicle_id', 'year'), [(first_id, 2010), (first_id, 2011)], 'vehicle_id', [first_id, second_id])
+    assert synced == (1, 3)
+    assert set(VehicleYear.objects.values_list("vehicle_id", "year")) == {(first_id, 2010), (first_id, 2011), (third_id, 2009), (third_id, 2010)}
+    assert bulk_loader.sync(VehicleYear, ('vehicle_id', 'year'), [], 'vehicle_id', []) == (0, 0)
+    assert bulk_loader.stats[VehicleYear._meta.db_table]['deleted'] == 3
+
+
+@pytest.mark.django_db
+def test_load_skips_stored_rows_with_nulls():
+    bulk_loader = BulkLoader("bulk_create")
+    load_fitment_with_nulls(bulk_loader)
+    assert bulk_loader.stats[ProductFitment._meta.db_table] == {'rows': 7, 'inserted': 3, 'deleted': 0, 'seconds': bulk_loader.stats[ProductFitment._meta.db_table]['seconds']}
+
+
+@postgresql
+@pytest.mark.postgresql
+@pytest.mark.django_db
+def test_copy_skips_stored_rows_with_nulls():
+    bulk_loader = BulkLoader("copy")
+    assert bulk_loader.engine == "copy"
+    load_fitment_with_nulls(bulk_loader)
@@ -0,0 +1,40 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from aces_pies_data.models import VehicleMake, VehicleModel
+from aces_pies_data.util.data_retriever import UpsertDataRetriever
+
+
+@pytest.mark.django_db
+def test_upsert_retriever_gets_and_creates():
+    ford_record = VehicleMake.objects.create(name="Ford")
+    make_records = UpsertDataRetriever(VehicleMake, VehicleMake.objects.all(), ('name',)).bulk_get_or_create({
+        "Ford": {'name': "Ford"}, "Dodge": {'name': "Dodge"}, "Dodge again": {'name': "Dodge"}
+    })
+    assert make_records["Ford"] == ford_record.id
+    assert make_records["Dodge"] == make_records["Dodge again"] == VehicleMake.objects.get(name="Dodge").id
+    assert VehicleMake.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_upsert_retriever_keys_do_not_collide():
+    make_records = UpsertDataRetriever(VehicleMake, VehicleMake.objects.all(), ('name',)).bulk_get_or_create({"Ab": {'name': "Ab"}, "A": {'name': "A"}})
+    model_records = UpsertDataRetriever(VehicleModel, VehicleModel.objects.all(), ('make_id', 'name')).bulk_get_or_create({
+        ("Ab", "C"): {'name': "C", 'make_id': make_records["Ab"]}, ("A", "bC"): {'name': "bC", 'make_id': make_records["A"]}
+    })
+    assert len(set(model_records.values())) == 2
+    assert set(VehicleModel.objects.values_list("make__name", "name")) == {("Ab", "C"), ("A", "bC")}
+
+
+@pytest.mark.django_db
+def test_upsert_retriever_does_not_query_existing_records_again():
+    VehicleMake.objects.bulk_create([VehicleMake(name=f"Make {idx}") for idx in range(20)])
+    make_configs = {f"Make {idx}": {'name': f"Make {idx}"} for idx in range(30)}
+    make_retriever = UpsertDataRetriever(VehicleMake, VehicleMake.objects.all(), ('name',))
+    with CaptureQueriesContext(connection) as queries:
+        make_records = make_retriever.bulk_get_or_create(make_configs)
+    assert make_records == dict(VehicleMake.objects.values_list("name", "id"))
+    # the existing records, the insert, and on sqlite the ids of only the 10 inserted keys
+    assert len(queries) <= 3
+    assert "Make 0" not in queries[-1]['sql']
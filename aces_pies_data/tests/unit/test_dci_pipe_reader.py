@@ -0,0 +1,82 @@
+import io
+from decimal import Decimal
+
+import pytest
+
+from aces_pies_data.models import ProductCategoryLookup
+from aces_pies_data.tests.factories import get_aces_rows, write_aces_flat_file
+from aces_pies_data.util.aces_pies_storage import PiesCategoryDataStorage
+from aces_pies_data.util.dci_pipe_reader import DciPipeReader, decimal_or_raw, int_or_raw
+
+
+@pytest.fixture
+def aces_rows():
+    return get_aces_rows(20)
+
+
+@pytest.fixture
+def aces_file(aces_rows):
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, aces_rows)
+    aces_file.seek(0)
+    return aces_file
+
+
+def test_reader_returns_requested_columns(aces_rows, aces_file):
+    values = list(DciPipeReader(aces_file, ('year', 'exppartno')))
+    assert values == [(aces_row['year'], aces_row['exppartno']) for aces_row in aces_rows]
+    # the caller still owns the file
+    assert not aces_file.closed
+
+
+def test_reader_reads_decoded_lines(aces_rows, aces_file):
+    aces_lines = [line.decode("utf-8") for line in aces_file]
+    assert list(DciPipeReader(aces_lines, ('make',))) == [(aces_row['make'],) for aces_row in aces_rows]
+
+
+def test_reader_caches_conversions(aces_rows, aces_file):
+    values = list(DciPipeReader(aces_file, ('exppartno', 'year', 'liter'), {'year': int_or_raw, 'liter': decimal_or_raw}))
+    assert [year for part_number, year, liters in values] == [int(aces_row['year']) if aces_row['year'] != 'ALL' else 'ALL' for aces_row in aces_rows]
+    assert [liters for part_number, year, liters in values] == [Decimal(aces_row['liter']) if aces_row['liter'] else '' for aces_row in aces_rows]
+    converted_liters = [liters for part_number, year, liters in values if liters == Decimal('5.0')]
+    assert len(converted_liters) > 1
+    assert all(liters is converted_liters[0] for liters in converted_liters)
+
+
+def test_reader_rejects_unknown_columns(aces_file):
+    with pytest.raises(ValueError):
+        list(DciPipeReader(aces_file, ('exppartno', 'not_a_column')))
+    with pytest.raises(ValueError):
+        DciPipeReader(aces_file, ('exppartno',), {'year': int_or_raw})
+
+
+@pytest.mark.parametrize("converters", [None, {'year': int_or_raw}])
+@pytest.mark.parametrize("columns", [('exppartno', 'year'), ('year',)])
+def test_reader_skips_blank_lines(aces_rows, aces_file, converters, columns):
+    aces_lines = aces_file.getvalue().split(b"\r\n")
+    # blank lines in the middle and at the end of the file
+    aces_lines.insert(3, b"")
+    aces_lines.insert(7, b"  ")
+    blank_lines_file = io.BytesIO(b"\r\n".join(aces_lines) + b"\r\n\r\n")
+    values = list(DciPipeReader(blank_lines_file, columns, {column: converter for column, converter in (converters or dict()).items() if column in columns}))
+    assert len(values) == len(aces_rows)
+    assert [value[-1] for value in values] == [int_or_raw(aces_row['year']) if converters else aces_row['year'] for aces_row in aces_rows]
+
+
+def test_reader_reports_short_rows():
+    dci_file = io.BytesIO(b"exppartno|year|make\r\nTB0000001|2018|Ford\r\nTB0000002\r\n")
+    with pytest.raises(ValueError, match="Line 3 has 1 columns, the header has 3"):
+        list(DciPipeReader(dci_file, ('exppartno', 'make')))
+
+
+@pytest.mark.django_db
+def test_category_storage_reads_pies_flat_file():
+    pies_flat_file = io.BytesIO(
+        b"PartNumber|BrandAAIAID|partterminologyname\r\n"
+        b"TB0000001|TEST|Brake Pad\r\n"
+        b"TB0000002|TEST|Brake Rotor\r\n"
+        b"TB0000003|TEST|Brake Pad\r\n"
+    )
+    PiesCategoryDataStorage(pies_flat_file, "TB").store_category_data()
+    category_lookup = ProductCategoryLookup.objects.filter(brand_short_name="TB").values_list("part_number", "category__name")
+    assert sorted(category_lookup) == [("TB0000001", "Brake Pad"), ("TB0000002", "Brake Rotor"), ("TB0000003", "Brake Pad")]
@@ -0,0 +1,196 @@
+import io
+import re
+import threading
+import time
+import zipfile
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build
+
+from aces_pies_data.management import drive_prefetcher as drive_prefetcher_module, import_utils
+from aces_pies_data.management.commands import import_aces_pies
+from aces_pies_data.management.commands.import_aces_pies import Command
+from aces_pies_data.management.drive_prefetcher import DrivePrefetcher
+from aces_pies_data.management.import_utils import open_zip
+
+
+class LocalDriveHttp(object):
+    """
+    Stands in for the http object of a drive service, serving files.get_media range requests from a dict of file id to content
+    """
+    def __init__(self, files, seconds_per_request=0.0, failing_file_id=None):
+        self.files = files
+        self.seconds_per_request = seconds_per_request
+        self.failing_file_id = failing_file_id
+        self.requests = list()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=None, connection_type=None):
+        file_id = re.search(r"/files/([^?/]+)\?", uri).group(1)
+        self.requests.append((file_id, threading.current_thread()))
+        time.sleep(self.seconds_per_request)
+        if file_id == self.failing_file_id:
+            return httplib2.Response({'status': 404}), b'{"error": {"message": "File not found"}}'
+        content = self.files[file_id]
+        start, end = [int(position) for position in re.match(r"bytes=(\d+)-(\d+)", headers['range']).groups()]
+        chunk = content[start:end + 1]
+        return httplib2.Response({'status': 206, 'content-range': f"bytes {start}-{start + len(chunk) - 1}/{len(content)}"}), chunk
+
+
+class LocalDrive(object):
+    def __init__(self, files, **http_kwargs):
+        self.files = files
+        self.http_kwargs = http_kwargs
+        self.https = list()
+
+    def get_drive_service(self):
+        http = LocalDriveHttp(self.files, **self.http_kwargs)
+        self.https.append(http)
+        return build('drive', 'v3', http=http, static_discovery=True)
+
+    def get_requested_files(self):
+        return [file_id for http in self.https for file_id, thread in http.requests]
+
+
+def get_file_infos(files):
+    return [{'file': {'id': file_id, 'name': f"{file_id}.zip", 'size': str(len(content))}} for file_id, content in files.items()]
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(drive_prefetcher_module, "download_chunk_size", 1000)
+
+
+FILES = {f"file{idx}": bytes([idx]) * 2500 for idx in range(4)}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_files_are_downloaded_ahead_in_order(tmp_path):
+    local_drive = LocalDrive(FILES)
+    file_infos = get_file_infos(FILES)
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=1, temp_dir=str(tmp_path)) as drive_prefetcher:
+        with drive_prefetcher.get_file(file_infos[0]) as zip_bytes:
+            # the next file downloads while this one is imported, the one after waits
+            assert wait_for(lambda: drive_prefetcher.downloads[1] is not None and drive_prefetcher.downloads[1].done)
+            time.sleep(0.05)
+            assert drive_prefetcher.downloads[2] is None
+            assert zip_bytes.read() == FILES["file0"]
+        for file_info in file_infos[1:]:
+            with drive_prefetcher.get_file(file_info) as zip_bytes:
+                assert zip_bytes.read() == FILES[file_info['file']['id']]
+    # 3 range requests per file, all from the background thread
+    assert local_drive.get_requested_files() == [file_id for file_id in FILES for _ in range(3)]
+    assert {thread for http in local_drive.https for file_id, thread in http.requests} != {threading.current_thread()}
+    assert drive_prefetcher.stats['files'] == 4
+    assert drive_prefetcher.stats['bytes'] == 10000
+
+
+def test_download_time_overlaps_import_time(tmp_path):
+    local_drive = LocalDrive(FILES, seconds_per_request=0.05)
+    file_infos = get_file_infos(FILES)
+    start = time.time()
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=1, temp_dir=str(tmp_path)) as drive_prefetcher:
+        for file_info in file_infos:
+            with drive_prefetcher.get_file(file_info):
+                time.sleep(0.15)
+    # sequential would be 4 * (0.15 download + 0.15 import)
+    assert time.time() - start < 1.0
+    assert drive_prefetcher.stats['wait_seconds'] < 0.4
+
+
+def test_disk_budget_limits_files_held(tmp_path):
+    local_drive = LocalDrive(FILES)
+    file_infos = get_file_infos(FILES)
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=3, disk_budget_bytes=6000, temp_dir=str(tmp_path)) as drive_prefetcher:
+        with drive_prefetcher.get_file(file_infos[0]):
+            # the file being imported does not count, 2 more fit in the budget
+            assert wait_for(lambda: all(download is not None and download.done for download in drive_prefetcher.downloads[1:3]))
+            time.sleep(0.05)
+            assert drive_prefetcher.downloads[3] is None
+            assert drive_prefetcher.held_bytes == 5000
+        with drive_prefetcher.get_file(file_infos[1]):
+            assert wait_for(lambda: drive_prefetcher.downloads[3] is not None)
+
+
+def test_released_files_are_discarded(tmp_path):
+    local_drive = LocalDrive(FILES)
+    file_infos = get_file_infos(FILES)
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=1, temp_dir=str(tmp_path)) as drive_prefetcher:
+        drive_prefetcher.release(file_infos[0])
+        # skipping straight to the last file passes over the ones in between
+        with drive_prefetcher.get_file(file_infos[3]) as zip_bytes:
+            assert zip_bytes.read() == FILES["file3"]
+        assert drive_prefetcher.held_bytes == 0
+    assert "file2" not in local_drive.get_requested_files()
+    assert all(download.file is None or download.file.closed for download in drive_prefetcher.downloads if download)
+
+
+def test_download_errors_are_raised_on_get(tmp_path):
+    local_drive = LocalDrive(FILES, failing_file_id="file1")
+    file_infos = get_file_infos(FILES)
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=1, temp_dir=str(tmp_path)) as drive_prefetcher:
+        drive_prefetcher.get_file(file_infos[0]).close()
+        with pytest.raises(Exception, match="File not found"):
+            drive_prefetcher.get_file(file_infos[1])
+
+
+def test_without_prefetching_files_download_on_get(tmp_path):
+    local_drive = LocalDrive(FILES)
+    file_infos = get_file_infos(FILES)
+    with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=0, temp_dir=str(tmp_path)) as drive_prefetcher:
+        assert local_drive.get_requested_files() == []
+        drive_prefetcher.release(file_infos[0])
+        with drive_prefetcher.get_file(file_infos[1]) as zip_bytes:
+            assert zip_bytes.read() == FILES["file1"]
+    assert {thread for file_id, thread in local_drive.https[0].requests} == {threading.current_thread()}
+    assert local_drive.get_requested_files() == ["file1"] * 3
+
+
+def test_files_past_the_spool_size_are_memory_mapped(tmp_path):
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, 'w') as zip_file:
+        zip_file.writestr("AAA_n1parts.txt", FILES["file0"])
+    zip_files = {"file0": zip_bytes.getvalue()}
+    local_drive = LocalDrive(zip_files)
+    file_infos = get_file_infos(zip_files)
+    for spool_max_bytes, on_disk in ((len(zip_files["file0"]), False), (len(zip_files["file0"]) - 1, True)):
+        with DrivePrefetcher(local_drive.get_drive_service, file_infos, prefetch_files=1, temp_dir=str(tmp_path), spool_max_bytes=spool_max_bytes) as drive_prefetcher:
+            with drive_prefetcher.get_file(file_infos[0]) as zip_bytes:
+                assert drive_prefetcher.is_on_disk(file_infos[0]) is on_disk
+                with open_zip(zip_bytes, drive_prefetcher.is_on_disk(file_infos[0])) as zip_file:
+                    assert isinstance(zip_file.fp, import_utils._ZipMemoryMap) is on_disk
+                    assert zip_file.read("AAA_n1parts.txt") == FILES["file0"]
+
+
+def test_brands_imported_in_process_share_one_prefetcher(monkeypatch, settings, tmp_path):
+    settings.IMPORT_BRAND_PROCESSES = 1
+    settings.DRIVE_PREFETCH_FILES = 1
+    settings.DRIVE_DOWNLOAD_TEMP_DIR = str(tmp_path)
+    settings.ORPHAN_GC_BATCH_SIZE = 0
+    local_drive = LocalDrive(FILES)
+    file_infos = get_file_infos(FILES)
+    for file_info, brand_short_name, import_type in zip(file_infos, ("AB", "AB", "CD", "CD"), ("pies_flat", "pies", "pies_flat", "pies")):
+        file_info.update(brand_short_name=brand_short_name, import_type=import_type)
+    monkeypatch.setattr(import_aces_pies, "get_drive_service", local_drive.get_drive_service)
+    monkeypatch.setattr(Command, "get_files_to_process", lambda self, drive_service: {
+        'files_to_parse': file_infos, 'files_to_archive': list(), 'pending_folder_id': "pending", 'archived_folder_id': "archived"
+    })
+    imports = list()
+
+    def import_file(self, drive_service, drive_prefetcher, file_info, pending_folder_id, archived_folder_id):
+        with drive_prefetcher.get_file(file_info) as zip_bytes:
+            # the first file of the next brand downloads while the last file of this one is imported
+            next_downloaded = wait_for(lambda: drive_prefetcher.downloads[2] is not None and drive_prefetcher.downloads[2].done) if file_info is file_infos[1] else None
+            imports.append((drive_prefetcher, zip_bytes.read(), next_downloaded))
+        return True
+    monkeypatch.setattr(Command, "import_file", import_file)
+    Command().do_import()
+    assert len({drive_prefetcher for drive_prefetcher, content, next_downloaded in imports}) == 1
+    assert [content for drive_prefetcher, content, next_downloaded in imports] == list(FILES.values())
+    assert imports[1][2] is True
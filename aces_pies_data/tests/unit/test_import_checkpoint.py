@@ -0,0 +1,198 @@
+import io
+import os
+import zipfile
+
+import pytest
+from django.db import OperationalError
+
+from aces_pies_data.management.commands.import_aces_pies import Command
+from aces_pies_data.models import ImportTracking, ImportTrackingType, Product, ProductFitment
+from aces_pies_data.tests.factories import get_aces_rows, write_aces_flat_file, write_pies_flat_file, write_pies_xml
+from aces_pies_data.util.aces_pies_parsing import AcesFileParser, PiesFileParser
+from aces_pies_data.util.aces_pies_storage import AcesDataStorage, PiesCategoryDataStorage, PiesDataStorage
+from aces_pies_data.util.import_checkpoint import CheckpointMismatch, ImportCheckpoint
+
+
+def create_import(import_type, content_hash="abc", end_date=None, chunks_committed=0, last_part_number=None):
+    tracking_type = ImportTrackingType.objects.get_or_create(name=import_type)[0]
+    return ImportTracking.objects.create(brand_short_name="TB", tracking_type=tracking_type, file_name=f"TB_{import_type}.zip", content_hash=content_hash, end_date=end_date,
+                                         chunks_committed=chunks_committed, last_part_number=last_part_number)
+
+
+def get_pies_brand_data(num_items):
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, num_items)
+    pies_file.seek(0)
+    return PiesFileParser(pies_file, "TB").get_brand_data()
+
+
+def get_aces_file_parser(aces_rows):
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, aces_rows)
+    aces_file.seek(0)
+    return AcesFileParser(aces_file, "TB")
+
+
+def store_categories(num_items):
+    pies_flat_file = io.BytesIO()
+    write_pies_flat_file(pies_flat_file, num_items)
+    pies_flat_file.seek(0)
+    PiesCategoryDataStorage(pies_flat_file, "TB").store_category_data()
+
+
+def fail_on_call(monkeypatch, cls, method_name, failing_call, error=OperationalError("server closed the connection unexpectedly")):
+    method = getattr(cls, method_name)
+    calls = list()
+
+    def failing_method(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == failing_call:
+            raise error
+        return method(self, *args, **kwargs)
+    monkeypatch.setattr(cls, method_name, failing_method)
+
+
+def count_calls(method, calls):
+    def counted_method(self, *args, **kwargs):
+        calls.append(1)
+        return method(self, *args, **kwargs)
+    return counted_method
+
+
+@pytest.mark.django_db
+def test_committed_chunks_are_skipped():
+    tracking_record = create_import("pies")
+    checkpoint = ImportCheckpoint(tracking_record.id)
+    assert list(checkpoint.skip_committed(iter([["TB1"], ["TB2"]]), lambda chunk: chunk[-1])) == [["TB1"], ["TB2"]]
+    checkpoint.commit("TB1")
+    checkpoint.commit("TB2")
+    assert ImportTracking.objects.values_list("chunks_committed", "last_part_number").get(id=tracking_record.id) == (2, "TB2")
+    chunks = [["TB0", "TB1"], ["TB2"], ["TB3"]]
+    checkpoint = ImportCheckpoint(tracking_record.id)
+    assert list(checkpoint.skip_committed(chunks, lambda chunk: chunk[-1])) == [["TB3"]]
+    assert checkpoint.chunks_skipped == 2
+    # the file split differently when the checkpoint was recorded
+    with pytest.raises(CheckpointMismatch):
+        list(ImportCheckpoint(tracking_record.id).skip_committed([["TB1"], ["TB3"], ["TB4"]], lambda chunk: chunk[-1]))
+    checkpoint.reset()
+    assert list(ImportCheckpoint(tracking_record.id).skip_committed(chunks, lambda chunk: chunk[-1])) == chunks
+
+
+@pytest.mark.django_db
+def test_resume_from_failed_import_of_same_content():
+    failed_import = create_import("aces", chunks_committed=3, last_part_number="TB0000089")
+    tracking_record = create_import("aces")
+    checkpoint = ImportCheckpoint.resume(tracking_record)
+    assert (checkpoint.resume_chunks, checkpoint.resume_part_number) == (3, "TB0000089")
+    assert ImportTracking.objects.get_resumable_import("TB", "aces", "def") is None
+    # the products the committed fitment was stored against have been replaced
+    create_import("pies", end_date="2018-01-01T00:00:00Z")
+    assert ImportTracking.objects.get_resumable_import("TB", "aces", "abc", tracking_record.id) is None
+    failed_import.delete()
+    # a completed import of the same type supersedes older failures
+    create_import("pies", chunks_committed=1, last_part_number="TB0000049")
+    assert ImportTracking.objects.get_resumable_import("TB", "pies", "abc").chunks_committed == 1
+    create_import("pies", end_date="2018-01-01T00:00:00Z")
+    assert ImportTracking.objects.get_resumable_import("TB", "pies", "abc") is None
+
+
+@pytest.mark.django_db
+def test_pies_storage_resumes_after_committed_chunks(monkeypatch):
+    store_categories(120)
+    tracking_record = create_import("pies")
+    with monkeypatch.context() as failing_patch:
+        fail_on_call(failing_patch, PiesDataStorage, "_bulk_create_products", 2)
+        with pytest.raises(OperationalError):
+            PiesDataStorage(get_pies_brand_data(120), checkpoint=ImportCheckpoint(tracking_record.id)).store_brand_data()
+    # the failed chunk was rolled back with its checkpoint
+    assert Product.objects.count() == 50
+    assert ImportTracking.objects.values_list("chunks_committed", "last_part_number").get(id=tracking_record.id) == (1, "TB0000049")
+    checkpoint = ImportCheckpoint(tracking_record.id)
+    pies_data_storage = PiesDataStorage(get_pies_brand_data(120), checkpoint=checkpoint, pipeline_queue_size=2)
+    pies_data_storage.store_brand_data()
+    assert checkpoint.chunks_skipped == 1
+    assert pies_data_storage.product_stats == {'unchanged': 0, 'updated': 0, 'created': 70}
+    assert Product.objects.count() == 120
+    assert ImportTracking.objects.values_list("chunks_committed", "last_part_number").get(id=tracking_record.id) == (3, "TB0000119")
+
+
+@pytest.mark.django_db
+def test_aces_storage_resumes_after_committed_chunks(monkeypatch):
+    store_categories(100)
+    PiesDataStorage(get_pies_brand_data(100)).store_brand_data()
+    aces_rows = get_aces_rows(100)
+    AcesDataStorage(get_aces_file_parser(aces_rows)).store_brand_fitment()
+    fitment = set(ProductFitment.objects.values_list("product__part_number", "vehicle_id", "start_year", "end_year"))
+    ProductFitment.objects.all().delete()
+    Product.objects.update(fitment_digest=None)
+    tracking_record = create_import("aces")
+    with monkeypatch.context() as failing_patch:
+        fail_on_call(failing_patch, AcesDataStorage, "_store_fitment", 3)
+        with pytest.raises(OperationalError):
+            AcesDataStorage(get_aces_file_parser(aces_rows), fitment_diff="set", checkpoint=ImportCheckpoint(tracking_record.id)).store_brand_fitment()
+    assert ImportTracking.objects.values_list("chunks_committed", "last_part_number").get(id=tracking_record.id) == (2, "TB0000059")
+    assert ProductFitment.objects.values("product").distinct().count() == 60
+    checkpoint = ImportCheckpoint(tracking_record.id)
+    aces_data_storage = AcesDataStorage(get_aces_file_parser(aces_rows), fitment_diff="set", checkpoint=checkpoint)
+    aces_data_storage.store_brand_fitment()
+    assert checkpoint.chunks_skipped == 2
+    assert aces_data_storage.fitment_stats['changed_parts'] == 40
+    assert set(ProductFitment.objects.values_list("product__part_number", "vehicle_id", "start_year", "end_year")) == fitment
+
+
+@pytest.mark.django_db
+def test_store_data_file_retries_from_checkpoint(monkeypatch, settings):
+    settings.IMPORT_STORE_ATTEMPTS = 2
+    settings.IMPORT_STORE_RETRY_SECONDS = 0
+    settings.PARSED_DATA_CACHE_DIR = None
+    settings.IMPORT_PIPELINE_QUEUE_SIZE = 0
+    store_categories(120)
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, 'w') as zip_file:
+        with zip_file.open("TB_pies67.xml", 'w') as pies_file:
+            write_pies_xml(pies_file, 120)
+    tracking_record = create_import("pies")
+    completed = list()
+    stored_chunks = list()
+    monkeypatch.setattr(PiesDataStorage, "_store_chunk", count_calls(PiesDataStorage._store_chunk, stored_chunks))
+    fail_on_call(monkeypatch, PiesDataStorage, "_bulk_create_products", 3)
+    with zipfile.ZipFile(zip_bytes) as zip_file:
+        Command().store_data_file(zip_file, zip_file.filelist[0], tracking_record, lambda: completed.append(1))
+    # the retry only stores the chunk that failed
+    assert len(stored_chunks) == 4
+    assert completed == [1]
+    assert Product.objects.count() == 120
+    assert ImportTracking.objects.get(id=tracking_record.id).chunks_committed == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("error,cached", [(OperationalError("server closed the connection unexpectedly"), True), (ValueError("Bad product"), False)])
+def test_only_retried_errors_parse_the_rest_of_the_file(monkeypatch, settings, tmp_path, error, cached):
+    settings.PARSED_DATA_CACHE_DIR = str(tmp_path)
+    settings.IMPORT_PIPELINE_QUEUE_SIZE = 0
+    store_categories(120)
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 120)
+    pies_file.seek(0)
+    parsed_products = list()
+    get_brand_data = PiesFileParser.get_brand_data
+
+    def count_products(product_data):
+        for product in product_data:
+            parsed_products.append(1)
+            yield product
+
+    def get_counted_brand_data(self):
+        brand_data = get_brand_data(self)
+        brand_data['product_data'] = count_products(brand_data['product_data'])
+        return brand_data
+    monkeypatch.setattr(PiesFileParser, "get_brand_data", get_counted_brand_data)
+    fail_on_call(monkeypatch, PiesDataStorage, "_bulk_create_products", 1, error)
+    with pytest.raises(type(error)):
+        Command().import_data_file(pies_file, "TB", "pies", "abc", None)
+    if cached:
+        assert len(parsed_products) == 120
+        assert os.listdir(tmp_path) == ["TB_pies.parsed.gz"]
+    else:
+        assert len(parsed_products) == 50
+        assert os.listdir(tmp_path) == []
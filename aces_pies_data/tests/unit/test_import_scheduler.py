@@ -0,0 +1,74 @@
+import functools
+import os
+import time
+
+import pytest
+
+from aces_pies_data.management.import_scheduler import BrandImportLock, BrandImportScheduler, get_brand_chains
+
+
+def get_file_info(brand_short_name, import_type):
+    return {'brand_short_name': brand_short_name, 'import_type': import_type, 'file': {'name': f"{brand_short_name}_{import_type}.zip"}}
+
+
+def record_brand_import(log_dir, brand_short_name, file_infos, fail_brand=None, seconds=0.0):
+    """
+    Stands in for import_brand_files, writes the files it was given and its process id to log_dir
+    """
+    time.sleep(seconds)
+    if brand_short_name == fail_brand:
+        raise ValueError(f"Bad file for {brand_short_name}")
+    with open(os.path.join(log_dir, brand_short_name), 'w') as log_file:
+        log_file.write(f"{os.getpid()} {','.join(file_info['import_type'] for file_info in file_infos)}")
+    return len(file_infos)
+
+
+def read_brand_imports(log_dir):
+    brand_imports = dict()
+    for brand_short_name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, brand_short_name)) as log_file:
+            brand_imports[brand_short_name] = log_file.read().split(" ")
+    return brand_imports
+
+
+def test_brand_chains_are_in_import_order():
+    files_to_parse = [get_file_info("AB", "pies_flat"), get_file_info("CD", "pies"), get_file_info("AB", "aces"), get_file_info("AB", "pies"), get_file_info("CD", "aces")]
+    brand_chains = get_brand_chains(files_to_parse)
+    assert list(brand_chains.keys()) == ["AB", "CD"]
+    assert [file_info['import_type'] for file_info in brand_chains["AB"]] == ["pies_flat", "pies", "aces"]
+    assert [file_info['import_type'] for file_info in brand_chains["CD"]] == ["pies", "aces"]
+
+
+def test_brands_run_in_worker_processes(tmp_path):
+    brand_chains = get_brand_chains([get_file_info(brand_short_name, import_type) for import_type in ("aces", "pies") for brand_short_name in ("AB", "CD", "EF")])
+    scheduler = BrandImportScheduler(functools.partial(record_brand_import, str(tmp_path), seconds=0.5), processes=3)
+    start = time.time()
+    assert scheduler.run(brand_chains) == 6
+    # the brands overlap instead of running one after another
+    assert time.time() - start < 1.4
+    brand_imports = read_brand_imports(str(tmp_path))
+    assert {brand_import[1] for brand_import in brand_imports.values()} == {"pies,aces"}
+    assert str(os.getpid()) not in {brand_import[0] for brand_import in brand_imports.values()}
+
+
+def test_sequential_scheduler_runs_in_process(tmp_path):
+    brand_chains = get_brand_chains([get_file_info("AB", "pies"), get_file_info("CD", "pies")])
+    assert BrandImportScheduler(functools.partial(record_brand_import, str(tmp_path))).run(brand_chains) == 2
+    assert {brand_import[0] for brand_import in read_brand_imports(str(tmp_path)).values()} == {str(os.getpid())}
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_failed_brand_does_not_stop_the_others(tmp_path, processes):
+    brand_chains = get_brand_chains([get_file_info(brand_short_name, "pies") for brand_short_name in ("AB", "CD", "EF")])
+    scheduler = BrandImportScheduler(functools.partial(record_brand_import, str(tmp_path), fail_brand="AB"), processes=processes)
+    with pytest.raises(RuntimeError, match="AB") as exc_info:
+        scheduler.run(brand_chains)
+    assert isinstance(exc_info.value.__cause__, ValueError)
+    assert set(read_brand_imports(str(tmp_path)).keys()) == {"CD", "EF"}
+
+
+def test_brand_lock_without_advisory_locks():
+    with BrandImportLock("AB") as brand_lock:
+        assert brand_lock.acquired
+    assert not brand_lock.acquired
+    assert BrandImportLock("AB").lock_key == BrandImportLock("AB").lock_key != BrandImportLock("CD").lock_key
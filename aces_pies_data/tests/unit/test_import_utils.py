@@ -0,0 +1,87 @@
+import io
+import logging
+import tempfile
+import zipfile
+
+import pytest
+
+from aces_pies_data.management import import_utils
+from aces_pies_data.management.import_utils import get_file_obj_from_zip, get_zip_member_hash, open_zip, with_backoff
+
+MEMBER_DATA = b"PartNumber|Make|Model\n" * 5000
+
+
+def write_zip(file_obj):
+    with zipfile.ZipFile(file_obj, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("AAA_n1parts.txt", MEMBER_DATA)
+    file_obj.seek(0)
+    return file_obj
+
+
+def read_member(zip_file):
+    with zip_file.open(get_file_obj_from_zip(zip_file, "aces")) as data_file:
+        return data_file.read()
+
+
+def test_zip_on_disk_is_memory_mapped(tmp_path):
+    zip_path = tmp_path / "AAA20240101_N1.zip"
+    with open(zip_path, 'wb') as file:
+        write_zip(file)
+    with open(zip_path, 'rb') as file:
+        with open_zip(file) as zip_file:
+            assert isinstance(zip_file.fp, import_utils._ZipMemoryMap)
+            zip_map = zip_file.fp
+            assert read_member(zip_file) == MEMBER_DATA
+            assert get_zip_member_hash(zip_file, get_file_obj_from_zip(zip_file, "aces")) == get_zip_member_hash(zipfile.ZipFile(zip_path), "AAA_n1parts.txt")
+        assert zip_map.closed
+        assert not file.closed
+
+
+@pytest.mark.parametrize("max_size,memory_map", [(1024 * 1024, False), (100, True)])
+def test_spooled_zip_is_memory_mapped_once_on_disk(max_size, memory_map):
+    with tempfile.SpooledTemporaryFile(max_size=max_size) as spooled_file:
+        write_zip(spooled_file)
+        with open_zip(spooled_file, memory_map) as zip_file:
+            assert isinstance(zip_file.fp, import_utils._ZipMemoryMap) is memory_map
+            assert read_member(zip_file) == MEMBER_DATA
+
+
+def test_in_memory_zip_is_read_directly():
+    with open_zip(write_zip(io.BytesIO())) as zip_file:
+        assert read_member(zip_file) == MEMBER_DATA
+
+
+def test_empty_file_is_not_a_zip(tmp_path):
+    with tempfile.TemporaryFile(dir=str(tmp_path)) as empty_file:
+        with pytest.raises(zipfile.BadZipFile):
+            with open_zip(empty_file):
+                pass
+
+
+def test_backoff_doubles_until_the_operation_succeeds(monkeypatch):
+    delays = list()
+    monkeypatch.setattr(import_utils.time, "sleep", delays.append)
+    attempts = iter([ConnectionError(), ConnectionError(), ConnectionError(), "done"])
+
+    def operation():
+        attempt = next(attempts)
+        if isinstance(attempt, Exception):
+            raise attempt
+        return attempt
+    assert with_backoff(operation, logging.getLogger("test"), (ConnectionError,), base_seconds=2, max_seconds=5) == "done"
+    assert delays == [2, 4, 5]
+
+
+def test_backoff_gives_up(monkeypatch):
+    delays = list()
+    monkeypatch.setattr(import_utils.time, "sleep", delays.append)
+
+    def operation():
+        raise ConnectionError()
+    with pytest.raises(ConnectionError):
+        with_backoff(operation, logging.getLogger("test"), (ConnectionError,), max_attempts=3)
+    assert delays == [1.0, 2.0]
+    # other errors are not retried
+    with pytest.raises(ValueError):
+        with_backoff(lambda: int("x"), logging.getLogger("test"), (ConnectionError,))
+    assert delays == [1.0, 2.0]
@@ -0,0 +1,76 @@
+import io
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+
+from aces_pies_data.models import Attribute, AttributeValue, DigitalAsset, Product, ProductAttribute, ProductDigitalAsset, ProductFitment, Vehicle, VehicleEngine, VehicleYear
+from aces_pies_data.tests.factories import get_aces_rows
+from aces_pies_data.tests.unit.test_aces_pies_storage import store_aces, store_pies
+from aces_pies_data.util.orphan_collector import ImportInProgressLock, OrphanCollector
+
+
+def get_counts():
+    return {model_cls.__name__: model_cls.objects.count() for model_cls in (VehicleYear, Vehicle, VehicleEngine, AttributeValue, Attribute, DigitalAsset)}
+
+
+@pytest.mark.django_db
+def test_nothing_collected_after_import():
+    store_pies(12)
+    store_aces(get_aces_rows(12))
+    counts = get_counts()
+    assert set(OrphanCollector().collect().values()) == {0}
+    assert get_counts() == counts
+
+
+@pytest.mark.django_db
+def test_orphans_collected_in_batches():
+    store_pies(12)
+    store_aces(get_aces_rows(12))
+    # half the parts lose their fitment, attributes and assets
+    products = Product.objects.filter(part_number__lt="TB0000006")
+    ProductFitment.objects.filter(product__in=products).delete()
+    ProductAttribute.objects.filter(product__in=products, attribute__name="Color Finish").delete()
+    ProductDigitalAsset.objects.filter(product__in=products).delete()
+    fitment = list(ProductFitment.objects.values_list("vehicle_id", "start_year", "end_year"))
+    used_vehicle_years = {(vehicle_id, year) for vehicle_id, start_year, end_year in fitment for year in range(start_year, end_year + 1)}
+    counts = get_counts()
+    orphan_collector = OrphanCollector(batch_size=2)
+    reclaimed = orphan_collector.collect()
+    assert set(VehicleYear.objects.values_list("vehicle_id", "year")) == used_vehicle_years
+    assert set(Vehicle.objects.values_list("id", flat=True)) == {vehicle_id for vehicle_id, start_year, end_year in fitment}
+    assert not VehicleEngine.objects.exclude(vehicle__isnull=False).exists()
+    # values of the removed finishes go, attributes are still used by the other parts
+    assert reclaimed['AttributeValue'] == 6
+    assert reclaimed['Attribute'] == 0
+    # the brand logo is kept
+    assert not DigitalAsset.objects.filter(productdigitalasset__isnull=True, brand__isnull=True).exists()
+    assert reclaimed['DigitalAsset'] == 18
+    assert {model_name: counts[model_name] - count for model_name, count in get_counts().items()} == reclaimed
+    assert reclaimed['VehicleYear'] > 0
+
+
+@pytest.mark.django_db
+def test_collect_orphans_command():
+    store_pies(3)
+    ProductDigitalAsset.objects.all().delete()
+    stdout = io.StringIO()
+    call_command("collect_orphans", stdout=stdout)
+    assert "DigitalAsset: 9 rows reclaimed" in stdout.getvalue()
+    assert "Reclaimed 9 rows" in stdout.getvalue()
+
+
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="needs a PostgreSQL server, set test_db_host")
+@pytest.mark.postgresql
+@pytest.mark.django_db(transaction=True)
+def test_collection_skipped_while_an_import_is_in_progress():
+    store_pies(12)
+    store_aces(get_aces_rows(12))
+    ProductFitment.objects.all().delete()
+    counts = get_counts()
+    with ImportInProgressLock(), ImportInProgressLock():
+        orphan_collector = OrphanCollector()
+        assert orphan_collector.collect() == dict()
+        assert orphan_collector.stats == dict()
+        assert get_counts() == counts
+    assert sum(OrphanCollector().collect().values()) > 0
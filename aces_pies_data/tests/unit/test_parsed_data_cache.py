@@ -0,0 +1,145 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from aces_pies_data.management.import_utils import get_zip_member_hash
+from aces_pies_data.models import Brand, ImportTracking, ImportTrackingType
+from aces_pies_data.tests.factories import get_aces_rows, write_aces_flat_file, write_pies_xml
+from aces_pies_data.util.aces_pies_parsing import AcesFileParser, PiesFileParser
+from aces_pies_data.util.parsed_data_cache import CachedAcesFileParser, ParsedDataCache, get_cached_brand_data
+
+
+def get_records(num_records):
+    for idx in range(num_records):
+        yield {'part_number': f"TB{idx:07d}", 'values': [idx] * 3}
+
+
+def test_cache_round_trip(tmp_path):
+    parsed_data_cache = ParsedDataCache(str(tmp_path), "TB", "pies", "abc")
+    assert not parsed_data_cache.is_cached()
+    records = list(parsed_data_cache.cache_records({'brand': "Test Brand"}, get_records(25)))
+    assert records == list(get_records(25))
+    assert os.listdir(tmp_path) == ["TB_pies.parsed.gz"]
+    assert parsed_data_cache.is_cached()
+    assert not ParsedDataCache(str(tmp_path), "TB", "pies", "def").is_cached()
+    header, cached_records = ParsedDataCache(str(tmp_path), "TB", "pies", "abc").get_records()
+    assert header == {'brand': "Test Brand"}
+    assert list(cached_records) == records
+    parsed_data_cache.clear()
+    assert os.listdir(tmp_path) == []
+
+
+def test_cache_keeps_records_as_handed_out(tmp_path):
+    parsed_data_cache = ParsedDataCache(str(tmp_path), "TB", "pies", "abc")
+    for record in parsed_data_cache.cache_records(None, get_records(5)):
+        # storage modifies records after it gets them
+        record['values'].clear()
+    assert list(parsed_data_cache.get_records()[1]) == list(get_records(5))
+
+
+def test_finish_caches_records_not_consumed(tmp_path):
+    parsed_data_cache = ParsedDataCache(str(tmp_path), "TB", "pies", "abc")
+    records = parsed_data_cache.cache_records(None, get_records(25))
+    next(records)
+    # nothing is visible while storing is in progress
+    assert not parsed_data_cache.is_cached()
+    parsed_data_cache.finish()
+    assert list(parsed_data_cache.get_records()[1]) == list(get_records(25))
+
+
+def test_parse_failure_leaves_no_entry(tmp_path):
+    def get_failing_records():
+        yield from get_records(3)
+        raise ValueError("Bad xml")
+
+    parsed_data_cache = ParsedDataCache(str(tmp_path), "TB", "pies", "abc")
+    with pytest.raises(ValueError):
+        list(parsed_data_cache.cache_records(None, get_failing_records()))
+    parsed_data_cache.finish()
+    assert os.listdir(tmp_path) == []
+
+
+def test_cache_disabled_passes_records_through():
+    parsed_data_cache = ParsedDataCache(None, "TB", "pies", "abc")
+    assert list(parsed_data_cache.cache_records(None, get_records(3))) == list(get_records(3))
+    assert not parsed_data_cache.is_cached()
+    parsed_data_cache.finish()
+    parsed_data_cache.clear()
+
+
+def test_cached_pies_brand_data(tmp_path):
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 5)
+    pies_file.seek(0)
+    parsed_data_cache = ParsedDataCache(str(tmp_path / "cache"), "TB", "pies", "abc")
+    brand_data = get_cached_brand_data(parsed_data_cache, PiesFileParser(pies_file, "TB"))
+    product_data = list(brand_data['product_data'])
+    assert len(product_data) == 5
+    # a retry never touches the parser
+    cached_brand_data = get_cached_brand_data(parsed_data_cache, None)
+    assert {key: value for key, value in cached_brand_data.items() if key != 'product_data'} == {key: value for key, value in brand_data.items() if key != 'product_data'}
+    assert list(cached_brand_data['product_data']) == product_data
+
+
+@pytest.mark.django_db
+def test_cached_aces_fitment(tmp_path):
+    brand_record = Brand.objects.create(name="Test Brand", short_name="TB")
+    aces_file = io.BytesIO()
+    write_aces_flat_file(aces_file, get_aces_rows(40))
+    aces_file.seek(0)
+    parsed_data_cache = ParsedDataCache(str(tmp_path), "TB", "aces", "abc")
+    parsed_fitment = list(CachedAcesFileParser(parsed_data_cache, "TB", AcesFileParser(aces_file, "TB")).get_fitment_data(10))
+    cached_fitment = list(CachedAcesFileParser(parsed_data_cache, "TB").get_fitment_data(10))
+    assert len(cached_fitment) == len(parsed_fitment) == 4
+    for parsed, cached in zip(parsed_fitment, cached_fitment):
+        assert cached.brand_record == brand_record
+        assert cached.part_fitment_storage == parsed.part_fitment_storage
+        assert cached.vehicle_storage == parsed.vehicle_storage
+
+
+def test_zip_member_hash_ignores_zip_layout():
+    member_hashes = set()
+    for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        zip_bytes = io.BytesIO()
+        with zipfile.ZipFile(zip_bytes, 'w', compression) as zip_file:
+            zip_file.writestr("n1parts.txt", b"exppartno|year\r\nTB0000001|2010\r\n" * 1000)
+        with zipfile.ZipFile(zip_bytes) as zip_file:
+            member_hashes.add(get_zip_member_hash(zip_file, zip_file.filelist[0], block_size=100))
+    assert len(member_hashes) == 1
+
+
+def create_import(brand_short_name, import_type, content_hash, import_action=ImportTracking.DO_IMPORT):
+    tracking_type = ImportTrackingType.objects.get_or_create(name=import_type)[0]
+    return ImportTracking.objects.create(brand_short_name=brand_short_name, tracking_type=tracking_type, import_action=import_action, file_name=f"{brand_short_name}_{import_type}.zip",
+                                         content_hash=content_hash, end_date="2018-01-01T00:00:00Z")
+
+
+@pytest.mark.django_db
+def test_content_unchanged_since_last_import():
+    assert not ImportTracking.objects.is_content_unchanged("TB", "pies_flat", "abc")
+    create_import("TB", "pies_flat", "abc")
+    assert ImportTracking.objects.is_content_unchanged("TB", "pies_flat", "abc")
+    assert not ImportTracking.objects.is_content_unchanged("TB", "pies_flat", "def")
+    assert not ImportTracking.objects.is_content_unchanged("OB", "pies_flat", "abc")
+    # only the last import counts, data sent again after a different file has to be imported
+    create_import("TB", "pies_flat", "def")
+    assert not ImportTracking.objects.is_content_unchanged("TB", "pies_flat", "abc")
+    # skipped files do not replace the last import
+    create_import("TB", "pies_flat", "ghi", ImportTracking.DO_ARCHIVE)
+    assert ImportTracking.objects.is_content_unchanged("TB", "pies_flat", "def")
+
+
+@pytest.mark.django_db
+def test_content_changed_when_dependency_imported():
+    create_import("TB", "pies", "abc")
+    create_import("TB", "aces", "def")
+    assert ImportTracking.objects.is_content_unchanged("TB", "pies", "abc")
+    assert ImportTracking.objects.is_content_unchanged("TB", "aces", "def")
+    # new categories change the products, and new products change the fitment
+    create_import("TB", "pies_flat", "ghi")
+    assert not ImportTracking.objects.is_content_unchanged("TB", "pies", "abc")
+    assert ImportTracking.objects.is_content_unchanged("TB", "aces", "def")
+    create_import("TB", "pies", "abc")
+    assert not ImportTracking.objects.is_content_unchanged("TB", "aces", "def")
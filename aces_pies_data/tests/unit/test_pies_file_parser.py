@@ -0,0 +1,134 @@
+import io
+import tracemalloc
+import xml.etree.ElementTree as XmlTree
+
+import pytest
+
+from aces_pies_data.tests.factories import write_pies_xml
+from aces_pies_data.util import aces_pies_parsing
+from aces_pies_data.util.aces_pies_parsing import PiesFileParser, PiesFileSplitter
+from aces_pies_data.util.resource_usage import get_current_rss_bytes
+
+
+@pytest.fixture
+def pies_xml_path(tmp_path):
+    file_path = tmp_path / "pies67.xml"
+    with open(file_path, 'wb') as pies_xml_file:
+        write_pies_xml(pies_xml_file, 250)
+    return str(file_path)
+
+
+def get_parsed_brand_data(pies_xml_binary, **parser_kwargs):
+    brand_data = PiesFileParser(pies_xml_binary, "TB", **parser_kwargs).get_brand_data()
+    brand_data['product_data'] = list(brand_data['product_data'])
+    return brand_data
+
+
+def test_parallel_parse_matches_sequential_parse(pies_xml_path):
+    """
+    The parallel mode must hand storage exactly what the sequential mode does, in the same order
+    """
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        sequential_brand_data = get_parsed_brand_data(pies_xml_file, engine="etree")
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        parallel_brand_data = get_parsed_brand_data(pies_xml_file, engine="etree", processes=2, chunk_size_bytes=16 * 1024)
+    assert len(sequential_brand_data['product_data']) == 250
+    assert parallel_brand_data == sequential_brand_data
+
+
+def test_parallel_parse_spools_streams(pies_xml_path):
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        pies_xml_stream = io.BytesIO(pies_xml_file.read())
+    parallel_brand_data = get_parsed_brand_data(pies_xml_stream, processes=2, chunk_size_bytes=16 * 1024)
+    assert [product_data['part_number'] for product_data in parallel_brand_data['product_data']] == [f"TB{idx:07d}" for idx in range(250)]
+
+
+def test_item_byte_ranges_hold_whole_items(pies_xml_path):
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        pies_file_splitter = PiesFileSplitter(pies_xml_file, 10000)
+        byte_ranges = pies_file_splitter.get_item_byte_ranges()
+        contents = pies_xml_file.read()
+    assert len(byte_ranges) > 1
+    for start, end in byte_ranges:
+        item_bytes = contents[start:end]
+        assert item_bytes.startswith(b"<Item ")
+        assert item_bytes.rstrip().endswith(b"</Item>")
+        assert item_bytes.count(b"<Item ") == item_bytes.count(b"</Item>")
+    assert sum(contents[start:end].count(b"<Item ") for start, end in byte_ranges) == 250
+
+
+@pytest.mark.parametrize("engine", ["etree", "lxml"])
+def test_streaming_parse_runs_in_constant_memory(tmp_path, engine):
+    """
+    Finished items have to be detached from the tree, not just cleared.  Emptied elements left on the root grow memory linearly with the item count,
+    which is enough to push the traced peak of this file over the limit.
+    """
+    if engine == "lxml":
+        pytest.importorskip("lxml")
+    num_items = 10000
+    memory_limit_bytes = 512 * 1024
+    file_path = tmp_path / "large_pies67.xml"
+    with open(file_path, 'wb') as pies_xml_file:
+        write_pies_xml(pies_xml_file, num_items)
+    num_parsed_items = 0
+    with open(file_path, 'rb') as pies_xml_file:
+        pies_file_parser = PiesFileParser(pies_xml_file, "TB", engine=engine)
+        for product_data in pies_file_parser.get_brand_data()['product_data']:
+            num_parsed_items += 1
+            # start tracing once the parser is warmed up so one time allocations do not count against the limit
+            if num_parsed_items == 100:
+                tracemalloc.start()
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert num_parsed_items == num_items
+    assert peak_traced_bytes < memory_limit_bytes
+    if get_current_rss_bytes() is not None:
+        assert pies_file_parser.peak_rss_bytes > 0
+
+
+def test_item_decoder_matches_parse_xml_item(pies_xml_path):
+    pies_file_parser = PiesFileParser(None, "TB")
+    num_items = 0
+    for event, xml_elem in XmlTree.iterparse(pies_xml_path):
+        if xml_elem.tag == pies_file_parser.item_tag:
+            num_items += 1
+            decoded_product_data = pies_file_parser.item_decoder.decode(xml_elem)
+            parsed_product_data = pies_file_parser._parse_xml_item(xml_elem)
+            assert decoded_product_data == parsed_product_data
+            assert list(decoded_product_data.keys()) == list(parsed_product_data.keys())
+    assert num_items == 250
+
+
+@pytest.mark.parametrize("engine", ["etree", "lxml"])
+def test_pricing_without_price_is_unset(engine):
+    if engine == "lxml":
+        pytest.importorskip("lxml")
+    pies_file = io.BytesIO()
+    write_pies_xml(pies_file, 3)
+    # drop the Price of the first item's map pricing
+    pies_xml = pies_file.getvalue().replace(b'<Price UOM="PE">9.25</Price>', b'', 1)
+    brand_data = get_parsed_brand_data(io.BytesIO(pies_xml), engine=engine)
+    assert len(brand_data['product_data']) == 3
+    assert brand_data['product_data'][0]['map_price'] is None
+    assert brand_data['product_data'][0]['retail_price'] is not None
+    assert brand_data['product_data'][1]['map_price'] is not None
+    pies_file_parser = PiesFileParser(None, "TB")
+    for event, xml_elem in XmlTree.iterparse(io.BytesIO(pies_xml)):
+        if xml_elem.tag == pies_file_parser.item_tag:
+            assert pies_file_parser.item_decoder.decode(xml_elem) == pies_file_parser._parse_xml_item(xml_elem)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_lxml_engine_matches_etree_engine(pies_xml_path, processes):
+    pytest.importorskip("lxml")
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        etree_brand_data = get_parsed_brand_data(pies_xml_file, engine="etree")
+    with open(pies_xml_path, 'rb') as pies_xml_file:
+        lxml_brand_data = get_parsed_brand_data(pies_xml_file, engine="lxml", processes=processes, chunk_size_bytes=16 * 1024)
+    assert lxml_brand_data == etree_brand_data
+
+
+def test_lxml_engine_falls_back_to_etree(monkeypatch):
+    monkeypatch.setattr(aces_pies_parsing, "lxml_etree", None)
+    assert aces_pies_parsing.get_pies_xml_engine() is aces_pies_parsing.ElementTreeEngine
+    assert aces_pies_parsing.get_pies_xml_engine("lxml") is aces_pies_parsing.ElementTreeEngine
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from aces_pies_data.util.pipeline import PipelinedIterator, iter_chunks
+
+
+def test_chunks():
+    assert list(iter_chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(iter_chunks([], 3)) == []
+
+
+def test_items_arrive_in_order_from_another_thread():
+    producer_threads = set()
+
+    def produce():
+        for idx in range(100):
+            producer_threads.add(threading.current_thread())
+            yield idx
+
+    pipelined_items = PipelinedIterator(produce(), max_size=3)
+    assert list(pipelined_items) == list(range(100))
+    assert producer_threads and threading.current_thread() not in producer_threads
+    assert pipelined_items.stats['items'] == 100
+    assert pipelined_items.stats['max_depth'] <= 3
+
+
+def test_producer_stays_within_queue_size():
+    produced = list()
+
+    def produce():
+        for idx in range(20):
+            produced.append(idx)
+            yield idx
+
+    for idx in PipelinedIterator(produce(), max_size=2):
+        time.sleep(0.01)
+        # the queue holds 2, the producer waits with a third and the consumer holds a fourth
+        assert len(produced) <= idx + 4
+
+
+def test_stall_time_is_tracked_per_stage():
+    def produce_slowly():
+        for idx in range(5):
+            time.sleep(0.05)
+            yield idx
+
+    slow_producer = PipelinedIterator(produce_slowly(), max_size=2)
+    list(slow_producer)
+    assert slow_producer.stats['consumer_stall_seconds'] > 0.15
+    slow_consumer = PipelinedIterator(range(5), max_size=1)
+    for idx in slow_consumer:
+        time.sleep(0.05)
+    assert slow_consumer.stats['producer_stall_seconds'] > 0.05
+
+
+def test_producer_failure_is_raised_in_consumer():
+    def produce():
+        yield 1
+        raise ValueError("Bad xml")
+
+    consumed = list()
+    with pytest.raises(ValueError, match="Bad xml"):
+        for item in PipelinedIterator(produce()):
+            consumed.append(item)
+    assert consumed == [1]
+
+
+def test_consumer_stopping_early_stops_producer():
+    closed = threading.Event()
+
+    def produce():
+        try:
+            for idx in range(1000):
+                yield idx
+        finally:
+            closed.set()
+
+    with pytest.raises(RuntimeError):
+        for item in PipelinedIterator(produce(), max_size=2):
+            if item == 3:
+                raise RuntimeError("Storage failed")
+    assert closed.is_set()
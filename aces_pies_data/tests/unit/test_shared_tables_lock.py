@@ -0,0 +1,44 @@
+import importlib
+
+import pytest
+from django.db import connection, transaction
+
+from aces_pies_data.models import Brand, Category, EngineAspiration, FuelDelivery, FuelType, Product, ProductFitment, Vehicle, VehicleEngine, VehicleMake, VehicleModel, VehicleYear
+from aces_pies_data.util.shared_tables_lock import lock_shared_tables, shared_tables_lock_key
+
+merge_duplicate_lookups = importlib.import_module("aces_pies_data.migrations.0007_merge_duplicate_lookups")
+
+
+@pytest.mark.django_db
+def test_duplicate_engines_with_nulls_are_merged():
+    engine_config = {'configuration': "V8", 'liters': None, 'engine_code': None, 'aspiration': EngineAspiration.objects.create(name="N"),
+                     'fuel_type': FuelType.objects.create(name="GAS"), 'fuel_delivery': FuelDelivery.objects.create(name="FI")}
+    kept_engine, duplicate_engine = VehicleEngine.objects.create(**engine_config), VehicleEngine.objects.create(**engine_config)
+    make_record = VehicleMake.objects.create(name="Ford")
+    model_record = VehicleModel.objects.create(name="Mustang", make=make_record)
+    kept_vehicle = Vehicle.objects.create(make=make_record, model=model_record, engine=kept_engine)
+    duplicate_vehicle = Vehicle.objects.create(make=make_record, model=model_record, engine=duplicate_engine)
+    product_record = Product.objects.create(part_number="TB1", name="Brake Pad", brand=Brand.objects.create(name="Test Brand", short_name="TB"), category=Category.objects.create(name="Brake Pad"))
+    for vehicle_record, years in ((kept_vehicle, (2009, 2010)), (duplicate_vehicle, (2010, 2011))):
+        VehicleYear.objects.bulk_create([VehicleYear(vehicle=vehicle_record, year=year) for year in years])
+        ProductFitment.objects.create(product=product_record, vehicle=vehicle_record, start_year=2009, end_year=2011)
+    merge_duplicate_lookups.merge_duplicates(VehicleEngine, ("configuration", "liters", "fuel_type_id", "fuel_delivery_id", "aspiration_id", "engine_code"))
+    # the vehicle of the duplicate engine repeated the other vehicle, so it was merged into it as well
+    assert list(VehicleEngine.objects.values_list("id", flat=True)) == [kept_engine.id]
+    assert list(Vehicle.objects.values_list("id", flat=True)) == [kept_vehicle.id]
+    assert sorted(VehicleYear.objects.values_list("vehicle_id", "year")) == [(kept_vehicle.id, 2009), (kept_vehicle.id, 2010), (kept_vehicle.id, 2011)]
+    assert list(ProductFitment.objects.values_list("vehicle_id", flat=True)) == [kept_vehicle.id]
+
+
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="needs a PostgreSQL server, set test_db_host")
+@pytest.mark.postgresql
+@pytest.mark.django_db(transaction=True)
+def test_shared_tables_lock_is_held_until_commit():
+    with transaction.atomic():
+        lock_shared_tables()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND objid = %s AND pid = pg_backend_pid()", [shared_tables_lock_key])
+            assert cursor.fetchone()[0] == 1
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND objid = %s AND pid = pg_backend_pid()", [shared_tables_lock_key])
+        assert cursor.fetchone()[0] == 0
@@ -0,0 +1,27 @@
+import os
+
+from aces_pies_data.util.sql_lite_utils import SqlLiteTempDb
+
+
+def test_temp_dbs_are_isolated(tmp_path):
+    with SqlLiteTempDb(temp_dir=str(tmp_path)) as first_cursor, SqlLiteTempDb(temp_dir=str(tmp_path)) as second_cursor:
+        first_cursor.execute("CREATE TABLE AcesTempStorage (exppartno TEXT NOT NULL)")
+        second_cursor.execute("CREATE TABLE AcesTempStorage (exppartno TEXT NOT NULL)")
+        first_cursor.execute("INSERT INTO AcesTempStorage VALUES ('first')")
+        second_cursor.execute("SELECT COUNT(*) FROM AcesTempStorage")
+        assert second_cursor.fetchone()[0] == 0
+        assert len(os.listdir(tmp_path)) == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_temp_db_is_tuned(tmp_path):
+    sql_lite_db = SqlLiteTempDb(temp_dir=str(tmp_path), cache_size_mb=64, mmap_size_mb=128)
+    with sql_lite_db as sql_cursor:
+        assert sql_cursor.execute("PRAGMA journal_mode").fetchone()[0] == "off"
+        assert sql_cursor.execute("PRAGMA synchronous").fetchone()[0] == 0
+        assert sql_cursor.execute("PRAGMA cache_size").fetchone()[0] == -64 * 1024
+        mmap_size = sql_cursor.execute("PRAGMA mmap_size").fetchone()
+        # builds without mmap support return nothing
+        assert mmap_size is None or mmap_size[0] == 128 * 1024 * 1024
+        sql_cursor.execute("CREATE TABLE AcesTempStorage (exppartno TEXT NOT NULL)")
+        assert sql_lite_db.get_size_bytes() > 0
@@ -1,25 +1,141 @@
-import csv
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
+import operator
+import os
+import queue
+import shutil
 import string
+import tempfile
 import xml.etree.ElementTree as XmlTree
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from timeit import default_timer as timer
 
+import django
+from django.conf import settings
+
 from aces_pies_data.models import Brand
 import logging
 
+from aces_pies_data.util.dci_pipe_reader import DciPipeReader, decimal_or_raw, int_or_raw
+from aces_pies_data.util.external_sort import ExternalSort, HashPartitioner, read_row_blocks, write_row_blocks
+from aces_pies_data.util.resource_usage import PeakRssTracker, get_current_rss_bytes
 from aces_pies_data.util.sql_lite_utils import SqlLiteTempDb
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger("AcesPiesParsing")
 
 
+class ElementTreeEngine(object):
+    """
+    Standard library xml engine, always available
+    """
+    name = "etree"
+
+    @staticmethod
+    def iterparse_elements(pies_xml_binary, tags):
+        """
+            Clearing an element is not enough to keep memory flat, the emptied element stays attached to its parent and the parent chain stays attached to the root.
+            Parents are tracked from the start events so that once the caller is done with an element, it is cleared and removed from its parent.
+            Finished top level segments (Header, MarketingCopy, Items, Trailer) are removed from the root the same way.
+        """
+        parent_elems = list()
+        for event, xml_elem in XmlTree.iterparse(pies_xml_binary, events=("start", "end")):
+            if event == "start":
+                parent_elems.append(xml_elem)
+            else:
+                parent_elems.pop()
+                is_parsed_elem = xml_elem.tag in tags
+                if is_parsed_elem:
+                    yield xml_elem
+                if is_parsed_elem or len(parent_elems) == 1:
+                    xml_elem.clear()
+                    parent_elems[-1].remove(xml_elem)
+
+
+class LxmlEngine(object):
+    """
+    lxml based engine, only used when lxml is installed.
+    The tag filter keeps every other element out of python entirely and huge_tree lifts libxml2's limits on text node size and tree depth.
+    """
+    name = "lxml"
+
+    @staticmethod
+    def iterparse_elements(pies_xml_binary, tags):
+        for event, xml_elem in lxml_etree.iterparse(pies_xml_binary, events=("end",), tag=tags, huge_tree=True, remove_comments=True, remove_pis=True):
+            yield xml_elem
+            xml_elem.clear(keep_tail=True)
+            # everything before the finished element has been handled already, drop it so the parent does not keep growing
+            parent_elem = xml_elem.getparent()
+            while xml_elem.getprevious() is not None:
+                del parent_elem[0]
+
+
+pies_xml_engines = {xml_engine.name: xml_engine for xml_engine in (ElementTreeEngine, LxmlEngine)}
+
+
+def get_pies_xml_engine(engine_name=None):
+    """
+    Args:
+        engine_name: etree or lxml.  None picks lxml when it is installed
+    Returns:
+        The xml engine to parse pies files with, lxml requests fall back to etree when lxml is not installed
+    """
+    if engine_name is None:
+        engine_name = LxmlEngine.name if lxml_etree is not None else ElementTreeEngine.name
+    if engine_name not in pies_xml_engines:
+        raise ValueError(f"Unknown pies xml engine {engine_name}")
+    if engine_name == LxmlEngine.name and lxml_etree is None:
+        logger.warning("lxml is not installed, falling back to the etree pies xml engine")
+        engine_name = ElementTreeEngine.name
+    return pies_xml_engines[engine_name]
+
+
 class PiesFileParser(object):
     xmlns = "http://www.autocare.org"
     xml_namespaces = {"autocare": xmlns}
+    item_tag = "{{{0}}}Item".format(xmlns)
+    market_copy_tag = "{{{0}}}MarketCopy".format(xmlns)
+    rss_sample_interval = 1000
+    image_asset_type_regex = re.compile("P[0-9]+")
+    asset_type_map = {
+        'WAR': 'Warranty',
+        'OWN': 'Owners Manual',
+        'INS': 'Install Instructions',
+        'IMG': 'Product Image',
+    }
 
-    def __init__(self, pies_xml_binary, brand_short_name):
+    def __init__(self, pies_xml_binary, brand_short_name, processes=1, chunk_size_bytes=16 * 1024 * 1024, engine=None):
+        """
+        Args:
+            pies_xml_binary: File object for the decompressed pies xml file
+            brand_short_name: DCI short name for the brand, taken from the file name
+            processes: Number of worker processes used to parse items.  Anything above 1 splits the file into byte ranges and parses them in a process pool
+            chunk_size_bytes: Approximate size of each byte range handed to a worker process
+            engine: Xml engine name, see get_pies_xml_engine
+        """
         self.pies_xml_binary = pies_xml_binary
         self.brand_short_name = brand_short_name
+        self.processes = processes
+        self.chunk_size_bytes = chunk_size_bytes
+        # Highest rss seen while parsing this file, set once all the product data has been consumed
+        self.peak_rss_bytes = None
+        self.item_decoder = PiesItemDecoder(self.xmlns)
+        self.xml_engine = get_pies_xml_engine(engine)
 
     def get_brand_data(self):
         """
@@ -28,10 +144,38 @@ class PiesFileParser(object):
         Returns:
             A dictionary containing brand level info plus a generator for all the product data
         """
-        xml_tree = XmlTree.iterparse(self.pies_xml_binary)
-        brand_name, marketing_copy, logo_data, first_xml_item = None, None, None, None
-        for event, xml_item in xml_tree:
-            if xml_item.tag == "{{{0}}}MarketCopy".format(self.xmlns):
+        if self.processes > 1:
+            return self._get_brand_data_parallel()
+        xml_elements = self._iterparse_elements(self.pies_xml_binary)
+        brand_data, first_product_data = self._parse_brand_info(xml_elements)
+        brand_data['product_data'] = self._get_product_data(xml_elements, first_product_data)
+        return brand_data
+
+    def _get_brand_data_parallel(self):
+        """
+            Brand info is parsed sequentially from the top of the file, the items are then split into byte ranges on <Item> boundaries and parsed in a process pool.
+            The pies file has to be seekable for this, so zip members are spooled to a temp file first.
+        """
+        pies_file_splitter = PiesFileSplitter(self.pies_xml_binary, self.chunk_size_bytes)
+        try:
+            with open(pies_file_splitter.file_path, 'rb') as pies_xml_file:
+                brand_data, first_product_data = self._parse_brand_info(self._iterparse_elements(pies_xml_file))
+        except Exception:
+            pies_file_splitter.close()
+            raise
+        brand_data['product_data'] = self._get_product_data_parallel(pies_file_splitter)
+        return brand_data
+
+    def _iterparse_elements(self, pies_xml_binary):
+        """
+            Yields every completed MarketCopy and Item element.  Elements are detached by the engine once the caller is done with them.
+        """
+        return self.xml_engine.iterparse_elements(pies_xml_binary, (self.market_copy_tag, self.item_tag))
+
+    def _parse_brand_info(self, xml_elements):
+        brand_name, marketing_copy, logo_data, first_product_data = None, None, None, None
+        for xml_item in xml_elements:
+            if xml_item.tag == self.market_copy_tag:
                 marketing_copy = xml_item.find("autocare:MarketCopyContent", self.xml_namespaces).text
                 digital_assets_elem = xml_item.find("autocare:DigitalAssets", self.xml_namespaces)
                 for asset_elem in digital_assets_elem:
@@ -42,32 +186,73 @@ class PiesFileParser(object):
                         logo_data['url'] = asset_elem.find("autocare:URI", self.xml_namespaces).text
                         logo_data['file_size_bytes'] = asset_elem.find("autocare:FileSize", self.xml_namespaces).text
 
-            elif xml_item.tag == "{{{0}}}Item".format(self.xmlns):
-                first_xml_item = xml_item
-                brand_name = first_xml_item.find("autocare:BrandLabel", self.xml_namespaces).text
+            elif xml_item.tag == self.item_tag and not first_product_data:
+                # parse right away, the element gets detached once iteration moves on
+                first_product_data = self.item_decoder.decode(xml_item)
+                brand_name = first_product_data['brand_name']
             if marketing_copy and brand_name:
                 break
         if not marketing_copy or not brand_name:
             raise RuntimeError("No marketing copy or brand name found in XML document")
-        return {
+        brand_data = {
             'brand': brand_name,
             'brand_short_name': self.brand_short_name,
             'logo': logo_data,
-            'marketing_copy': marketing_copy,
-            'product_data': self._get_product_data(xml_tree, first_xml_item)
+            'marketing_copy': marketing_copy
         }
+        return brand_data, first_product_data
+
+    def _get_product_data(self, xml_elements, first_product_data=None):
+        rss_tracker = PeakRssTracker()
+        rss_tracker.sample()
+        num_items = 0
+        if first_product_data:
+            num_items += 1
+            yield first_product_data
+        for xml_item in xml_elements:
+            if xml_item.tag == self.item_tag:
+                num_items += 1
+                if num_items % self.rss_sample_interval == 0:
+                    rss_tracker.sample()
+                yield self.item_decoder.decode(xml_item)
+        self._log_parse_stats(num_items, rss_tracker)
+
+    def _get_product_data_parallel(self, pies_file_splitter):
+        """
+            Byte ranges are submitted to the pool a few at a time and results are yielded in file order.
+            Only a bounded number of ranges are in flight so parsed products do not pile up in memory while storage catches up.
+        """
+        max_pending_ranges = self.processes * 2
+        rss_tracker = PeakRssTracker()
+        num_items = 0
+        try:
+            # django.setup is needed for spawned (non forked) workers, this module imports models
+            with ProcessPoolExecutor(max_workers=self.processes, initializer=django.setup) as executor:
+                pending_ranges = deque()
+                for start, end in pies_file_splitter.get_item_byte_ranges():
+                    pending_ranges.append(executor.submit(parse_pies_byte_range, pies_file_splitter.file_path, pies_file_splitter.document_prefix, pies_file_splitter.document_suffix, start, end, self.brand_short_name, self.xml_engine.name))
+                    if len(pending_ranges) >= max_pending_ranges:
+                        range_product_data = self._get_range_product_data(pending_ranges.popleft(), rss_tracker)
+                        num_items += len(range_product_data)
+                        yield from range_product_data
+                while pending_ranges:
+                    range_product_data = self._get_range_product_data(pending_ranges.popleft(), rss_tracker)
+                    num_items += len(range_product_data)
+                    yield from range_product_data
+        finally:
+            pies_file_splitter.close()
+        self._log_parse_stats(num_items, rss_tracker)
 
-    def _get_product_data(self, xml_tree, first_xml_item=None):
-        def get_xml_data(_xml_item):
-            _xml_item_data = self._parse_xml_item(_xml_item)
-            _xml_item.clear()
-            return _xml_item_data
+    @staticmethod
+    def _get_range_product_data(range_future, rss_tracker):
+        range_product_data, worker_rss_bytes = range_future.result()
+        rss_tracker.sample()
+        rss_tracker.sample(worker_rss_bytes)
+        return range_product_data
 
-        if first_xml_item:
-            yield get_xml_data(first_xml_item)
-        for event, xml_item in xml_tree:
-            if xml_item.tag == "{{{0}}}Item".format(self.xmlns):
-                yield get_xml_data(xml_item)
+    def _log_parse_stats(self, num_items, rss_tracker):
+        self.peak_rss_bytes = rss_tracker.peak_rss_bytes
+        logger.info(f"Parsed {num_items} pies items for {self.brand_short_name}, peak RSS {rss_tracker.get_peak_rss_mb()} MB")
 
     def _parse_xml_item(self, xml_item):
         part_number = xml_item.find("autocare:PartNumber", self.xml_namespaces).text
@@ -154,6 +339,9 @@ class PiesFileParser(object):
             for pricing_elem in pricing_elems:
                 price_type = pricing_elem.get("PriceType")
                 price_elem = pricing_elem.find("autocare:Price", self.xml_namespaces)
+                # a Pricing without a Price leaves the price unset
+                if price_elem is None:
+                    continue
                 price = round(Decimal(price_elem.text), 2)
                 if price_type == "RMP":
                     map_price = price
@@ -195,13 +383,8 @@ class PiesFileParser(object):
 
     def _parse_xml_digital_assets(self, xml_item):
         assets_elem = xml_item.findall("autocare:DigitalAssets/autocare:DigitalFileInformation", self.xml_namespaces)
-        is_image_regex = re.compile("P[0-9]+")
-        asset_type_map = {
-            'WAR': 'Warranty',
-            'OWN': 'Owners Manual',
-            'INS': 'Install Instructions',
-            'IMG': 'Product Image',
-        }
+        is_image_regex = self.image_asset_type_regex
+        asset_type_map = self.asset_type_map
         digital_assets = list()
         display_sequence = 1
         for asset_elem in assets_elem:
@@ -253,42 +436,481 @@ class PiesFileParser(object):
         return weight_val
 
 
+class PiesItemDecoder(object):
+    """
+    Decodes an <Item> element into the same product data dict as PiesFileParser._parse_xml_item, in one pass over the item's children.
+    Namespaced tags are built once and every child is dispatched through a tag -> handler table instead of running a namespaced find/findall per field.
+    """
+
+    def __init__(self, xmlns):
+        self.xmlns_prefix = "{{{0}}}".format(xmlns)
+        tag = self._get_tag
+        self.part_number_tag = tag("PartNumber")
+        self.price_tag = tag("Price")
+        self.package_tag = tag("Package")
+        self.package_uom_tag = tag("PackageUOM")
+        self.quantity_tag = tag("QuantityofEaches")
+        self.dimensions_tag = tag("Dimensions")
+        self.weights_tag = tag("Weights")
+        self.digital_file_tag = tag("DigitalFileInformation")
+        self.country_tag = tag("Country")
+        self.asset_type_tag = tag("AssetType")
+        self.uri_tag = tag("URI")
+        self.file_size_tag = tag("FileSize")
+        self.item_handlers = {
+            self.part_number_tag: self._decode_part_number,
+            tag("BrandLabel"): self._decode_brand_label,
+            tag("HazardousMaterialCode"): self._decode_hazardous_material,
+            tag("Descriptions"): self._decode_descriptions,
+            tag("ProductAttributes"): self._decode_attributes,
+            tag("ExtendedInformation"): self._decode_extended_info,
+            tag("Prices"): self._decode_pricing,
+            tag("DigitalAssets"): self._decode_digital_assets,
+            tag("Packages"): self._decode_packaging,
+        }
+        # dimension and weight tags become package_data keys, cache the conversion as only a handful of tags ever show up
+        self.package_keys = dict()
+
+    def _get_tag(self, name):
+        return self.xmlns_prefix + name
+
+    def decode(self, xml_item):
+        product_data = {
+            'part_number': None,
+            'brand_name': None,
+            'is_hazardous': False,
+            'name': None,
+            'features': list(),
+            'attributes': list(),
+            'is_carb_legal': True,
+            'is_discontinued': False,
+            'is_obsolete': False,
+            'is_superseded': False,
+            'superseded_by': None,
+            'map_price': None,
+            'retail_price': None,
+            'digital_assets': list(),
+            'packages': list()
+        }
+        item_state = {
+            'feature_lookup': dict(),
+            'display_sequence': 1
+        }
+        item_handlers = self.item_handlers
+        for child_elem in xml_item:
+            handler = item_handlers.get(child_elem.tag)
+            if handler:
+                handler(child_elem, product_data, item_state)
+        feature_lookup = item_state['feature_lookup']
+        for feature_sequence in sorted(feature_lookup.keys()):
+            product_data['features'].append(feature_lookup[feature_sequence])
+        if not product_data['name']:
+            product_data['name'] = product_data['part_number']
+        return product_data
+
+    @staticmethod
+    def _get_first_children(xml_elem):
+        # equivalent of running find for every tag, the first child with a given tag wins
+        first_children = dict()
+        for child_elem in xml_elem:
+            if child_elem.tag not in first_children:
+                first_children[child_elem.tag] = child_elem
+        return first_children
+
+    @staticmethod
+    def _decode_part_number(part_number_elem, product_data, item_state):
+        product_data['part_number'] = part_number_elem.text
+
+    @staticmethod
+    def _decode_brand_label(brand_label_elem, product_data, item_state):
+        product_data['brand_name'] = brand_label_elem.text
+
+    @staticmethod
+    def _decode_hazardous_material(hazardous_elem, product_data, item_state):
+        # element truth tests are spelled out with len(), the result matches _parse_xml_item and lxml no longer gives truth tests the same meaning
+        product_data['is_hazardous'] = hazardous_elem.text.lower() == "y" if len(hazardous_elem) else False
+
+    @staticmethod
+    def _decode_descriptions(descriptions_elem, product_data, item_state):
+        product_ext, product_des = None, None
+        for description_elem in descriptions_elem:
+            code = description_elem.attrib['DescriptionCode']
+            if code == 'DES':
+                product_des = description_elem.text
+            elif code == 'EXT':
+                product_ext = description_elem.text
+            elif code == 'FAB':
+                item_state['feature_lookup'][description_elem.attrib['Sequence']] = description_elem.text
+        product_data['name'] = product_ext or product_des
+
+    @staticmethod
+    def _decode_attributes(attributes_elem, product_data, item_state):
+        attributes = product_data['attributes']
+        for attribute_elem in attributes_elem:
+            attributes.append({
+                "type": string.capwords(attribute_elem.get("AttributeID")).strip(),
+                "value": attribute_elem.text.strip()
+            })
+
+    @staticmethod
+    def _decode_extended_info(extended_info_elems, product_data, item_state):
+        not_for_ca, discontinued, obsolete, superseded = False, False, False, False
+        superseded_by = None
+        for extended_info_elem in extended_info_elems:
+            code, value = extended_info_elem.get("EXPICode"), extended_info_elem.text
+            if code == "EMS" and value == "2":
+                not_for_ca = True
+            elif code == "LIF":
+                if value == "7":
+                    superseded = True
+                elif value == "8":
+                    discontinued = True
+                elif value == "9":
+                    obsolete = True
+            elif code == "PTS":
+                superseded_by = value
+        if superseded_by and not superseded:
+            superseded_by = None
+        product_data['is_carb_legal'] = not not_for_ca
+        product_data['is_discontinued'] = discontinued
+        product_data['is_obsolete'] = obsolete
+        product_data['is_superseded'] = superseded
+        product_data['superseded_by'] = superseded_by
+
+    def _decode_pricing(self, pricing_elems, product_data, item_state):
+        price_tag = self.price_tag
+        for pricing_elem in pricing_elems:
+            price_type = pricing_elem.get("PriceType")
+            price_elem = next((child_elem for child_elem in pricing_elem if child_elem.tag == price_tag), None)
+            # a Pricing without a Price leaves the price unset, like _parse_xml_pricing
+            if price_elem is None:
+                continue
+            price = round(Decimal(price_elem.text), 2)
+            if price_type == "RMP":
+                product_data['map_price'] = price
+            elif price_type == "RET":
+                product_data['retail_price'] = price
+
+    def _decode_packaging(self, packages_elem, product_data, item_state):
+        for package_elem in packages_elem:
+            if package_elem.tag != self.package_tag:
+                continue
+            package_fields = self._get_first_children(package_elem)
+            if package_fields[self.package_uom_tag].text == "EA":
+                package_data = dict()
+                package_data['quantity'] = int(package_fields[self.quantity_tag].text)
+                dimensions_elem = package_fields.get(self.dimensions_tag)
+                weights_elem = package_fields.get(self.weights_tag)
+                if dimensions_elem is not None and len(dimensions_elem):
+                    package_data["dimension_unit"] = "in"
+                    dimensions_uom = dimensions_elem.get("UOM")  # in or cm
+                    for dimension_elem in dimensions_elem:
+                        package_data[self._get_package_key(dimension_elem.tag)] = round(PiesFileParser.get_dimension_inches(dimension_elem.text, dimensions_uom), 2)
+                if weights_elem is not None and len(weights_elem):
+                    package_data["weight_unit"] = "lb"
+                    weights_uom = weights_elem.get("UOM")  # pg or gt, gross pounds or gross kilograms
+                    for weight_elem in weights_elem:
+                        package_data[self._get_package_key(weight_elem.tag)] = round(PiesFileParser.get_weight_pounds(weight_elem.text, weights_uom), 2)
+                product_data['packages'].append(package_data)
+
+    def _get_package_key(self, tag):
+        package_key = self.package_keys.get(tag)
+        if package_key is None:
+            package_key = tag.replace(self.xmlns_prefix, "").lower()
+            self.package_keys[tag] = package_key
+        return package_key
+
+    def _decode_digital_assets(self, assets_elem, product_data, item_state):
+        is_image_regex = PiesFileParser.image_asset_type_regex
+        asset_type_map = PiesFileParser.asset_type_map
+        for asset_elem in assets_elem:
+            if asset_elem.tag != self.digital_file_tag:
+                continue
+            asset_fields = self._get_first_children(asset_elem)
+            country_elem = asset_fields.get(self.country_tag)
+            # spelled out element truth test of _parse_xml_digital_assets, a country element without children passes the check
+            if country_elem is None or not len(country_elem) or country_elem.text == "US":
+                asset_type = asset_fields[self.asset_type_tag].text
+                is_image = is_image_regex.match(asset_type)
+                if is_image or asset_type in asset_type_map:
+                    try:
+                        file_size_bytes = int(asset_fields[self.file_size_tag].text)
+                    except:
+                        file_size_bytes = None
+
+                    file_data = {
+                        'url': asset_fields[self.uri_tag].text,
+                        'file_size_bytes': file_size_bytes,
+                        'display_sequence': 0
+                    }
+                    if is_image:
+                        asset_type_text = asset_type_map["IMG"]
+                        if asset_type == "P04":
+                            file_data['display_sequence'] = 1
+                        else:
+                            item_state['display_sequence'] += 1
+                            file_data['display_sequence'] = item_state['display_sequence']
+                    else:
+                        asset_type_text = asset_type_map[asset_type]
+                    file_data['asset_type'] = asset_type_text
+                    product_data['digital_assets'].append(file_data)
+
+
+class PiesFileSplitter(object):
+    """
+    Splits a decompressed pies xml file into byte ranges that only contain whole <Item> elements, so each range can be parsed on its own.
+    Each range is turned back into a valid document by wrapping it with everything up to the root start tag and the matching root end tag,
+    which keeps the xml declaration and all namespace declarations intact.
+    """
+    item_start_regex = re.compile(rb"<Item[\s>]")
+    item_end_tag = b"</Item>"
+    root_start_tag_regex = re.compile(rb"<([A-Za-z_][\w.:-]*)[^>]*>")
+    read_block_size = 1024 * 1024
+
+    def __init__(self, pies_xml_binary, chunk_size_bytes):
+        self.chunk_size_bytes = chunk_size_bytes
+        self.is_spooled = False
+        # zip members also have a name, but it is the name inside the archive, only real files can be read in place
+        if isinstance(pies_xml_binary, (io.FileIO, io.BufferedReader, io.TextIOWrapper)) and os.path.isfile(pies_xml_binary.name):
+            self.file_path = pies_xml_binary.name
+        else:
+            self.file_path = self._spool_to_temp_file(pies_xml_binary)
+            self.is_spooled = True
+        self.document_prefix, self.document_suffix = self._get_document_wrapper()
+
+    def _spool_to_temp_file(self, pies_xml_binary):
+        file_descriptor, file_path = tempfile.mkstemp(suffix=".xml")
+        start = timer()
+        with os.fdopen(file_descriptor, 'wb') as spool_file:
+            shutil.copyfileobj(pies_xml_binary, spool_file, self.read_block_size)
+        logger.info(f"Spooled pies file to {file_path} in {timer() - start} seconds")
+        return file_path
+
+    def _get_document_wrapper(self):
+        with open(self.file_path, 'rb') as pies_xml_file:
+            header = b''
+            root_start_tag_match = None
+            while not root_start_tag_match:
+                block = pies_xml_file.read(self.read_block_size)
+                if not block:
+                    raise RuntimeError("No root element found in XML document")
+                header += block
+                root_start_tag_match = self.root_start_tag_regex.search(header)
+        return header[:root_start_tag_match.end()], b"</" + root_start_tag_match.group(1) + b">"
+
+    def get_item_byte_ranges(self):
+        """
+        Returns:
+            A list of (start, end) byte offsets.  Every range starts at an <Item> start tag and the last range ends right after the last </Item> end tag
+        """
+        with open(self.file_path, 'rb') as pies_xml_file:
+            first_item_start = self._find_item_start(pies_xml_file, 0)
+            if first_item_start is None:
+                return list()
+            last_item_end = self._find_last_item_end(pies_xml_file)
+            boundaries = [first_item_start]
+            next_item_start = self._find_item_start(pies_xml_file, first_item_start + self.chunk_size_bytes)
+            while next_item_start is not None and next_item_start < last_item_end:
+                boundaries.append(next_item_start)
+                next_item_start = self._find_item_start(pies_xml_file, next_item_start + self.chunk_size_bytes)
+            boundaries.append(last_item_end)
+        return list(zip(boundaries, boundaries[1:]))
+
+    def _find_item_start(self, pies_xml_file, offset):
+        # overlap reads by the length of the longest match so a tag split across two blocks is still found
+        overlap = len(b"<Item ")
+        pies_xml_file.seek(offset)
+        block = pies_xml_file.read(self.read_block_size)
+        while block:
+            item_start_match = self.item_start_regex.search(block)
+            if item_start_match:
+                return offset + item_start_match.start()
+            offset += max(len(block) - overlap, 1)
+            pies_xml_file.seek(offset)
+            block = pies_xml_file.read(self.read_block_size)
+        return None
+
+    def _find_last_item_end(self, pies_xml_file):
+        file_size = pies_xml_file.seek(0, io.SEEK_END)
+        block_end = file_size
+        while block_end > 0:
+            block_start = max(block_end - self.read_block_size, 0)
+            pies_xml_file.seek(block_start)
+            block = pies_xml_file.read(block_end - block_start + len(self.item_end_tag))
+            item_end_idx = block.rfind(self.item_end_tag)
+            if item_end_idx != -1:
+                return block_start + item_end_idx + len(self.item_end_tag)
+            block_end = block_start
+        raise RuntimeError("No closing Item tag found in XML document")
+
+    def close(self):
+        if self.is_spooled:
+            try:
+                os.remove(self.file_path)
+            except OSError:
+                logger.exception(f"Failed to delete spooled pies file {self.file_path}")
+            self.is_spooled = False
+
+
+def parse_pies_byte_range(file_path, document_prefix, document_suffix, start, end, brand_short_name, engine_name):
+    """
+    Worker for PiesFileParser's parallel mode, needs to stay at module level so it can be pickled into the process pool
+    Returns:
+        A list of product data dicts for every item in the byte range, plus the worker's rss so the parent can report a peak for the whole file
+    """
+    with open(file_path, 'rb') as pies_xml_file:
+        pies_xml_file.seek(start)
+        item_bytes = pies_xml_file.read(end - start)
+    pies_file_parser = PiesFileParser(None, brand_short_name, engine=engine_name)
+    xml_elements = pies_file_parser._iterparse_elements(io.BytesIO(document_prefix + item_bytes + document_suffix))
+    range_product_data = [pies_file_parser.item_decoder.decode(xml_item) for xml_item in xml_elements if xml_item.tag == pies_file_parser.item_tag]
+    return range_product_data, get_current_rss_bytes()
+
+
+def get_product_fingerprint(product_data):
+    """
+    Stable hash of a parsed product, covering its fields, features, attributes, packages and digital assets.
+    Keys are sorted and values are written as strings, so the same item in two files hashes the same whichever parser or process decoded it.
+    Returns:
+        A 40 character hex digest
+    """
+    fingerprint_data = {key: value for key, value in product_data.items() if key not in ('product_record', 'fingerprint')}
+    return hashlib.sha1(json.dumps(fingerprint_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
 class AcesFileParser(object):
-    def __init__(self, aces_flat_file_binary, brand_short_name):
+    # exppartno is first so it can be used as the sort key
+    fitment_columns = ('exppartno', 'catcode', 'year', 'make', 'model', 'submodel', 'engtype', 'liter', 'fuel', 'fueldel', 'asp', 'engvin', 'engdesg', 'dciptdescr', 'expldescr', 'vqdescr', 'fndescr')
+    # converted once per distinct value by the reader.  Not used by the sqlite engine, sqlite cannot store Decimal
+    fitment_converters = {'year': int_or_raw, 'liter': decimal_or_raw}
+    # chunks a partition worker parses ahead of storage in parallel mode
+    partition_queue_size = 4
+
+    def __init__(self, aces_flat_file_binary, brand_short_name, sort_engine="external", sort_run_size=500000, sort_temp_dir=None, processes=1, partitions=None, normaliser="dict"):
+        """
+        Args:
+            aces_flat_file_binary: The pipe delimited aces flat file, a binary file object or anything else DciPipeReader reads
+            brand_short_name: DCI short name for the brand, taken from the file name
+            sort_engine: external sorts with ExternalSort, sqlite sorts through a temp sqlite database
+            sort_run_size: Number of rows held in memory per sorted run by the external sort
+            sort_temp_dir: Directory the sort spills to, for either engine.  Defaults to the system temp directory
+            processes: More than 1 hash partitions the rows by part number and parses the partitions in a process pool.  Partitions are sorted in runs of sort_run_size rows by the workers
+            partitions: Number of partitions in parallel mode, defaults to 8 per process
+            normaliser: dict consolidates one row at a time with ParsedProductFitment, columnar uses ColumnarFitmentNormaliser and falls back to dict without numpy
+        """
+        if sort_engine not in ("external", "sqlite"):
+            raise ValueError(f"Unknown aces sort engine {sort_engine}")
+        if normaliser not in ("dict", ColumnarFitmentNormaliser.name):
+            raise ValueError(f"Unknown aces normaliser {normaliser}")
+        if normaliser == ColumnarFitmentNormaliser.name and numpy is None:
+            logger.warning("numpy is not installed, falling back to the dict aces normaliser")
+            normaliser = "dict"
         self.aces_flat_file_binary = aces_flat_file_binary
         self.brand_short_name = brand_short_name
+        self.sort_engine = sort_engine
+        self.sort_run_size = sort_run_size
+        self.sort_temp_dir = sort_temp_dir
+        self.processes = processes
+        self.partitions = partitions or processes * 8
+        self.normaliser = normaliser
+        # rows, bytes_spilled and sort_seconds are reported by both engines, filled in once the rows are sorted
+        self.sort_stats = dict()
         self.brand_record = Brand.objects.get(short_name=self.brand_short_name)
 
     def get_fitment_data(self, part_fitment_chunks=10):
-        part_num_to_consolidate = None
-        parsed_product_fitment = ParsedProductFitment(self.brand_record)
-        with SqlLiteTempDb() as sql_cursor:
-            self._store_file_in_db(sql_cursor)
-            for fitment_row in sql_cursor:
-                current_part_num = fitment_row['exppartno']
-                if part_num_to_consolidate and part_num_to_consolidate != current_part_num:
-                    if len(parsed_product_fitment.part_fitment_storage['storage_objects']) == part_fitment_chunks:
-                        parsed_product_fitment._add_years_to_fitment_keys()
+        """
+        Returns:
+            A generator of ParsedProductFitment, each holding the complete fitment of up to part_fitment_chunks parts.
+            In parallel mode chunks come partition by partition rather than in part number order, the same order for the same file and number of partitions.
+        """
+        if self.processes > 1:
+            return self._get_fitment_data_parallel(part_fitment_chunks)
+        return consolidate_fitment_values(self._get_sorted_fitment_values(), self.brand_record, part_fitment_chunks, self.normaliser)
+
+    def _get_fitment_data_parallel(self, part_fitment_chunks):
+        """
+        Fitment for a part never depends on another part, so rows are hash partitioned by part number and each partition is sorted and consolidated in workers.
+        Partitions are written in segments of sort_run_size rows, each full segment is sorted into a run by a worker while the main process keeps reading the file.
+        Once the file is read a worker per partition merges its runs and streams the consolidated chunks back through a bounded queue.
+        Partitions are handed to storage in order, at most partition_queue_size chunks of a bounded number of partitions are held at a time.
+        """
+        max_pending_partitions = self.processes * 2
+        rss_tracker = PeakRssTracker()
+        num_parts = 0
+        fitment_values = DciPipeReader(self.aces_flat_file_binary, self.fitment_columns, self.fitment_converters)
+        self.sort_stats = {'rows': 0, 'runs': 0, 'bytes_spilled': 0, 'sort_seconds': 0.0, 'partitions': 0}
+        # django.setup is needed for spawned (non forked) workers, this module imports models
+        with HashPartitioner(self.partitions, temp_dir=self.sort_temp_dir) as hash_partitioner, multiprocessing.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=self.processes, initializer=django.setup) as executor:
+            stop_event = manager.Event()
+            try:
+                partition_runs = dict()
+                for partition, segment_path in hash_partitioner.partition_segments(fitment_values, self.sort_run_size):
+                    partition_runs.setdefault(partition, list()).append(executor.submit(sort_aces_segment, segment_path))
+                self.sort_stats['rows'] = hash_partitioner.stats['rows']
+                self.sort_stats['bytes_spilled'] = hash_partitioner.stats['bytes_spilled']
+                self.sort_stats['partitions'] = len(partition_runs)
+                partitions = deque(sorted(partition_runs))
+                pending_partitions = deque()
+                while partitions or pending_partitions:
+                    while partitions and len(pending_partitions) < max_pending_partitions:
+                        run_paths = [self._add_run_stats(run_future.result()) for run_future in partition_runs.pop(partitions.popleft())]
+                        fitment_queue = manager.Queue(self.partition_queue_size)
+                        partition_future = executor.submit(parse_aces_partition, run_paths, self.brand_record, part_fitment_chunks, self.normaliser, fitment_queue, stop_event)
+                        pending_partitions.append((partition_future, fitment_queue))
+                    partition_future, fitment_queue = pending_partitions.popleft()
+                    for parsed_product_fitment in iter_partition_fitment(partition_future, fitment_queue):
+                        num_parts += len(parsed_product_fitment.part_fitment_storage['storage_objects'])
                         yield parsed_product_fitment
-                        parsed_product_fitment = ParsedProductFitment(self.brand_record)
-                part_num_to_consolidate = current_part_num
-                parsed_product_fitment.parse_fitment_row(fitment_row)
-            if len(parsed_product_fitment.part_fitment_storage['storage_objects']):
-                parsed_product_fitment._add_years_to_fitment_keys()
-                yield parsed_product_fitment
+                    rss_tracker.sample()
+                    rss_tracker.sample(partition_future.result())
+            finally:
+                # workers blocked on a full queue stop once the consumer is gone
+                stop_event.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+        logger.info(
+            f"Parsed fitment for {num_parts} parts of {self.brand_short_name} from {self.sort_stats['partitions']} partitions in {self.sort_stats['runs']} runs, "
+            f"{self.sort_stats['bytes_spilled']} bytes spilled, {self.sort_stats['sort_seconds']} seconds sorting, peak RSS {rss_tracker.get_peak_rss_mb()} MB"
+        )
+
+    def _add_run_stats(self, sorted_segment):
+        run_path, run_stats = sorted_segment
+        self.sort_stats['runs'] += 1
+        self.sort_stats['bytes_spilled'] += run_stats['bytes_spilled']
+        self.sort_stats['sort_seconds'] += run_stats['sort_seconds']
+        return run_path
+
+    def _get_sorted_fitment_values(self):
+        """
+        The files do not come in sorted, rows have to be grouped by part number before they can be consolidated
+        Returns:
+            A generator of fitment rows in part number order, each row can be indexed by position in fitment_columns order
+        """
+        if self.sort_engine == "sqlite":
+            sql_lite_db = SqlLiteTempDb(temp_dir=self.sort_temp_dir, cache_size_mb=settings.ACES_SQLITE_CACHE_MB, mmap_size_mb=settings.ACES_SQLITE_MMAP_MB)
+            with sql_lite_db as sql_cursor:
+                self._store_file_in_db(sql_lite_db, sql_cursor)
+                yield from sql_cursor
+        else:
+            logger.info("Sorting aces data by part number")
+            fitment_values = DciPipeReader(self.aces_flat_file_binary, self.fitment_columns, self.fitment_converters)
+            external_sort = ExternalSort(run_size=self.sort_run_size, temp_dir=self.sort_temp_dir)
+            self.sort_stats = external_sort.stats
+            yield from external_sort.sort(fitment_values)
 
-    def _store_file_in_db(self, sql_cursor):
+    def _store_file_in_db(self, sql_lite_db, sql_cursor):
         """
-        The files do not come in sorted.  Store in temp sql_lite DB so we can sort by part number
+        Store in temp sql_lite DB so we can sort by part number
         Other options were OS level sort, however, if hosting on windows there isn't a great out of the box option.
         Linux does have a great built in sort feature that is reliable and fast.  SQLite strategy is a compromise, but still fast enough.
+        The external sort engine avoids writing every row to the database and reading it back, this is kept as an alternative engine.
         """
         logger.info("Storing aces data into SqlliteDB to sort by part number")
         cols = ['catcode', 'year', 'make', 'model', 'submodel', 'engtype', 'liter', 'fuel', 'fueldel', 'asp', 'engvin', 'engdesg', 'dciptdescr', 'expldescr', 'vqdescr', 'fndescr']
         sql_cursor.execute('CREATE TABLE AcesTempStorage (exppartno TEXT NOT NULL, {})'.format(",".join([col + " TEXT NULL" for col in cols])))
         cols.append("exppartno")
         sql_chunks = list()
-        reader = csv.DictReader(self.aces_flat_file_binary, delimiter='|', quoting=csv.QUOTE_NONE)
+        reader = DciPipeReader(self.aces_flat_file_binary, cols)
         sql = "INSERT INTO AcesTempStorage ({cols}) VALUES({values})".format(cols=",".join(cols), values=','.join(['?'] * len(cols)))
         sql_cursor.execute("BEGIN")
         num_chunks = 100000
@@ -301,19 +923,132 @@ class AcesFileParser(object):
             logger.info(f"Rows {_rows} - {row_end} stored in SqlliteDB in {timer() - start} seconds")
             return row_end
 
-        for fitment_row in reader:
-            values = list()
-            for col in cols:
-                values.append(fitment_row[col])
+        for values in reader:
             sql_chunks.append(values)
             if len(sql_chunks) == num_chunks:
                 rows = store_chunks(rows, sql_chunks)
                 sql_chunks = list()
         if len(sql_chunks):
-            store_chunks(rows, sql_chunks)
+            rows = store_chunks(rows, sql_chunks)
         sql_cursor.execute("COMMIT")
+        start = timer()
         sql_cursor.execute('CREATE INDEX exppartno ON AcesTempStorage (exppartno)')
-        sql_cursor.execute("SELECT * FROM AcesTempStorage ORDER BY exppartno")
+        sql_cursor.execute("SELECT {cols} FROM AcesTempStorage ORDER BY exppartno".format(cols=",".join(self.fitment_columns)))
+        self.sort_stats = {
+            'rows': rows,
+            'bytes_spilled': sql_lite_db.get_size_bytes(),
+            'sort_seconds': timer() - start
+        }
+        logger.info(f"Sorted {rows} rows in SqlliteDB in {self.sort_stats['sort_seconds']} seconds, {self.sort_stats['bytes_spilled']} bytes spilled")
+
+
+def consolidate_fitment_rows(fitment_rows, brand_record, part_fitment_chunks):
+    """
+    Args:
+        fitment_rows: Fitment rows grouped by part number, each row can be indexed by column name
+        brand_record: Brand the fitment belongs to
+        part_fitment_chunks: Number of parts per ParsedProductFitment
+    Returns:
+        A generator of ParsedProductFitment, a part's rows never get split across two of them
+    """
+    part_num_to_consolidate = None
+    parsed_product_fitment = ParsedProductFitment(brand_record)
+    for fitment_row in fitment_rows:
+        current_part_num = fitment_row['exppartno']
+        if part_num_to_consolidate and part_num_to_consolidate != current_part_num:
+            if len(parsed_product_fitment.part_fitment_storage['storage_objects']) == part_fitment_chunks:
+                parsed_product_fitment._add_years_to_fitment_keys()
+                yield parsed_product_fitment
+                parsed_product_fitment = ParsedProductFitment(brand_record)
+        part_num_to_consolidate = current_part_num
+        parsed_product_fitment.parse_fitment_row(fitment_row)
+    if len(parsed_product_fitment.part_fitment_storage['storage_objects']):
+        parsed_product_fitment._add_years_to_fitment_keys()
+        yield parsed_product_fitment
+
+
+def consolidate_fitment_values(fitment_values, brand_record, part_fitment_chunks, normaliser="dict"):
+    """
+    Args:
+        fitment_values: Fitment rows grouped by part number, each row can be indexed by position in AcesFileParser.fitment_columns order
+        normaliser: dict or columnar, see AcesFileParser
+    Returns:
+        A generator of ParsedProductFitment
+    """
+    if normaliser == ColumnarFitmentNormaliser.name:
+        return ColumnarFitmentNormaliser(brand_record, part_fitment_chunks).get_fitment_data(fitment_values)
+    fitment_columns = AcesFileParser.fitment_columns
+    return consolidate_fitment_rows((dict(zip(fitment_columns, values)) for values in fitment_values), brand_record, part_fitment_chunks)
+
+
+def sort_aces_segment(segment_path):
+    """
+    Worker for AcesFileParser's parallel mode, sorts a partition segment by part number into a run file next to it
+    Returns:
+        The path of the run file and its sort stats
+    """
+    start = timer()
+    with open(segment_path, 'rb') as segment_file:
+        rows = list(read_row_blocks(segment_file))
+    os.remove(segment_path)
+    # a stable sort keeps the rows of a part in file order
+    rows.sort(key=operator.itemgetter(0))
+    run_path = f"{segment_path}_sorted"
+    with open(run_path, 'wb') as run_file:
+        bytes_spilled = write_row_blocks(rows, run_file)
+    return run_path, {'bytes_spilled': bytes_spilled, 'sort_seconds': timer() - start}
+
+
+def parse_aces_partition(run_paths, brand_record, part_fitment_chunks, normaliser, fitment_queue, stop_event):
+    """
+    Worker for AcesFileParser's parallel mode, needs to stay at module level so it can be pickled into the process pool.
+    Merges the sorted runs of a partition and puts each consolidated ParsedProductFitment on fitment_queue as it is made, followed by None.
+    Returns:
+        The worker's rss
+    """
+    run_files = [open(run_path, 'rb') for run_path in run_paths]
+    try:
+        # runs are in file order, the merge keeps the rows of a part in file order
+        fitment_values = heapq.merge(*[read_row_blocks(run_file) for run_file in run_files], key=operator.itemgetter(0))
+        for parsed_product_fitment in consolidate_fitment_values(fitment_values, brand_record, part_fitment_chunks, normaliser):
+            if not _put_partition_fitment(fitment_queue, stop_event, parsed_product_fitment):
+                return None
+        _put_partition_fitment(fitment_queue, stop_event, None)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+    return get_current_rss_bytes()
+
+
+def _put_partition_fitment(fitment_queue, stop_event, parsed_product_fitment):
+    """
+    Returns:
+        False if the consumer stopped before there was room on the queue
+    """
+    while not stop_event.is_set():
+        try:
+            fitment_queue.put(parsed_product_fitment, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_partition_fitment(partition_future, fitment_queue):
+    """
+    Returns:
+        A generator of the ParsedProductFitment a parse_aces_partition worker puts on fitment_queue, raising the worker's exception if it fails
+    """
+    while True:
+        try:
+            parsed_product_fitment = fitment_queue.get(timeout=0.1)
+        except queue.Empty:
+            if partition_future.done() and partition_future.exception():
+                raise partition_future.exception()
+            continue
+        if parsed_product_fitment is None:
+            return
+        yield parsed_product_fitment
 
 
 class ParsedProductFitment(object):
@@ -342,6 +1077,7 @@ class ParsedProductFitment(object):
         self.part_fitment_storage = {
             'storage_objects': dict()
         }
+        self.fitment_digests = dict()
 
     def parse_fitment_row(self, fitment_row):
         year = fitment_row['year']
@@ -404,37 +1140,46 @@ class ParsedProductFitment(object):
         }
 
     def _parse_engine_data(self, fitment_row):
-        engine_configuration = fitment_row['engtype']
-        engine_key = None
-        if engine_configuration:
-            engine_liters = fitment_row['liter'] or None
-            if engine_liters:
-                engine_liters = Decimal(engine_liters)
-            engine_code = fitment_row['engdesg'] or None
-            # This only accounts for T and S enumeration for aspiration, I am not sure if there are others
-            aspiration = 'N/A'
-            if fitment_row['asp'] == 'S':
-                aspiration = 'Supercharged'
-            elif fitment_row['asp'] == 'T':
-                aspiration = 'Turbocharged'
-            fuel_type = fitment_row['fuel']
-            fuel_delivery = fitment_row['fueldel']
-            engine_key = engine_configuration + str(engine_liters or '') + fuel_type + fuel_delivery + (engine_code or '') + aspiration
-
-            self.engine_storage['configurations'].add(engine_configuration)
-            if engine_code:
-                self.engine_storage['engine_codes'].add(engine_code)
+        engine_key, engine_object = self.get_engine_data(fitment_row)
+        if engine_key:
+            self.engine_storage['configurations'].add(engine_object['configuration'])
+            if engine_object['engine_code']:
+                self.engine_storage['engine_codes'].add(engine_object['engine_code'])
             if engine_key not in self.engine_storage['storage_objects']:
-                self.engine_storage['storage_objects'][engine_key] = {
-                    'configuration': engine_configuration,
-                    'liters': engine_liters,
-                    'engine_code': engine_code,
-                    'fuel_type': fuel_type,
-                    'fuel_delivery': fuel_delivery,
-                    'aspiration': aspiration
-                }
+                self.engine_storage['storage_objects'][engine_key] = engine_object
         return engine_key
 
+    @staticmethod
+    def get_engine_data(fitment_row):
+        """
+        Returns:
+            The engine key and engine storage object for a fitment row, both None when the row has no engine
+        """
+        engine_configuration = fitment_row['engtype']
+        if not engine_configuration:
+            return None, None
+        engine_liters = fitment_row['liter']
+        # the reader may already have converted liters, a converted Decimal('0') still counts as a value
+        engine_liters = None if engine_liters in ('', None) else Decimal(engine_liters)
+        engine_code = fitment_row['engdesg'] or None
+        # This only accounts for T and S enumeration for aspiration, I am not sure if there are others
+        aspiration = 'N/A'
+        if fitment_row['asp'] == 'S':
+            aspiration = 'Supercharged'
+        elif fitment_row['asp'] == 'T':
+            aspiration = 'Turbocharged'
+        fuel_type = fitment_row['fuel']
+        fuel_delivery = fitment_row['fueldel']
+        engine_key = engine_configuration + str(engine_liters or '') + fuel_type + fuel_delivery + (engine_code or '') + aspiration
+        return engine_key, {
+            'configuration': engine_configuration,
+            'liters': engine_liters,
+            'engine_code': engine_code,
+            'fuel_type': fuel_type,
+            'fuel_delivery': fuel_delivery,
+            'aspiration': aspiration
+        }
+
     def _parse_vehicle_data(self, fitment_row, make, make_key, model, model_key, sub_model, sub_model_key, engine_key):
         vehicle_key = make + model + (sub_model or '') + (engine_key or '')
         vehicle_year = int(fitment_row['year'])
@@ -498,3 +1243,221 @@ class ParsedProductFitment(object):
                         end_year = year
                         add_new_fitment_key(fitment, fitment_data.copy(), vehicle_key, start_year, end_year)
                     prev_year = year
+        self.set_fitment_digests()
+
+    def set_fitment_digests(self):
+        """
+        Digests the consolidated fitment of every part, once the years have been turned into ranges.
+        Storage compares them with the digest stored on the product to skip parts whose fitment has not changed without reading their fitment rows.
+        """
+        for part_number, fitment in self.part_fitment_storage['storage_objects'].items():
+            fitment_values = sorted((fitment_data['vehicle'], fitment_data['start_year'], fitment_data['end_year'], fitment_data['fitment_info_1'] or '', fitment_data['fitment_info_2'] or '') for fitment_data in fitment.values())
+            self.fitment_digests[part_number] = hashlib.sha1(json.dumps(fitment_values).encode("utf-8")).hexdigest()
+
+
+class ColumnarFitmentNormaliser(object):
+    """
+    Columnar alternative to consolidating rows one at a time through ParsedProductFitment.parse_fitment_row.
+    Rows are collected into batches of whole chunks.  The only work done per row is factorizing its vehicle and fitment note columns into an integer code,
+    keys are then built once per distinct combination and rows are grouped, and split into contiguous year ranges, with array operations on the codes.
+    The ParsedProductFitment objects produced hold the same storage objects, split into the same chunks, as consolidate_fitment_rows.
+    """
+    name = "columnar"
+    # everything consolidated from a row besides the part number and year
+    combination_columns = ('make', 'model', 'submodel', 'engtype', 'liter', 'fuel', 'fueldel', 'asp', 'engdesg', 'vqdescr', 'fndescr')
+    engine_columns = ('engtype', 'liter', 'fuel', 'fueldel', 'asp', 'engdesg')
+
+    def __init__(self, brand_record, part_fitment_chunks, chunks_per_batch=100):
+        """
+        Args:
+            brand_record: Brand the fitment belongs to
+            part_fitment_chunks: Number of parts per ParsedProductFitment
+            chunks_per_batch: Number of ParsedProductFitment worth of rows vectorised at a time
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for the columnar fitment normaliser")
+        self.brand_record = brand_record
+        self.part_fitment_chunks = part_fitment_chunks
+        self.parts_per_batch = part_fitment_chunks * chunks_per_batch
+        self.column_index = {column: idx for idx, column in enumerate(AcesFileParser.fitment_columns)}
+
+    def get_fitment_data(self, fitment_values):
+        """
+        Args:
+            fitment_values: Rows grouped by part number, each row indexable by position in AcesFileParser.fitment_columns order
+        Returns:
+            A generator of ParsedProductFitment
+        """
+        part_index, year_index = self.column_index['exppartno'], self.column_index['year']
+        batch_rows = list()
+        num_parts, previous_part, part_has_fitment = 0, None, False
+        for row in fitment_values:
+            part_number = row[part_index]
+            if part_number != previous_part:
+                # only parts with fitment count towards a chunk, a batch always ends on a chunk boundary
+                if num_parts == self.parts_per_batch:
+                    yield from self._normalise_batch(batch_rows)
+                    batch_rows = list()
+                    num_parts = 0
+                previous_part, part_has_fitment = part_number, False
+            if not part_has_fitment and row[year_index] != 'ALL':
+                part_has_fitment = True
+                num_parts += 1
+            batch_rows.append(row)
+        if batch_rows:
+            yield from self._normalise_batch(batch_rows)
+
+    def _normalise_batch(self, batch_rows):
+        column_index = self.column_index
+        part_index, year_index = column_index['exppartno'], column_index['year']
+        fitment_rows = [row for row in batch_rows if row[year_index] != 'ALL']
+        num_rows = len(fitment_rows)
+        if not num_rows:
+            return list()
+        combination_lookup = dict()
+        get_combination = operator.itemgetter(*[column_index[column] for column in self.combination_columns])
+        row_combination_codes = numpy.fromiter((combination_lookup.setdefault(get_combination(row), len(combination_lookup)) for row in fitment_rows), dtype=numpy.int64, count=num_rows)
+        years = numpy.fromiter((int(row[year_index]) for row in fitment_rows), dtype=numpy.int64, count=num_rows)
+        part_numbers = [row[part_index] for row in fitment_rows]
+        # rows are grouped by part, so a part's code is its position in the batch
+        part_starts = numpy.ones(num_rows, dtype=bool)
+        part_starts[1:] = numpy.fromiter(map(operator.ne, part_numbers[1:], part_numbers[:-1]), dtype=bool, count=num_rows - 1)
+        part_codes = numpy.cumsum(part_starts) - 1
+        chunk_codes = part_codes // self.part_fitment_chunks
+        del fitment_rows
+
+        # Keys are built once per distinct combination.  Different combinations can concatenate to the same key, so keys get their own codes
+        combinations = list(combination_lookup)
+        engine_data = dict()
+        key_lookups = {key_name: dict() for key_name in ('make', 'model', 'sub_model', 'engine', 'vehicle', 'fitment')}
+        combination_key_codes = {key_name: list() for key_name in key_lookups}
+        for combination in combinations:
+            make, model, sub_model, engine_configuration, liters, fuel_type, fuel_delivery, aspiration, engine_code, fitment_info_1, fitment_info_2 = combination
+            engine_values = (engine_configuration, liters, fuel_type, fuel_delivery, aspiration, engine_code)
+            if engine_values not in engine_data:
+                engine_data[engine_values] = ParsedProductFitment.get_engine_data(dict(zip(self.engine_columns, engine_values)))
+            engine_key = engine_data[engine_values][0] or ''
+            vehicle_key = make + model + sub_model + engine_key
+            combination_keys = (
+                ('make', make), ('model', make + model), ('sub_model', make + model + sub_model), ('engine', engine_key), ('vehicle', vehicle_key), ('fitment', vehicle_key + fitment_info_1 + fitment_info_2)
+            )
+            for key_name, key in combination_keys:
+                key_lookup = key_lookups[key_name]
+                combination_key_codes[key_name].append(key_lookup.setdefault(key, len(key_lookup)))
+        keys = {key_name: list(key_lookup) for key_name, key_lookup in key_lookups.items()}
+        row_key_codes = {key_name: numpy.array(key_codes, dtype=numpy.int64)[row_combination_codes] for key_name, key_codes in combination_key_codes.items()}
+        combination_codes = row_combination_codes.tolist()
+
+        def get_first_combinations(key_name, combination_filter=None):
+            row_filter = None if combination_filter is None else numpy.array([combination_filter(combination) for combination in combinations], dtype=bool)[row_combination_codes]
+            for chunk_code, key_code, row_idx in self._get_first_rows(chunk_codes, row_key_codes[key_name], row_filter):
+                yield parsed_chunks[chunk_code], keys[key_name][key_code], combinations[combination_codes[row_idx]]
+
+        parsed_chunks = [ParsedProductFitment(self.brand_record) for _ in range(int(chunk_codes[-1]) + 1)]
+        for parsed_chunk, make_key, combination in get_first_combinations('make'):
+            parsed_chunk.make_storage['makes'].add(combination[0])
+            parsed_chunk.make_storage['storage_objects'][make_key] = {
+                'name': combination[0]
+            }
+        for parsed_chunk, model_key, combination in get_first_combinations('model'):
+            parsed_chunk.model_storage['models'].add(combination[1])
+            parsed_chunk.model_storage['storage_objects'][model_key] = {
+                'name': combination[1],
+                'make': combination[0]
+            }
+        for parsed_chunk, sub_model_key, combination in get_first_combinations('sub_model', operator.itemgetter(2)):
+            parsed_chunk.sub_model_storage['sub_models'].add(combination[2])
+            parsed_chunk.sub_model_storage['storage_objects'][sub_model_key] = {
+                'name': combination[2],
+                'model': combination[0] + combination[1]
+            }
+        for parsed_chunk, engine_key, combination in get_first_combinations('engine', operator.itemgetter(3)):
+            engine_object = engine_data[combination[3:9]][1]
+            parsed_chunk.engine_storage['configurations'].add(engine_object['configuration'])
+            if engine_object['engine_code']:
+                parsed_chunk.engine_storage['engine_codes'].add(engine_object['engine_code'])
+            # storage swaps lookups into the engine objects, every chunk needs its own copy
+            parsed_chunk.engine_storage['storage_objects'][engine_key] = engine_object.copy()
+        for parsed_chunk, vehicle_key, combination in get_first_combinations('vehicle'):
+            make, model, sub_model = combination[:3]
+            parsed_chunk.vehicle_storage['storage_objects'][vehicle_key] = {
+                'make': make,
+                'model': make + model,
+                'sub_model': make + model + sub_model if sub_model else None,
+                'engine': engine_data[combination[3:9]][0],
+                'years': set()
+            }
+
+        min_year = int(years.min())
+        chunk_vehicle_codes, vehicle_radix = self._combine(chunk_codes, row_key_codes['vehicle'])
+        chunk_vehicle_years, year_radix = self._combine(chunk_vehicle_codes, years - min_year)
+        chunk_vehicle_years = numpy.unique(chunk_vehicle_years)
+        chunk_vehicle_codes = chunk_vehicle_years // year_radix
+        vehicle_years = zip((chunk_vehicle_codes // vehicle_radix).tolist(), (chunk_vehicle_codes % vehicle_radix).tolist(), (chunk_vehicle_years % year_radix + min_year).tolist())
+        vehicle_keys = keys['vehicle']
+        for chunk_code, vehicle_key_code, year in vehicle_years:
+            parsed_chunks[chunk_code].vehicle_storage['storage_objects'][vehicle_keys[vehicle_key_code]]['years'].add(year)
+
+        self._add_fitment_ranges(parsed_chunks, part_codes, part_numbers, row_key_codes['fitment'], keys['fitment'], years, row_combination_codes, combinations, engine_data)
+        for parsed_chunk in parsed_chunks:
+            parsed_chunk.set_fitment_digests()
+        return parsed_chunks
+
+    def _add_fitment_ranges(self, parsed_chunks, part_codes, part_numbers, fitment_key_codes, fitment_keys, years, row_combination_codes, combinations, engine_data):
+        """
+        Same ranges as ParsedProductFitment._add_years_to_fitment_keys, a range ends wherever the next year of the part's fitment is not the year after
+        """
+        min_year = int(years.min())
+        part_fitment_codes, fitment_radix = self._combine(part_codes, fitment_key_codes)
+        distinct_part_fitment_codes, part_fitment_rows = numpy.unique(part_fitment_codes, return_index=True)
+        part_fitment_years, year_radix = self._combine(part_fitment_codes, years - min_year)
+        # sorted by part, then fitment key, then year
+        part_fitment_years = numpy.unique(part_fitment_years)
+        part_fitment_codes = part_fitment_years // year_radix
+        fitment_years = part_fitment_years % year_radix + min_year
+        range_starts = numpy.ones(len(part_fitment_years), dtype=bool)
+        range_starts[1:] = (part_fitment_codes[1:] != part_fitment_codes[:-1]) | (fitment_years[1:] - fitment_years[:-1] != 1)
+        start_positions = numpy.flatnonzero(range_starts)
+        end_positions = numpy.append(start_positions[1:], len(part_fitment_years)) - 1
+        range_part_fitment_codes = part_fitment_codes[start_positions]
+        range_rows = part_fitment_rows[numpy.searchsorted(distinct_part_fitment_codes, range_part_fitment_codes)]
+        fitment_ranges = zip(
+            (range_part_fitment_codes // fitment_radix).tolist(), (range_part_fitment_codes % fitment_radix).tolist(), range_rows.tolist(),
+            row_combination_codes[range_rows].tolist(), fitment_years[start_positions].tolist(), fitment_years[end_positions].tolist()
+        )
+        for part_code, fitment_key_code, row_idx, combination_code, start_year, end_year in fitment_ranges:
+            part_number = part_numbers[row_idx]
+            combination = combinations[combination_code]
+            part_storage = parsed_chunks[part_code // self.part_fitment_chunks].part_fitment_storage['storage_objects']
+            if part_number not in part_storage:
+                part_storage[part_number] = dict()
+            part_storage[part_number][str(start_year) + str(end_year) + fitment_keys[fitment_key_code]] = {
+                'product': part_number,
+                'vehicle': combination[0] + combination[1] + combination[2] + (engine_data[combination[3:9]][0] or ''),
+                'fitment_info_1': combination[9] or None,
+                'fitment_info_2': combination[10] or None,
+                'start_year': start_year,
+                'end_year': end_year
+            }
+
+    @staticmethod
+    def _combine(high_codes, low_codes):
+        """
+        Returns:
+            A single code for every (high, low) pair that sorts the same way as the pair, and the radix to split it back up with
+        """
+        radix = int(low_codes.max()) + 1
+        return high_codes.astype(numpy.int64) * radix + low_codes, radix
+
+    @classmethod
+    def _get_first_rows(cls, group_codes, key_codes, row_filter=None):
+        """
+        Returns:
+            (group code, key code, first row) for every distinct key within a group, optionally only considering the rows in row_filter
+        """
+        row_indexes = numpy.arange(len(group_codes)) if row_filter is None else numpy.flatnonzero(row_filter)
+        if not len(row_indexes):
+            return list()
+        group_key_codes, key_radix = cls._combine(group_codes[row_indexes], key_codes[row_indexes])
+        group_key_codes, first_rows = numpy.unique(group_key_codes, return_index=True)
+        return zip((group_key_codes // key_radix).tolist(), (group_key_codes % key_radix).tolist(), row_indexes[first_rows].tolist())
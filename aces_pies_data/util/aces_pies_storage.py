@@ -1,12 +1,19 @@
-import csv
 from timeit import default_timer as timer
 from django.db import transaction
-
-from aces_pies_data.models import DigitalAssetType, DigitalAsset, Brand, Product, Category, ProductFeature, Attribute, AttributeValue, ProductAttribute, ProductDigitalAsset, ProductPackaging, ProductFitment, VehicleMake, VehicleModel, VehicleSubModel, FuelType, \
-    FuelDelivery, EngineAspiration, VehicleEngine, Vehicle, VehicleYear, ProductCategoryLookup
-from aces_pies_data.util.data_retriever import DataRetriever
+from django.utils import timezone
+
+from aces_pies_data.models import DigitalAssetType, DigitalAsset, Brand, Product, Category, ProductFeature, Attribute, AttributeValue, ProductAttribute, ProductDigitalAsset, ProductPackaging, ProductFitment, FuelType, FuelDelivery, \
+    EngineAspiration, VehicleYear, ProductCategoryLookup
+from aces_pies_data.util.aces_pies_parsing import get_product_fingerprint
+from aces_pies_data.util.bulk_loader import BulkLoader
+from aces_pies_data.util.data_retriever import DataRetriever, UpsertDataRetriever
+from aces_pies_data.util.dci_pipe_reader import DciPipeReader
+from aces_pies_data.util.pies_import_session import PiesImportSession
+from aces_pies_data.util.pipeline import PipelinedIterator, iter_chunks
+from aces_pies_data.util.query_counter import QueryCounter
+from aces_pies_data.util.shared_tables_lock import lock_shared_tables
+from aces_pies_data.util.vehicle_dimension_cache import VehicleDimensionCache
 import logging
-from django.db.models import Q
 
 pies_logger = logging.getLogger("PiesDataStorage")
 pies_flat_logger = logging.getLogger("PiesFlatDataStorage")
@@ -14,11 +21,27 @@ aces_logger = logging.getLogger("AcesDataStorage")
 
 
 class PiesDataStorage(object):
-    def __init__(self, brand_data):
+    def __init__(self, brand_data, bulk_load_engine="copy", pipeline_queue_size=0, checkpoint=None):
+        """
+        Args:
+            brand_data: Brand data as returned by PiesFileParser.get_brand_data
+            bulk_load_engine: copy or bulk_create, see BulkLoader
+            pipeline_queue_size: Chunks parsed ahead in a producer thread while a chunk is stored, 0 parses and stores in lockstep
+            checkpoint: ImportCheckpoint of the file, chunks it has committed are skipped and every stored chunk is committed to it
+        """
         self.brand_data = brand_data
+        self.pipeline_queue_size = pipeline_queue_size
+        self.checkpoint = checkpoint
+        self.bulk_loader = BulkLoader(bulk_load_engine)
+        self.chunk_query_counts = list()
+        self.relation_query_counts = list()
+        self.product_stats = {
+            'unchanged': 0,
+            'updated': 0,
+            'created': 0
+        }
         self.brand_records = dict()
-        self.category_records = dict()
-        self.digital_asset_type_records = dict()
+        self.import_session = None
 
         for brand_record in Brand.objects.all():
             self.brand_records[brand_record.name] = brand_record
@@ -26,42 +49,69 @@ class PiesDataStorage(object):
     def store_brand_data(self, on_complete=None):
         pies_logger.info("Storing pies product data for brand {}".format(self.brand_data['brand']))
         begin_timer = timer()
+        self.import_session = PiesImportSession(self.brand_data['brand_short_name'])
         brand_record = self._get_brand_record(self.brand_data)
-        products = list()
         num_products_to_store = 50
-        for product_data in self.brand_data['product_data']:
-            products.append(product_data)
-            if len(products) == num_products_to_store:
-                self._store_products(products, brand_record)
-                products = list()
-        if len(products) > 0:
-            self._store_products(products, brand_record)
+        product_chunks = iter_chunks(self.brand_data['product_data'], num_products_to_store)
+        if self.checkpoint:
+            product_chunks = self.checkpoint.skip_committed(product_chunks, lambda products: products[-1]['part_number'])
+        if self.pipeline_queue_size:
+            product_chunks = PipelinedIterator(product_chunks, self.pipeline_queue_size, f"pies {self.brand_data['brand_short_name']}")
+        for products in product_chunks:
+            self._store_chunk(products, brand_record)
         if on_complete:
             on_complete()
+        pies_logger.info(f"Products for {self.brand_data['brand']}: {self.product_stats['unchanged']} unchanged, {self.product_stats['updated']} updated, {self.product_stats['created']} created")
+        self.bulk_loader.log_stats(pies_logger)
         pies_logger.info('Total time for {0}: {1}'.format(self.brand_data['brand'], timer() - begin_timer))
 
+    def _store_chunk(self, products, brand_record):
+        with QueryCounter() as query_counter:
+            self._store_products(products, brand_record)
+        self.chunk_query_counts.append(query_counter.num_queries)
+        pies_logger.info(f"Stored {len(products)} products in {query_counter.num_queries} queries")
+
     @transaction.atomic
     def _store_products(self, products, brand_record):
-        products_to_create = {product['part_number']: product for product in products}
+        lock_shared_tables()
+        products_to_create = dict()
+        for product_data in products:
+            product_data['fingerprint'] = get_product_fingerprint(product_data)
+            if self.import_session.is_unchanged(product_data):
+                self.product_stats['unchanged'] += 1
+            else:
+                products_to_create[product_data['part_number']] = product_data
         products_to_update = dict()
-        part_categories_lookup = dict()
-        if not ProductCategoryLookup.objects.filter(brand_short_name=self.brand_data['brand_short_name']).exists():
-            raise RuntimeError("Cannot parse pies data if no pies categories have been stored")
-
-        part_categories_queryset = ProductCategoryLookup.objects.filter(part_number__in=products_to_create.keys(), brand_short_name=self.brand_data['brand_short_name']).select_related("category")
-        for part_category in part_categories_queryset:
-            part_categories_lookup[part_category.part_number] = part_category.category
-
-        existing_product_records = Product.objects.filter(part_number__in=products_to_create.keys(), brand=brand_record).prefetch_related('features').prefetch_related('attributes').prefetch_related('attributes__attribute').prefetch_related('attributes__value').prefetch_related(
-            'packages').prefetch_related('digital_assets').prefetch_related('digital_assets__digital_asset').prefetch_related('digital_assets__digital_asset__type').all()
+        changed_fields = set()
+        relation_ids_to_delete = dict()
+        part_categories_lookup = self.import_session.get_part_categories(products_to_create.keys())
+        existing_product_ids = self.import_session.get_product_ids(products_to_create.keys())
+        existing_product_records = list()
+        if existing_product_ids:
+            existing_product_records = Product.objects.filter(id__in=existing_product_ids).select_related('category').prefetch_related('features').prefetch_related('attributes').prefetch_related('attributes__attribute').prefetch_related(
+                'attributes__value').prefetch_related('packages').prefetch_related('digital_assets').prefetch_related('digital_assets__digital_asset').all()
+        fingerprint_records = list()
         for existing_product_record in existing_product_records:
             product_data_to_update = products_to_create.pop(existing_product_record.part_number)
-            if self._prepare_for_update(product_data_to_update, existing_product_record, part_categories_lookup):
+            fingerprint = product_data_to_update['fingerprint']
+            if self._prepare_for_update(product_data_to_update, existing_product_record, part_categories_lookup, changed_fields, relation_ids_to_delete):
                 products_to_update[existing_product_record.part_number] = product_data_to_update
+            else:
+                self.product_stats['unchanged'] += 1
+                # a product stored before fingerprints, or with an older way of taking them, only needs its fingerprint written
+                if existing_product_record.fingerprint != fingerprint:
+                    fingerprint_records.append(existing_product_record)
+            existing_product_record.fingerprint = fingerprint
+        self.product_stats['updated'] += len(products_to_update)
+        if fingerprint_records:
+            Product.objects.bulk_update(fingerprint_records, ['fingerprint'])
         if len(products_to_create):
             self._bulk_create_products(products_to_create, brand_record, part_categories_lookup)
         if len(products_to_update):
-            self._bulk_update_products(products_to_update)
+            changed_fields.add('fingerprint')
+            self._bulk_update_products(products_to_update, changed_fields, relation_ids_to_delete)
+        if self.checkpoint:
+            self.checkpoint.commit(products[-1]['part_number'])
 
     def _bulk_create_products(self, product_lookup, brand_record, part_categories_lookup):
         products_to_create = list()
@@ -71,24 +121,52 @@ class PiesDataStorage(object):
                     Product(
                         part_number=product_data['part_number'], name=product_data['name'], is_hazardous=product_data['is_hazardous'], is_carb_legal=product_data['is_carb_legal'], is_discontinued=product_data['is_discontinued'],
                         is_obsolete=product_data['is_obsolete'], map_price=product_data['map_price'], retail_price=product_data['retail_price'], brand=brand_record, category=part_categories_lookup.get(product_data['part_number'], None),
-                        is_superseded=product_data['is_superseded'], superseded_by=product_data['superseded_by']
+                        is_superseded=product_data['is_superseded'], superseded_by=product_data['superseded_by'], fingerprint=product_data['fingerprint']
                     )
                 )
             else:
                 pies_logger.warning(f"No category info found for {product_data['part_number']} for brand {self.brand_data['brand']}, skipping")
         if products_to_create:
-            Product.objects.bulk_create(products_to_create)
-            created_products = Product.objects.filter(part_number__in=product_lookup.keys(), brand=brand_record).all()
+            created_products = Product.objects.bulk_create(products_to_create)
+            if any(created_product.id is None for created_product in created_products):
+                # backends that cannot return ids from a bulk insert
+                created_products = Product.objects.filter(part_number__in=product_lookup.keys(), brand=brand_record).select_related('category')
+            self.import_session.add_products(created_products)
+            self.product_stats['created'] += len(products_to_create)
             for created_product in created_products:
                 product_lookup[created_product.part_number]['product_record'] = created_product
             # filter out any product data that didn't create an actual record.  This can happen if category is missing.
             product_lookup = {part_number: product_data for part_number, product_data in product_lookup.items() if 'product_record' in product_data}
             self._bulk_create_relationships(product_lookup)
 
-    def _bulk_update_products(self, product_lookup):
-        for part_number, product_data in product_lookup.items():
-            product_data['product_record'].save()
-        self._bulk_create_relationships(product_lookup)
+    def _bulk_update_products(self, product_lookup, changed_fields, relation_ids_to_delete):
+        """
+        Writes the changed products of a chunk with one UPDATE of only the columns that changed in any of them.
+        bulk_update skips auto_now, so updated_on is set here.
+        """
+        if changed_fields:
+            now = timezone.now()
+            product_records = [product_data['product_record'] for product_data in product_lookup.values()]
+            for product_record in product_records:
+                product_record.updated_on = now
+            Product.objects.bulk_update(product_records, sorted(changed_fields) + ['updated_on'])
+        with QueryCounter() as query_counter:
+            self._delete_relationships(relation_ids_to_delete)
+            self._bulk_create_relationships(product_lookup)
+        self.relation_query_counts.append(query_counter.num_queries)
+        pies_logger.info(f"Applied relation changes of {len(product_lookup)} products in {query_counter.num_queries} queries")
+
+    def _delete_relationships(self, relation_ids_to_delete):
+        """
+        Deletes the relation rows that are gone from the updated products of a chunk, one statement per relation.
+        Attributes of the deleted rows that no product uses any more are removed with them.
+        """
+        for relation_model, ids_to_delete in relation_ids_to_delete.items():
+            if relation_model is not Attribute:
+                relation_model.objects.filter(id__in=ids_to_delete).delete()
+        attribute_ids = relation_ids_to_delete.get(Attribute)
+        if attribute_ids:
+            Attribute.objects.filter(id__in=attribute_ids).exclude(id__in=ProductAttribute.objects.filter(attribute_id__in=attribute_ids).values("attribute_id")).delete()
 
     def _bulk_create_relationships(self, product_lookup):
         self._bulk_create_features(product_lookup)
@@ -96,9 +174,13 @@ class PiesDataStorage(object):
         self._bulk_create_digital_assets(product_lookup)
         self._bulk_create_packaging(product_lookup)
 
-    def _prepare_for_update(self, product_data, product_record, part_categories_lookup):
+    def _prepare_for_update(self, product_data, product_record, part_categories_lookup, changed_fields, relation_ids_to_delete):
         product_change_manager = ProductChangeManager(product_record)
         do_update = product_change_manager.prepare_for_update(product_data, part_categories_lookup)
+        if do_update:
+            changed_fields.update(product_change_manager.changed_fields)
+            for relation_model, ids_to_delete in product_change_manager.relation_ids_to_delete.items():
+                relation_ids_to_delete.setdefault(relation_model, list()).extend(ids_to_delete)
         product_data['product_record'] = product_record
         return do_update
 
@@ -108,6 +190,9 @@ class PiesDataStorage(object):
             features = product_data['features']
             if features:
                 for idx, feature in enumerate(features):
+                    if feature is None:
+                        # already stored, see ProductChangeManager
+                        continue
                     features_to_create.append(ProductFeature(name=feature, listing_sequence=idx, product=product_data['product_record']))
         if features_to_create:
             ProductFeature.objects.bulk_create(features_to_create)
@@ -126,22 +211,22 @@ class PiesDataStorage(object):
                 for attribute in attributes:
                     attribute_names.add(attribute['type'])
                     attribute_values.add(attribute['value'])
-                    attribute_key = category_record.name + attribute['type']
+                    attribute_key = (category_record.name, attribute['type'])
                     attribute_objects[attribute_key] = {
                         'name': attribute['type'],
-                        'category': category_record
+                        'category_id': category_record.id
                     }
-                    attribute_value_key = attribute_key + attribute['value']
+                    attribute_value_key = attribute_key + (attribute['value'],)
                     attribute_value_objects[attribute_value_key] = {
                         'value': attribute['value'],
                         'attribute': attribute_key
                     }
         if attribute_objects:
-            attribute_retriever = DataRetriever(Attribute, Attribute.objects.filter(name__in=attribute_names, category__in=category_records).select_related('category'), ('category__name', 'name',))
+            attribute_retriever = UpsertDataRetriever(Attribute, Attribute.objects.filter(name__in=attribute_names, category__in=category_records), ('category_id', 'name',))
             attribute_records = attribute_retriever.bulk_get_or_create(attribute_objects)
             for attribute_value_config in attribute_value_objects.values():
                 attribute_value_config['attribute_id'] = attribute_records[attribute_value_config.pop('attribute')]
-            attribute_value_retriever = DataRetriever(AttributeValue, AttributeValue.objects.filter(value__in=attribute_values, attribute_id__in=attribute_records.values()).select_related('attribute').select_related('attribute__category'), ('attribute__category__name', 'attribute__name', 'value',))
+            attribute_value_retriever = UpsertDataRetriever(AttributeValue, AttributeValue.objects.filter(value__in=attribute_values, attribute_id__in=attribute_records.values()), ('attribute_id', 'value',))
             attribute_value_records = attribute_value_retriever.bulk_get_or_create(attribute_value_objects)
             product_attributes_to_create = list()
             for product_data in product_lookup.values():
@@ -151,11 +236,10 @@ class PiesDataStorage(object):
                     category_record = product_record.category
                     category_name = category_record.name
                     for attribute in attributes:
-                        attribute_id = attribute_records.get(category_name + attribute['type'])
-                        attribute_value_id = attribute_value_records.get(category_name + attribute['type'] + attribute['value'])
-                        product_attributes_to_create.append(ProductAttribute(attribute_id=attribute_id, value_id=attribute_value_id, product=product_record))
-            if product_attributes_to_create:
-                ProductAttribute.objects.bulk_create(product_attributes_to_create)
+                        attribute_id = attribute_records.get((category_name, attribute['type']))
+                        attribute_value_id = attribute_value_records.get((category_name, attribute['type'], attribute['value']))
+                        product_attributes_to_create.append((attribute_id, attribute_value_id, product_record.id))
+            self.bulk_loader.load(ProductAttribute, ('attribute_id', 'value_id', 'product_id'), product_attributes_to_create)
 
     def _bulk_create_digital_assets(self, product_lookup):
         product_assets_to_create = list()
@@ -165,17 +249,17 @@ class PiesDataStorage(object):
 
         def _append_digital_asset(_part_number, _asset, _digital_asset_type_record):
             urls.add(_asset['url'])
-            digital_asset_key = _asset['url'] + _digital_asset_type_record.name
-            digital_asset_objects[digital_asset_key] = {
-                'url': _asset['url'],
-                'file_size_bytes': _asset['file_size_bytes'],
-                'type': _digital_asset_type_record
-            }
+            # A url is stored once whatever its type, the first type it is listed with is kept
+            if _asset['url'] not in digital_asset_objects:
+                digital_asset_objects[_asset['url']] = {
+                    'url': _asset['url'],
+                    'file_size_bytes': _asset['file_size_bytes'],
+                    'type_id': _digital_asset_type_record.id
+                }
             if _part_number not in product_asset_objects:
                 product_asset_objects[_part_number] = list()
             product_asset_objects[_part_number].append({
                 'url': _asset['url'],
-                'asset_type': _digital_asset_type_record.name,
                 'display_sequence': _asset['display_sequence']
             })
 
@@ -186,36 +270,28 @@ class PiesDataStorage(object):
                     digital_asset_type_record = self._get_digital_asset_type_record(digital_asset['asset_type'])
                     _append_digital_asset(product_data['part_number'], digital_asset, digital_asset_type_record)
         if urls:
-            digital_assets_retriever = DataRetriever(DigitalAsset, DigitalAsset.objects.filter(url__in=urls), ('url', 'type__name',))
+            digital_assets_retriever = UpsertDataRetriever(DigitalAsset, DigitalAsset.objects.filter(url__in=urls), ('url',))
             digital_asset_records = digital_assets_retriever.bulk_get_or_create(digital_asset_objects)
             for part_number, product_assets in product_asset_objects.items():
                 product_record = product_lookup[part_number]['product_record']
                 for product_asset in product_assets:
-                    digital_asset_id = digital_asset_records[product_asset['url'] + product_asset['asset_type']]
-                    product_assets_to_create.append(ProductDigitalAsset(digital_asset_id=digital_asset_id, display_sequence=product_asset['display_sequence'], product=product_record))
+                    digital_asset_id = digital_asset_records[product_asset['url']]
+                    product_assets_to_create.append((digital_asset_id, product_asset['display_sequence'], product_record.id))
 
-        if product_assets_to_create:
-            ProductDigitalAsset.objects.bulk_create(product_assets_to_create)
+        self.bulk_loader.load(ProductDigitalAsset, ('digital_asset_id', 'display_sequence', 'product_id'), product_assets_to_create)
 
     def _bulk_create_packaging(self, product_lookup):
         product_packaging_to_create = list()
-        db_col_override = {
-            'dimensionalweight': 'dimensional_weight'
-        }
         for product_data in product_lookup.values():
             product_packaging = product_data['packages']
             if product_packaging:
                 product_record = product_data['product_record']
                 for product_package in product_packaging:
-                    product_package_record = ProductPackaging(product=product_record, product_quantity=product_package['quantity'])
-                    for dimension_type, value in product_package.items():
-                        db_col = dimension_type
-                        if dimension_type in db_col_override:
-                            db_col = db_col_override['dimensionalweight']
-                        setattr(product_package_record, db_col, value)
-                    product_packaging_to_create.append(product_package_record)
-        if product_packaging_to_create:
-            ProductPackaging.objects.bulk_create(product_packaging_to_create)
+                    product_packaging_to_create.append((
+                        product_record.id, product_package['quantity'], product_package.get('weight'), product_package.get('dimensionalweight'), product_package.get('height'), product_package.get('length'),
+                        product_package.get('width')
+                    ))
+        self.bulk_loader.load(ProductPackaging, ('product_id', 'product_quantity', 'weight', 'dimensional_weight', 'height', 'length', 'width'), product_packaging_to_create)
 
     def _get_brand_record(self, brand_data):
         brand_name = brand_data['brand']
@@ -223,146 +299,184 @@ class PiesDataStorage(object):
         if brand_name not in self.brand_records:
             logo, marketing_copy = brand_data['logo'], brand_data['marketing_copy']
             digital_asset_record = None
-            if logo:
-                digital_asset_record = self._create_digital_asset(logo['url'], logo['file_size_bytes'], self._get_digital_asset_type_record('Brand Logo'))
-            self.brand_records[brand_name] = Brand.objects.create(name=brand_name, short_name=brand_short_name, logo=digital_asset_record, marketing_copy=marketing_copy)
+            with transaction.atomic():
+                lock_shared_tables()
+                if logo:
+                    digital_asset_record = self._create_digital_asset(logo['url'], logo['file_size_bytes'], self._get_digital_asset_type_record('Brand Logo'))
+                self.brand_records[brand_name] = Brand.objects.create(name=brand_name, short_name=brand_short_name, logo=digital_asset_record, marketing_copy=marketing_copy)
         return self.brand_records[brand_name]
 
     def _get_digital_asset_type_record(self, digital_asset_type):
-        if digital_asset_type not in self.digital_asset_type_records:
-            digital_asset_type_record = DigitalAssetType.objects.get_or_create(name=digital_asset_type)[0]
-            self.digital_asset_type_records[digital_asset_type] = digital_asset_type_record
-        return self.digital_asset_type_records[digital_asset_type]
+        digital_asset_type_records = self.import_session.digital_asset_types
+        if digital_asset_type not in digital_asset_type_records:
+            digital_asset_type_records[digital_asset_type] = DigitalAssetType.objects.get_or_create(name=digital_asset_type)[0]
+        return digital_asset_type_records[digital_asset_type]
 
     def _create_digital_asset(self, url, file_size_bytes, digital_asset_type_record):
-        return DigitalAsset.objects.create(url=url, file_size_bytes=file_size_bytes, type=digital_asset_type_record)
+        return DigitalAsset.objects.get_or_create(url=url, defaults={'file_size_bytes': file_size_bytes, 'type': digital_asset_type_record})[0]
 
 
 class ProductChangeManager(object):
+    """
+    Diffs the parsed data of a product against its stored record and prefetched relations in memory, without running any queries.
+    Scalar fields that differ are set on the record.  Relations are compared row by row: the relation fields of product_data are left with only the rows to insert,
+    and the ids of stored rows that are gone are collected in relation_ids_to_delete, so PiesDataStorage can apply a whole chunk with one statement per relation.
+    The names of the scalar fields that changed are collected in changed_fields.
+    """
     def __init__(self, product_record):
         self.product_record = product_record
+        self.changed_fields = list()
+        self.relation_ids_to_delete = dict()
 
     def prepare_for_update(self, product_data, part_categories_lookup):
         do_update = False
         related_fields = ('attributes', 'features', 'packages', 'digital_assets',)
-        ignore_fields = ('brand_name', 'product_record',)
+        # the fingerprint is written by PiesDataStorage for every product that was diffed, it is not a change on its own
+        ignore_fields = ('brand_name', 'product_record', 'fingerprint',)
         product_skip_fields = related_fields + ignore_fields
         for field, value in product_data.items():
             if field not in product_skip_fields and getattr(self.product_record, field) != value:
                 setattr(self.product_record, field, value)
+                self.changed_fields.append(field)
                 do_update = True
             elif field in related_fields:
-                perform_update = getattr(self, '_prepare_update_' + field)(value)
-                if perform_update:
+                relation_model, items_to_insert, ids_to_delete = getattr(self, '_diff_' + field)(value or list())
+                if ids_to_delete:
+                    self.relation_ids_to_delete[relation_model] = ids_to_delete
+                if items_to_insert or ids_to_delete:
                     do_update = True
-                if not perform_update:
-                    product_data[field] = None  # null out the field so it does not attempt to get inserted on the update
+                product_data[field] = items_to_insert  # only the new rows get inserted on the update
         category = part_categories_lookup.get(self.product_record.part_number, None)
         if category and self.product_record.category_id != category.id:
             raise NotImplementedError("Implementation needed if products change categories")
         return do_update
 
-    def _prepare_update_features(self, features):
-        prepare_update = self._are_there_differences(features, self.product_record.features, ('name',))
-        if prepare_update:
-            self.product_record.features.all().delete()
-        return prepare_update
-
-    def _prepare_update_attributes(self, attributes):
-        # compare all attributes, store actual attribute objects for potential delete later
-        attribute_records = list()
-        sorted_attributes = sorted(attributes, key=lambda row: (row['type'], row['value']))
-        num_attributes = len(sorted_attributes)
-        found_differences = num_attributes != self.product_record.attributes.count()
-
-        for idx, product_attribute in enumerate(self.product_record.attributes.all()):
-            if idx < num_attributes - 1:
-                sorted_attribute = sorted_attributes[idx]
-                attribute_records.append(product_attribute.attribute)
-                if product_attribute.attribute.name != sorted_attribute['type'] or product_attribute.value.value != sorted_attribute['value']:
-                    found_differences = True
-        if found_differences:
-            self.product_record.attributes.all().delete()
-            for attribute_record in attribute_records:
-                if not Product.objects.filter(attributes__attribute=attribute_record).exists():
-                    attribute_record.delete()
-        return found_differences
-
-    def _prepare_update_packages(self, packages):
-        keys_to_compare = ('weight', 'dimensionalweight', 'height', 'length', 'width',)
-        db_col_map = {
-            'dimensionalweight': 'dimensional_weight'
-        }
-        prepare_update = self._are_there_differences(packages, self.product_record.packages, keys_to_compare, db_col_map)
-        if prepare_update:
-            self.product_record.packages.all().delete()
-        return prepare_update
-
-    def _prepare_update_digital_assets(self, digital_assets):
-        sorted_new_digital_assets = sorted(digital_assets, key=lambda k: [k['display_sequence'], k['asset_type']])
-        sorted_db_digital_assets = list()
-
-        for digital_asset_record in self.product_record.digital_assets.all():
-            sorted_db_digital_assets.append({
-                'asset_type': digital_asset_record.digital_asset.type.name,
-                'display_sequence': digital_asset_record.display_sequence,
-                'file_size_bytes': digital_asset_record.digital_asset.file_size_bytes,
-                'url': digital_asset_record.digital_asset.url
-            })
-        sorted_db_digital_assets = sorted(sorted_db_digital_assets, key=lambda k: [k['display_sequence'], k['asset_type']])
-        found_differences = sorted_new_digital_assets != sorted_db_digital_assets
-        if found_differences:
-            self.product_record.digital_assets.all().delete()
-        return found_differences
-
-    def _are_there_differences(self, data, queryset, keys_to_compare, db_col_map=None):
-        if not db_col_map:
-            db_col_map = dict()
-        found_differences = False
-        num_existing_data = queryset.count()
-        if num_existing_data != len(data):
-            found_differences = True
-        else:
-            for idx, existing_data_item in enumerate(queryset.all()):
-                new_item = data[idx]
-                for key in keys_to_compare:
-                    db_col = key
-                    if key in db_col_map:
-                        db_col = db_col_map[key]
-                    if isinstance(new_item, dict):
-                        val_to_compare = new_item.get(key, None)
-                    else:
-                        val_to_compare = new_item
-                    if getattr(existing_data_item, db_col) != val_to_compare:
-                        found_differences = True
-                        break
-        return found_differences
+    def _diff_features(self, features):
+        # listing_sequence is the position in the list, features that are already stored are left as None so the rest keep their position
+        relation_items = [(listing_sequence, feature) for listing_sequence, feature in enumerate(features)]
+        items_to_insert, ids_to_delete = self._diff_relation(relation_items, self.product_record.features.all(), lambda feature: (feature.listing_sequence, feature.name))
+        items_to_insert = set(items_to_insert)
+        features_to_insert = [feature if (listing_sequence, feature) in items_to_insert else None for listing_sequence, feature in relation_items] if items_to_insert else list()
+        return ProductFeature, features_to_insert, ids_to_delete
+
+    def _diff_attributes(self, attributes):
+        items_to_insert, ids_to_delete = self._diff_relation(
+            attributes, self.product_record.attributes.all(), lambda product_attribute: (product_attribute.attribute.name, product_attribute.value.value), lambda attribute: (attribute['type'], attribute['value'])
+        )
+        if ids_to_delete:
+            # attributes of the removed rows are deleted once no product uses them
+            removed_ids = set(ids_to_delete)
+            self.relation_ids_to_delete[Attribute] = [product_attribute.attribute_id for product_attribute in self.product_record.attributes.all() if product_attribute.id in removed_ids]
+        return ProductAttribute, items_to_insert, ids_to_delete
+
+    def _diff_packages(self, packages):
+        keys_to_compare = ('quantity', 'weight', 'dimensionalweight', 'height', 'length', 'width',)
+        db_cols_to_compare = ('product_quantity', 'weight', 'dimensional_weight', 'height', 'length', 'width',)
+        items_to_insert, ids_to_delete = self._diff_relation(
+            packages, self.product_record.packages.all(), lambda package: tuple(getattr(package, db_col) for db_col in db_cols_to_compare), lambda package: tuple(package.get(key) for key in keys_to_compare)
+        )
+        return ProductPackaging, items_to_insert, ids_to_delete
+
+    def _diff_digital_assets(self, digital_assets):
+        # type and file size belong to the shared digital asset, a url is stored once, so a product asset is only replaced when its url or position change
+        items_to_insert, ids_to_delete = self._diff_relation(
+            digital_assets, self.product_record.digital_assets.all(), lambda product_asset: (product_asset.digital_asset.url, product_asset.display_sequence),
+            lambda digital_asset: (digital_asset['url'], digital_asset['display_sequence'])
+        )
+        return ProductDigitalAsset, items_to_insert, ids_to_delete
+
+    @staticmethod
+    def _diff_relation(new_items, stored_records, get_stored_key, get_new_key=None):
+        """
+        Matches new items to stored records by key, as multisets so repeated rows are matched one for one.
+        Args:
+            new_items: Parsed rows of the relation
+            stored_records: Prefetched records of the relation
+            get_stored_key: Returns the comparison key of a stored record
+            get_new_key: Returns the comparison key of a new item, None uses the item itself
+        Returns:
+            The new items that are not stored and the ids of the stored records that are not in new_items
+        """
+        stored_ids = dict()
+        for stored_record in stored_records:
+            stored_ids.setdefault(get_stored_key(stored_record), list()).append(stored_record.id)
+        items_to_insert = list()
+        for new_item in new_items:
+            matching_ids = stored_ids.get(get_new_key(new_item) if get_new_key else new_item)
+            if matching_ids:
+                matching_ids.pop()
+            else:
+                items_to_insert.append(new_item)
+        ids_to_delete = [stored_id for matching_ids in stored_ids.values() for stored_id in matching_ids]
+        return items_to_insert, ids_to_delete
 
 
 class AcesDataStorage(object):
-    def __init__(self, aces_file_parser):
+    def __init__(self, aces_file_parser, bulk_load_engine="copy", fitment_diff="python", pipeline_queue_size=0, checkpoint=None):
+        """
+        Args:
+            aces_file_parser: AcesFileParser or CachedAcesFileParser of the file to store
+            bulk_load_engine: copy or bulk_create, see BulkLoader
+            fitment_diff: python compares the stored fitment of changed parts in dicts, set replaces it with a set diff in the database through BulkLoader.sync
+            pipeline_queue_size: Fitment chunks parsed ahead in a producer thread while a chunk is stored, 0 parses and stores in lockstep
+            checkpoint: ImportCheckpoint of the file, chunks it has committed are skipped and every stored chunk is committed to it
+        """
         self.aces_file_parser = aces_file_parser
+        self.pipeline_queue_size = pipeline_queue_size
+        self.checkpoint = checkpoint
+        self.fitment_diff = fitment_diff
+        self.bulk_loader = BulkLoader(bulk_load_engine)
+        self.dimension_cache = VehicleDimensionCache()
         self.fuel_type_lookup = dict()
         self.fuel_delivery_lookup = dict()
         self.aspiration_lookup = dict()
+        self.fitment_stats = {
+            'unchanged_parts': 0,
+            'changed_parts': 0,
+            'inserted': 0,
+            'deleted': 0
+        }
 
     def store_brand_fitment(self, on_complete=None):
         aces_logger.info(f'Storing aces fitment for brand {self.aces_file_parser.brand_record.name}')
         begin_timer = timer()
-        for fitment_data in self.aces_file_parser.get_fitment_data(30):
+        fitment_chunks = self.aces_file_parser.get_fitment_data(30)
+        if self.checkpoint:
+            fitment_chunks = self.checkpoint.skip_committed(fitment_chunks, self._get_last_part_number)
+        if self.pipeline_queue_size:
+            fitment_chunks = PipelinedIterator(fitment_chunks, self.pipeline_queue_size, f"aces {self.aces_file_parser.brand_record.short_name}")
+        for fitment_data in fitment_chunks:
             # Only start storing data if there any makes were parsed, some part numbers fit ALL and will not have associated makes/models/etc
             if fitment_data.make_storage['makes']:
                 self._clean_and_store_data(fitment_data)
+            elif self.checkpoint:
+                self.checkpoint.commit(self._get_last_part_number(fitment_data))
         if on_complete:
             on_complete()
+        aces_logger.info(f"Fitment for {self.aces_file_parser.brand_record.name}: {self.fitment_stats['unchanged_parts']} parts unchanged by digest, {self.fitment_stats['changed_parts']} parts compared, "
+                         f"{self.fitment_stats['inserted']} fitment rows inserted and {self.fitment_stats['deleted']} deleted")
+        self.bulk_loader.log_stats(aces_logger)
+        self.dimension_cache.log_stats(aces_logger)
         aces_logger.info(f'Total time for {self.aces_file_parser.brand_record.name}: {timer() - begin_timer}')
 
     @transaction.atomic
     def _clean_and_store_data(self, fitment_data):
-        part_fitment_storage = self._clean_fitment_data(fitment_data)
+        lock_shared_tables()
+        # taken before cleaning drops the parts that need no storing
+        last_part_number = self._get_last_part_number(fitment_data)
+        if self.fitment_diff == "set":
+            part_fitment_storage = self._filter_changed_parts(fitment_data)
+        else:
+            part_fitment_storage = self._clean_fitment_data(fitment_data)
         if part_fitment_storage['storage_objects']:
             aces_logger.info('Storing fitment for parts {}'.format(",".join(list(fitment_data.part_fitment_storage['storage_objects'].keys()))))
             self._store_data(fitment_data)
+        if self.checkpoint:
+            self.checkpoint.commit(last_part_number)
+
+    @staticmethod
+    def _get_last_part_number(fitment_data):
+        return next(reversed(fitment_data.part_fitment_storage['storage_objects']), None)
 
     def _store_data(self, fitment_data):
         make_records = self._get_make_records(fitment_data)
@@ -380,19 +494,43 @@ class AcesDataStorage(object):
 
         self._store_fitment(fitment_data, vehicle_records)
 
+    def _filter_changed_parts(self, fitment_data):
+        """
+        Removes parts that do not exist and parts whose fitment digest matches the digest stored with the product, before any fitment is read.
+        The new digests of the remaining parts are saved on their products, in the same transaction as the fitment is stored.
+        Returns:
+            The part fitment storage of fitment_data
+        """
+        part_fitment_storage = fitment_data.part_fitment_storage
+        existing_products = Product.objects.filter(brand=fitment_data.brand_record, part_number__in=part_fitment_storage['storage_objects'].keys()).values_list("part_number", "id", "fitment_digest")
+        existing_product_lookup = set()
+        products_to_update = list()
+        for part_number, product_id, fitment_digest in existing_products:
+            new_fitment_digest = fitment_data.fitment_digests[part_number]
+            if fitment_digest == new_fitment_digest:
+                self.fitment_stats['unchanged_parts'] += 1
+            else:
+                existing_product_lookup.add(part_number)
+                products_to_update.append(Product(id=product_id, fitment_digest=new_fitment_digest))
+        part_fitment_storage['storage_objects'] = {key: value for key, value in part_fitment_storage['storage_objects'].items() if key in existing_product_lookup}
+        if not products_to_update:
+            return part_fitment_storage
+        self.fitment_stats['changed_parts'] += len(products_to_update)
+        Product.objects.bulk_update(products_to_update, ["fitment_digest"])
+        return part_fitment_storage
+
     def _clean_fitment_data(self, fitment_data):
         """
         This method cleans the fitment data.
         1. If the fitment_data input is the same as database, do not store
         2. If the fitment_data and database differ, delete existing records from the database and re-insert new records
-        3. If the fitment_data is storing a part that does not exist, remove it
-
+        3. If the fitment_data is storing a part that does not exist or has an unchanged fitment digest, remove it
         """
         existing_fitment_lookup = dict()
         product_fitment_to_delete = list()
-        part_fitment_storage = fitment_data.part_fitment_storage
-        existing_product_lookup = Product.objects.filter(brand=fitment_data.brand_record, part_number__in=part_fitment_storage['storage_objects'].keys()).values_list("part_number", flat=True)
-        part_fitment_storage['storage_objects'] = {key: value for key, value in part_fitment_storage['storage_objects'].items() if key in existing_product_lookup}
+        part_fitment_storage = self._filter_changed_parts(fitment_data)
+        if not part_fitment_storage['storage_objects']:
+            return part_fitment_storage
         existing_fitment_records = ProductFitment.objects.filter(product__brand=fitment_data.brand_record, product__part_number__in=part_fitment_storage['storage_objects'].keys())
         existing_fitment_records = existing_fitment_records.select_related("product", "vehicle", "vehicle__make", "vehicle__model", "vehicle__sub_model", "vehicle__engine", "vehicle__engine__fuel_delivery", "vehicle__engine__fuel_type", "vehicle__engine__aspiration")
         vehicle_key_parts = [
@@ -425,7 +563,7 @@ class AcesDataStorage(object):
                         fitment_id = existing_fitment_data.pop('fitment_id')
                         if existing_fitment_key not in new_part_fitment_storage:
                             product_fitment_to_delete.append(fitment_id)
-                            # TODO, clean up unused vehicle data
+                            # vehicles left unused are deleted by OrphanCollector after the import
                         else:
                             new_fitment_data = new_part_fitment_storage[existing_fitment_key]
                             if existing_fitment_data != new_fitment_data:
@@ -436,88 +574,72 @@ class AcesDataStorage(object):
                                     del part_fitment_storage['storage_objects'][part_number]
         if product_fitment_to_delete:
             ProductFitment.objects.filter(id__in=product_fitment_to_delete).delete()
+            self.fitment_stats['deleted'] += len(product_fitment_to_delete)
         return part_fitment_storage
 
     def _get_make_records(self, fitment_data):
-        make_retriever = DataRetriever(VehicleMake, VehicleMake.objects.filter(name__in=fitment_data.make_storage['makes']), ('name',))
-        return make_retriever.bulk_get_or_create(fitment_data.make_storage['storage_objects'])
+        return self.dimension_cache.makes.bulk_get_or_create(fitment_data.make_storage['storage_objects'])
 
     def _get_model_records(self, fitment_data, make_records):
         model_storage = fitment_data.model_storage['storage_objects']
         for model_key, model_object in model_storage.items():
             model_object["make_id"] = make_records[model_object.pop("make")]
-
-        model_retriever = DataRetriever(VehicleModel, VehicleModel.objects.filter(name__in=fitment_data.model_storage['models'], make_id__in=make_records.values()).select_related("make"), ("make__name", "name",))
-        return model_retriever.bulk_get_or_create(model_storage)
+        return self.dimension_cache.models.bulk_get_or_create(model_storage)
 
     def _get_sub_model_records(self, fitment_data, model_records):
         sub_model_storage = fitment_data.sub_model_storage['storage_objects']
         if sub_model_storage:
             for sub_model_key, sub_model_object in sub_model_storage.items():
                 sub_model_object['model_id'] = model_records[sub_model_object.pop('model')]
-            sub_model_retriever = DataRetriever(VehicleSubModel, VehicleSubModel.objects.filter(name__in=fitment_data.sub_model_storage['sub_models'], model_id__in=model_records.values()).select_related("model__make"), ("model__make__name", "model__name", "name",))
-            return sub_model_retriever.bulk_get_or_create(sub_model_storage)
+            return self.dimension_cache.sub_models.bulk_get_or_create(sub_model_storage)
         return None
 
     def _get_engine_records(self, fitment_data):
         engine_storage = fitment_data.engine_storage['storage_objects']
         if engine_storage:
             for engine_key, engine_object in engine_storage.items():
-                engine_object['fuel_type'] = self._get_fuel_type(engine_object['fuel_type'])
-                engine_object['fuel_delivery'] = self._get_fuel_delivery(engine_object['fuel_delivery'])
-                engine_object['aspiration'] = self._get_aspiration(engine_object['aspiration'])
-            engine_retriever = DataRetriever(VehicleEngine, VehicleEngine.objects.filter(configuration__in=fitment_data.engine_storage['configurations']).filter(Q(engine_code__isnull=True) | Q(engine_code__in=fitment_data.engine_storage['engine_codes'])).select_related(),
-                                             ("configuration", "liters", "fuel_type__name", "fuel_delivery__name", "engine_code", "aspiration__name"))
-            return engine_retriever.bulk_get_or_create(engine_storage)
+                engine_object['fuel_type_id'] = self._get_fuel_type(engine_object.pop('fuel_type')).id
+                engine_object['fuel_delivery_id'] = self._get_fuel_delivery(engine_object.pop('fuel_delivery')).id
+                engine_object['aspiration_id'] = self._get_aspiration(engine_object.pop('aspiration')).id
+            return self.dimension_cache.engines.bulk_get_or_create(engine_storage)
         return None
 
     def _get_vehicle_records(self, fitment_data, make_records, model_records, sub_model_records, engine_records):
         vehicle_storage = fitment_data.vehicle_storage['storage_objects']
-        vehicle_year_storage = dict()
+        vehicle_year_storage = list()
         for vehicle_key, vehicle_object in vehicle_storage.items():
             vehicle_object['make_id'] = make_records[vehicle_object.pop('make')]
             vehicle_object['model_id'] = model_records[vehicle_object.pop('model')]
-            if vehicle_object['sub_model'] and sub_model_records:
-                vehicle_object['sub_model_id'] = sub_model_records[vehicle_object.pop('sub_model')]
-            if vehicle_object['engine'] and engine_records:
-                vehicle_object['engine_id'] = engine_records[vehicle_object.pop('engine')]
+            sub_model_key = vehicle_object.pop('sub_model')
+            vehicle_object['sub_model_id'] = sub_model_records[sub_model_key] if sub_model_key and sub_model_records else None
+            engine_key = vehicle_object.pop('engine')
+            vehicle_object['engine_id'] = engine_records[engine_key] if engine_key and engine_records else None
             vehicle_years = vehicle_object.pop("years")
             for vehicle_year in vehicle_years:
-                vehicle_year_key = str(vehicle_year) + vehicle_key
-                vehicle_year_storage[vehicle_year_key] = {
-                    'vehicle': vehicle_key,
-                    'year': vehicle_year
-                }
-        vehicle_retriever = DataRetriever(
-            Vehicle,
-            Vehicle.objects.filter(model_id__in=model_records.values()).select_related("make", "model", "sub_model", "engine", "engine__fuel_delivery", "engine__fuel_type", "engine__aspiration"),
-            ("make__name", "model__name", "sub_model__name", "engine__configuration", "engine__liters", "engine__fuel_type__name", "engine__fuel_delivery__name", "engine__engine_code", "engine__aspiration__name")
-        )
-        vehicle_records = vehicle_retriever.bulk_get_or_create(vehicle_storage)
-        for vehicle_year_object in vehicle_year_storage.values():
-            vehicle_year_object['vehicle_id'] = vehicle_records[vehicle_year_object.pop('vehicle')]
-
-        vehicle_year_retriever = DataRetriever(
-            VehicleYear,
-            VehicleYear.objects.filter(vehicle_id__in=vehicle_records.values()).select_related("vehicle", "vehicle__make", "vehicle__model", "vehicle__sub_model", "vehicle__engine", "vehicle__engine__fuel_delivery", "vehicle__engine__fuel_type", "vehicle__engine__aspiration"),
-            (
-                "year", "vehicle__make__name", "vehicle__model__name", "vehicle__sub_model__name", "vehicle__engine__configuration", "vehicle__engine__liters", "vehicle__engine__fuel_type__name", "vehicle__engine__fuel_delivery__name", "vehicle__engine__engine_code",
-                "vehicle__engine__aspiration__name")
-        )
-        vehicle_year_retriever.bulk_get_or_create(vehicle_year_storage)
+                vehicle_year_storage.append((vehicle_key, vehicle_year))
+        vehicle_records = self.dimension_cache.vehicles.bulk_get_or_create(vehicle_storage)
+        # Vehicle year ids are never used, years stored before this import are left to the unique constraint instead of being queried
+        vehicle_years = self.dimension_cache.get_new_vehicle_years([(vehicle_records[vehicle_key], vehicle_year) for vehicle_key, vehicle_year in vehicle_year_storage])
+        self.bulk_loader.load(VehicleYear, ('vehicle_id', 'year'), vehicle_years)
         return vehicle_records
 
     def _store_fitment(self, fitment_data, vehicle_records):
         fitment_storage_objects = fitment_data.part_fitment_storage['storage_objects']
         product_retriever = DataRetriever(Product, Product.objects.filter(brand=fitment_data.brand_record, part_number__in=fitment_storage_objects.keys()), ("part_number",))
-        product_fitment_objects = list()
+        product_fitment_rows = list()
         for part_number, storage_objects in fitment_storage_objects.items():
             for storage_object in storage_objects.values():
-                storage_object['product_id'] = product_retriever.get_instance(storage_object.pop('product'))
-                storage_object['vehicle_id'] = vehicle_records[storage_object.pop('vehicle')]
-                product_fitment_objects.append(ProductFitment(**storage_object))
-        if product_fitment_objects:
-            ProductFitment.objects.bulk_create(product_fitment_objects)
+                product_fitment_rows.append((
+                    product_retriever.get_instance(storage_object['product']), vehicle_records[storage_object['vehicle']], storage_object['start_year'], storage_object['end_year'], storage_object['fitment_info_1'],
+                    storage_object['fitment_info_2']
+                ))
+        product_fitment_fields = ('product_id', 'vehicle_id', 'start_year', 'end_year', 'fitment_info_1', 'fitment_info_2')
+        if self.fitment_diff == "set":
+            num_inserted, num_deleted = self.bulk_loader.sync(ProductFitment, product_fitment_fields, product_fitment_rows, 'product_id', list(product_retriever.get_records().values()))
+            self.fitment_stats['deleted'] += num_deleted
+        else:
+            num_inserted = self.bulk_loader.load(ProductFitment, product_fitment_fields, product_fitment_rows)
+        self.fitment_stats['inserted'] += num_inserted
 
     def _get_fuel_type(self, fuel_type):
         fuel_type_record = self.fuel_type_lookup.get(fuel_type, None)
@@ -547,15 +669,13 @@ class PiesCategoryDataStorage(object):
         self.brand_short_name = brand_short_name
 
     def store_category_data(self, on_complete=None):
-        reader = csv.DictReader(self.pies_flat_binary, delimiter='|', quoting=csv.QUOTE_NONE)
+        reader = DciPipeReader(self.pies_flat_binary, ('partterminologyname', 'PartNumber'))
         categories = set()
         parts_categories = dict()
         part_numbers = set()
         num_chunks = 100
         pies_flat_logger.info(f"Storing category lookup for brand {self.brand_short_name}")
-        for row in reader:
-            category = row['partterminologyname']
-            part_number = row['PartNumber']
+        for category, part_number in reader:
             part_category_key = self.brand_short_name + category + part_number
             categories.add(category)
             parts_categories[part_category_key] = {
@@ -576,6 +696,7 @@ class PiesCategoryDataStorage(object):
 
     @transaction.atomic
     def _store_chunks(self, categories, parts_categories, part_numbers):
+        lock_shared_tables()
         category_records = dict()
         existing_categories = Category.objects.filter(name__in=categories)
         for existing_category in existing_categories:
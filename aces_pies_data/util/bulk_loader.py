@@ -0,0 +1,242 @@
+import io
+import logging
+from timeit import default_timer as timer
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+logger = logging.getLogger("BulkLoader")
+
+
+def format_copy_value(value):
+    """
+    Returns:
+        value in the text format of COPY ... FROM STDIN
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_copy_rows(rows):
+    """
+    Returns:
+        A file of rows in the text format of COPY ... FROM STDIN, one tab separated line per row
+    """
+    copy_file = io.StringIO()
+    for row in rows:
+        copy_file.write('\t'.join([format_copy_value(value) for value in row]))
+        copy_file.write('\n')
+    copy_file.seek(0)
+    return copy_file
+
+
+def get_unique_fields(model_cls, fields):
+    """
+    Returns:
+        Attribute names of each unique field and unique_together of model_cls whose fields are all in fields, the primary key excluded
+    """
+    unique_fields = [(field.attname,) for field in model_cls._meta.concrete_fields if field.unique and not field.primary_key]
+    unique_fields.extend([tuple(model_cls._meta.get_field(name).attname for name in unique_together) for unique_together in model_cls._meta.unique_together])
+    return [unique_key for unique_key in unique_fields if all(field in fields for field in unique_key)]
+
+
+def dedupe_rows(rows, fields, unique_fields):
+    """
+    Drops rows with the same values as an earlier row in any of unique_fields, a None matches a None
+    Returns:
+        The rest of rows in order
+    """
+    key_indexes = [[fields.index(field) for field in unique_key] for unique_key in unique_fields]
+    seen_keys = [set() for _ in key_indexes]
+    deduped_rows = list()
+    for row in rows:
+        row_keys = [tuple(row[index] for index in indexes) for indexes in key_indexes]
+        if any(row_key in seen for row_key, seen in zip(row_keys, seen_keys)):
+            continue
+        for row_key, seen in zip(row_keys, seen_keys):
+            seen.add(row_key)
+        deduped_rows.append(row)
+    return deduped_rows
+
+
+class BulkLoader(object):
+    """
+    Inserts rows of a model in bulk, skipping rows that violate a unique constraint.
+    On PostgreSQL rows are streamed with COPY into a temp staging table per model and merged with INSERT ... ON CONFLICT DO NOTHING.
+    That avoids building a model instance per row and the size limits of multi row INSERTs.  Other databases fall back to bulk_create.
+    A unique constraint does not match NULLs, so rows are first deduplicated in Python and rows matching a stored row on a unique key with a nullable column are
+    skipped with IS NOT DISTINCT FROM, the bulk_create fallback skips the stored rows it finds on every unique key.
+    sync replaces the rows of a set of parents with a set diff, on PostgreSQL the diff runs as two anti-joins against the staging table.
+    Rows per second are tracked per table in stats.
+    """
+    def __init__(self, engine="copy", using=DEFAULT_DB_ALIAS):
+        """
+        Args:
+            engine: copy or bulk_create, copy falls back to bulk_create when the database is not PostgreSQL
+            using: Database alias to load into
+        """
+        self.using = using
+        self.engine = engine
+        if engine == "copy" and connections[using].vendor != "postgresql":
+            self.engine = "bulk_create"
+        self.stats = dict()
+
+    def load(self, model_cls, fields, rows):
+        """
+        Args:
+            model_cls: Model to insert into
+            fields: Attribute names of the values in each row, foreign keys by their _id name.  auto_now and auto_now_add fields are filled in when not given
+            rows: List of tuples in fields order
+        Returns:
+            The number of rows inserted
+        """
+        if not rows:
+            return 0
+        start = timer()
+        unique_fields = get_unique_fields(model_cls, fields)
+        new_rows = dedupe_rows(rows, fields, unique_fields)
+        if self.engine == "copy":
+            num_inserted = self._copy_rows(model_cls, fields, new_rows, unique_fields)
+        else:
+            num_inserted = self._create_model_rows(model_cls, fields, new_rows, unique_fields)
+        if num_inserted < len(rows):
+            logger.debug(f"Skipped {len(rows) - num_inserted} of {len(rows)} {model_cls._meta.db_table} rows already stored or duplicated")
+        self._add_stats(model_cls, len(rows), num_inserted, 0, timer() - start)
+        return num_inserted
+
+    def sync(self, model_cls, fields, rows, scope_field, scope_values):
+        """
+        Makes rows the complete set of rows of model_cls whose scope_field is in scope_values.
+        Stored rows that are in rows are left alone, stored rows that are not are deleted and the rest of rows is inserted.
+        Args:
+            model_cls: Model to sync
+            fields: Attribute names of the values in each row, as in load.  A row is matched on all of them
+            rows: List of tuples in fields order, every row has one of scope_values in scope_field
+            scope_field: Attribute name of the field that limits the rows replaced, e.g. product_id
+            scope_values: Values of scope_field to replace the rows of, a value without any rows has all its stored rows deleted
+        Returns:
+            The number of rows inserted and the number of rows deleted
+        """
+        if not scope_values:
+            return 0, 0
+        start = timer()
+        new_rows = dedupe_rows(rows, fields, get_unique_fields(model_cls, fields))
+        if self.engine == "copy":
+            num_inserted, num_deleted = self._sync_copy_rows(model_cls, fields, new_rows, scope_field, scope_values)
+        else:
+            num_inserted, num_deleted = self._sync_model_rows(model_cls, fields, new_rows, scope_field, scope_values)
+        self._add_stats(model_cls, len(rows), num_inserted, num_deleted, timer() - start)
+        return num_inserted, num_deleted
+
+    def _add_stats(self, model_cls, num_rows, num_inserted, num_deleted, seconds):
+        table_stats = self.stats.setdefault(model_cls._meta.db_table, {'rows': 0, 'inserted': 0, 'deleted': 0, 'seconds': 0.0})
+        table_stats['rows'] += num_rows
+        table_stats['inserted'] += num_inserted
+        table_stats['deleted'] += num_deleted
+        table_stats['seconds'] += seconds
+
+    def _copy_rows(self, model_cls, fields, rows, unique_fields):
+        table = model_cls._meta.db_table
+        quote_name = connections[self.using].ops.quote_name
+        field_lookup = {field.attname: field for field in model_cls._meta.concrete_fields}
+        # ON CONFLICT catches the rest, a unique key with a nullable column never conflicts on a NULL
+        conditions = [
+            f"NOT EXISTS (SELECT 1 FROM {quote_name(table)} t WHERE {self._get_match(field_lookup, unique_key)})"
+            for unique_key in unique_fields if any(field_lookup[field].null for field in unique_key)
+        ]
+        with connections[self.using].cursor() as cursor:
+            staging_table, columns = self._copy_to_staging(cursor, model_cls, fields, rows)
+            return self._insert_from_staging(cursor, model_cls, fields, staging_table, columns, " AND ".join(conditions))
+
+    def _create_model_rows(self, model_cls, fields, rows, unique_fields, lookup_batch_size=500):
+        """
+        Returns:
+            The number of rows inserted, rows matching a stored row on a unique key are left out so ignore_conflicts only covers concurrent inserts
+        """
+        query_set = model_cls.objects.using(self.using)
+        for unique_key in unique_fields:
+            key_indexes = [fields.index(field) for field in unique_key]
+            first_values = list({row[key_indexes[0]] for row in rows})
+            stored_keys = set()
+            for batch_start in range(0, len(first_values), lookup_batch_size):
+                stored_keys.update(query_set.filter(**{f"{unique_key[0]}__in": first_values[batch_start:batch_start + lookup_batch_size]}).values_list(*unique_key))
+            rows = [row for row in rows if tuple(row[index] for index in key_indexes) not in stored_keys]
+        query_set.bulk_create([model_cls(**dict(zip(fields, row))) for row in rows], ignore_conflicts=True)
+        return len(rows)
+
+    def _get_match(self, field_lookup, fields):
+        quote_name = connections[self.using].ops.quote_name
+        # Nullable columns need IS NOT DISTINCT FROM to match a NULL, = keeps the unique index usable for the rest
+        return " AND ".join([
+            f"t.{quote_name(field_lookup[field].column)} {'IS NOT DISTINCT FROM' if field_lookup[field].null else '='} s.{quote_name(field_lookup[field].column)}" for field in fields
+        ])
+
+    def _sync_copy_rows(self, model_cls, fields, rows, scope_field, scope_values):
+        table = model_cls._meta.db_table
+        quote_name = connections[self.using].ops.quote_name
+        field_lookup = {field.attname: field for field in model_cls._meta.concrete_fields}
+        match = self._get_match(field_lookup, fields)
+        with connections[self.using].cursor() as cursor:
+            staging_table, columns = self._copy_to_staging(cursor, model_cls, fields, rows)
+            cursor.execute(
+                f"DELETE FROM {quote_name(table)} t WHERE t.{quote_name(field_lookup[scope_field].column)} = ANY(%s) AND NOT EXISTS (SELECT 1 FROM {quote_name(staging_table)} s WHERE {match})",
+                [list(scope_values)]
+            )
+            num_deleted = cursor.rowcount
+            num_inserted = self._insert_from_staging(cursor, model_cls, fields, staging_table, columns, f"NOT EXISTS (SELECT 1 FROM {quote_name(table)} t WHERE {match})")
+        return num_inserted, num_deleted
+
+    def _sync_model_rows(self, model_cls, fields, rows, scope_field, scope_values):
+        query_set = model_cls.objects.using(self.using).filter(**{f"{scope_field}__in": scope_values})
+        new_rows = set(rows)
+        stored_rows = set()
+        ids_to_delete = list()
+        for stored_row in query_set.values_list(*(["id"] + list(fields))):
+            if stored_row[1:] in new_rows:
+                stored_rows.add(stored_row[1:])
+            else:
+                ids_to_delete.append(stored_row[0])
+        if ids_to_delete:
+            model_cls.objects.using(self.using).filter(id__in=ids_to_delete).delete()
+        model_objects = [model_cls(**dict(zip(fields, row))) for row in new_rows if row not in stored_rows]
+        model_cls.objects.using(self.using).bulk_create(model_objects, ignore_conflicts=True)
+        return len(model_objects), len(ids_to_delete)
+
+    def _copy_to_staging(self, cursor, model_cls, fields, rows):
+        """
+        Returns:
+            The quoted name of the temp staging table of model_cls holding only rows, and the quoted column names of fields
+        """
+        table = model_cls._meta.db_table
+        quote_name = connections[self.using].ops.quote_name
+        staging_table = quote_name(f"{table}_staging")
+        column_lookup = {field.attname: field.column for field in model_cls._meta.concrete_fields}
+        columns = [quote_name(column_lookup[field]) for field in fields]
+        # Temp tables live for the connection, a rolled back transaction drops one created inside it
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} AS SELECT {', '.join(columns)} FROM {quote_name(table)} WITH NO DATA")
+        cursor.execute(f"TRUNCATE {staging_table}")
+        cursor.copy_expert(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN", format_copy_rows(rows))
+        return staging_table, columns
+
+    def _insert_from_staging(self, cursor, model_cls, fields, staging_table, columns, condition=None):
+        quote_name = connections[self.using].ops.quote_name
+        timestamp_columns = [
+            quote_name(field.column) for field in model_cls._meta.concrete_fields if (getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)) and field.attname not in fields
+        ]
+        insert_columns = ", ".join(columns + timestamp_columns)
+        select_columns = ", ".join([f"s.{column}" for column in columns] + ["%s"] * len(timestamp_columns))
+        where = f" WHERE {condition}" if condition else ""
+        now = timezone.now()
+        cursor.execute(
+            f"INSERT INTO {quote_name(model_cls._meta.db_table)} ({insert_columns}) SELECT {select_columns} FROM {staging_table} s{where} ON CONFLICT DO NOTHING", [now] * len(timestamp_columns)
+        )
+        return cursor.rowcount
+
+    def log_stats(self, stats_logger=logger):
+        for table, table_stats in self.stats.items():
+            rows_per_second = table_stats['rows'] / table_stats['seconds'] if table_stats['seconds'] else 0
+            stats_logger.info(
+                f"Loaded {table_stats['rows']} rows into {table} with {self.engine}, {table_stats['inserted']} inserted and {table_stats['deleted']} deleted in {table_stats['seconds']} seconds, "
+                f"{rows_per_second:.0f} rows/sec"
+            )
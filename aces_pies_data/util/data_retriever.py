@@ -1,3 +1,7 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+
+
 # class DataRetriever(object):
 #     """
 #     This is a helper class for bulk inserts
@@ -150,3 +154,103 @@ class DataRetriever(object):
             self.model_cls.objects.bulk_create(items_to_create.values())
             self.set_record_lookup(True)
         return self.record_lookup
+
+
+class UpsertDataRetriever(object):
+    """
+    Gets or creates records by a tuple of the model's own columns, for example ('make_id', 'name') for a vehicle model.
+    Keys are typed tuples, so they cost no string building and ("ab", "c") never matches ("a", "bc").
+    Existing records are read once with values_list, without joins.  Missing records are inserted with INSERT ... ON CONFLICT DO NOTHING RETURNING id and the key columns,
+    the returned ids are merged into the lookup so nothing is queried again.  Only keys another connection inserted first are looked up afterwards.
+    Databases other than PostgreSQL fall back to bulk_create(ignore_conflicts=True) and a query for just the inserted keys.
+    Without a query set nothing is preloaded, keys the lookup has not seen yet are queried on demand, so one retriever can serve a whole import.
+    """
+    max_query_params = 60000
+    # sqlite limits the depth of an expression tree, so keys are looked up in small OR batches
+    keys_per_query = 500
+
+    def __init__(self, model_cls, query_set, key_fields, using=DEFAULT_DB_ALIAS):
+        """
+        Args:
+            model_cls: Model to get or create records of
+            query_set: Records that may already exist, normally filtered down by the caller.  None fills the lookup on demand
+            key_fields: Attribute names identifying a record, foreign keys by their _id name.  Every record config has to contain all of them
+            using: Database alias when there is no query set
+        """
+        self.model_cls = model_cls
+        self.query_set = query_set
+        self.key_fields = tuple(key_fields)
+        self.using = query_set.db if query_set is not None else using
+        self.record_lookup = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+    def get_record_key(self, record_config):
+        return tuple([record_config[key_field] for key_field in self.key_fields])
+
+    def get_records(self):
+        """
+        Returns:
+            Dictionary of key tuple to record id
+        """
+        if self.record_lookup is None:
+            self.record_lookup = dict()
+            if self.query_set is not None:
+                self.record_lookup = {tuple(record[1:]): record[0] for record in self.query_set.values_list('id', *self.key_fields)}
+        return self.record_lookup
+
+    def bulk_get_or_create(self, data_lookup):
+        """
+        Args:
+            data_lookup: Dictionary of the caller's key to record config, the keyword arguments of the model
+        Returns:
+            Dictionary of the caller's key to record id
+        """
+        record_lookup = self.get_records()
+        record_configs = {self.get_record_key(record_config): record_config for record_config in data_lookup.values()}
+        configs_to_create = {record_key: record_config for record_key, record_config in record_configs.items() if record_key not in record_lookup}
+        self.stats['hits'] += len(record_configs) - len(configs_to_create)
+        self.stats['misses'] += len(configs_to_create)
+        if configs_to_create and self.query_set is None:
+            self._get_remaining_records(list(configs_to_create))
+            configs_to_create = {record_key: record_config for record_key, record_config in configs_to_create.items() if record_key not in record_lookup}
+        if configs_to_create:
+            if connections[self.using].vendor == "postgresql":
+                self._insert_returning(configs_to_create)
+            else:
+                self.model_cls.objects.using(self.using).bulk_create([self.model_cls(**record_config) for record_config in configs_to_create.values()], ignore_conflicts=True)
+            self._get_remaining_records([record_key for record_key in configs_to_create if record_key not in record_lookup])
+        return {data_key: record_lookup[self.get_record_key(record_config)] for data_key, record_config in data_lookup.items()}
+
+    def _insert_returning(self, configs_to_create):
+        connection = connections[self.using]
+        quote_name = connection.ops.quote_name
+        fields = [field for field in self.model_cls._meta.concrete_fields if not field.primary_key]
+        column_lookup = {field.attname: field.column for field in fields}
+        columns = ", ".join([quote_name(field.column) for field in fields])
+        returning_columns = ", ".join([quote_name(column_lookup[key_field]) for key_field in self.key_fields])
+        row_placeholder = "(" + ", ".join(["%s"] * len(fields)) + ")"
+        rows_per_insert = self.max_query_params // len(fields)
+        record_configs = list(configs_to_create.values())
+        with connection.cursor() as cursor:
+            for batch_start in range(0, len(record_configs), rows_per_insert):
+                params = list()
+                batch = record_configs[batch_start:batch_start + rows_per_insert]
+                for record_config in batch:
+                    record = self.model_cls(**record_config)
+                    params.extend([field.get_db_prep_save(field.pre_save(record, True), connection) for field in fields])
+                cursor.execute(
+                    f"INSERT INTO {quote_name(self.model_cls._meta.db_table)} ({columns}) VALUES {', '.join([row_placeholder] * len(batch))} ON CONFLICT DO NOTHING RETURNING id, {returning_columns}", params
+                )
+                for returned_record in cursor.fetchall():
+                    self.record_lookup[tuple(returned_record[1:])] = returned_record[0]
+
+    def _get_remaining_records(self, record_keys):
+        for batch_start in range(0, len(record_keys), self.keys_per_query):
+            key_filter = Q()
+            for record_key in record_keys[batch_start:batch_start + self.keys_per_query]:
+                key_filter |= Q(**dict(zip(self.key_fields, record_key)))
+            for record in self.model_cls.objects.using(self.using).filter(key_filter).values_list('id', *self.key_fields):
+                self.record_lookup[tuple(record[1:])] = record[0]
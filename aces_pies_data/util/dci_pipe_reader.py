@@ -0,0 +1,101 @@
+import csv
+import io
+import operator
+from decimal import Decimal, InvalidOperation
+
+
+def int_or_raw(value):
+    """
+    Converts numeric values like years, anything else (blank, ALL) is returned as is
+    """
+    return int(value) if value.isdigit() else value
+
+
+def decimal_or_raw(value):
+    """
+    Converts numeric values like liters, anything else (blank) is returned as is
+    """
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return value
+
+
+class DciPipeReader(object):
+    """
+    Reads the pipe delimited DCI flat files (n1parts.txt, piesdata67.txt).
+    The header is resolved to column positions once and every row is returned as a tuple of just the requested columns, no dict is built per row.
+    The files repeat a small number of values (years, liters) millions of times, so converted values are cached by their raw value.
+    Blank lines are skipped, a row too short to hold the requested columns raises a ValueError with its line number.
+    """
+    def __init__(self, dci_file, columns, converters=None, encoding="utf-8"):
+        """
+        Args:
+            dci_file: Binary file object (zip member, open file), text file object or iterable of decoded lines
+            columns: Names of the columns to return, in the order they are returned
+            converters: Dict of column name to a callable that converts the raw string value.  Results are cached per distinct value, only use for columns with few distinct values
+            encoding: Encoding of binary files
+        """
+        missing_columns = [column for column in (converters or dict()) if column not in columns]
+        if missing_columns:
+            raise ValueError(f"Converters given for columns that are not read {','.join(missing_columns)}")
+        self.dci_file = dci_file
+        self.columns = tuple(columns)
+        self.converters = converters or dict()
+        self.encoding = encoding
+        self.conversion_cache = {column: dict() for column in self.converters}
+
+    def __iter__(self):
+        text_file, wrapped = self._get_text_file()
+        try:
+            reader = csv.reader(text_file, delimiter='|', quoting=csv.QUOTE_NONE)
+            try:
+                header = next(reader)
+            except StopIteration:
+                return
+            missing_columns = [column for column in self.columns if column not in header]
+            if missing_columns:
+                raise ValueError(f"Columns {','.join(missing_columns)} are not in the file header")
+            positions = [header.index(column) for column in self.columns]
+            if len(positions) == 1:
+                position = positions[0]
+                get_values = lambda row: (row[position],)
+            else:
+                get_values = operator.itemgetter(*positions)
+            rows = self._get_row_values(reader, get_values, len(header))
+            if not self.converters:
+                yield from rows
+                return
+            conversions = [(self.columns.index(column), self.conversion_cache[column], converter) for column, converter in self.converters.items()]
+            for row_values in rows:
+                values = list(row_values)
+                for idx, cache, converter in conversions:
+                    raw_value = values[idx]
+                    try:
+                        values[idx] = cache[raw_value]
+                    except KeyError:
+                        values[idx] = cache[raw_value] = converter(raw_value)
+                yield tuple(values)
+        finally:
+            if wrapped:
+                # detach so the caller still owns, and closes, the underlying file
+                text_file.detach()
+
+    @staticmethod
+    def _get_row_values(reader, get_values, num_columns):
+        for row in reader:
+            try:
+                yield get_values(row)
+            except IndexError:
+                if not any(value.strip() for value in row):
+                    continue
+                raise ValueError(f"Line {reader.line_num} has {len(row)} columns, the header has {num_columns}")
+
+    def _get_text_file(self):
+        """
+        Returns:
+            Something csv.reader can read from, and whether it is a wrapper created here
+        """
+        if isinstance(self.dci_file, io.TextIOBase) or not hasattr(self.dci_file, 'read'):
+            return self.dci_file, False
+        return io.TextIOWrapper(self.dci_file, encoding=self.encoding, newline=''), True
@@ -0,0 +1,245 @@
+import heapq
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from operator import itemgetter
+from timeit import default_timer as timer
+
+logger = logging.getLogger("ExternalSort")
+
+rows_per_block = 10000
+
+
+def write_row_blocks(rows, row_file):
+    """
+    Pickles rows to row_file in blocks, pickling a block at a time is much faster than a row at a time
+    Returns:
+        The number of bytes written
+    """
+    start_position = row_file.tell()
+    for block_start in range(0, len(rows), rows_per_block):
+        pickle.dump(rows[block_start:block_start + rows_per_block], row_file, pickle.HIGHEST_PROTOCOL)
+    return row_file.tell() - start_position
+
+
+def read_row_blocks(row_file):
+    """
+    Returns:
+        A generator of the rows written by write_row_blocks, from the current position of row_file to the end
+    """
+    while True:
+        try:
+            rows = pickle.load(row_file)
+        except EOFError:
+            return
+        yield from rows
+
+
+class ExternalSort(object):
+    """
+    Sorts a stream of row tuples that does not fit in memory.
+    At most run_size rows are held in memory.  Each full buffer is sorted and spilled to a temp file as a sorted run, the runs are then merged in key order.
+    Input that is already in key order is detected while buffering, in that case no run is sorted and the runs are read back one after another instead of merged.
+    If all the rows fit in a single run nothing is spilled at all.
+    """
+    def __init__(self, key_index=0, run_size=500000, temp_dir=None):
+        """
+        Args:
+            key_index: Position of the sort key in every row
+            run_size: Maximum number of rows held in memory, and the size of each sorted run
+            temp_dir: Directory for the run files, defaults to the system temp directory
+        """
+        self.key_index = key_index
+        self.run_size = run_size
+        self.temp_dir = temp_dir
+        self.stats = {
+            'rows': 0,
+            'runs': 0,
+            'bytes_spilled': 0,
+            'was_sorted': True,
+            'sort_seconds': 0.0,
+            'spill_seconds': 0.0
+        }
+
+    def sort(self, rows):
+        """
+        Args:
+            rows: Iterable of tuples
+        Returns:
+            A generator of the rows in key order.  Rows with equal keys keep their input order.
+        """
+        run_files = list()
+        try:
+            run_rows = self._spill_runs(rows, run_files)
+            logger.info(
+                f"Buffered {self.stats['rows']} rows, input already sorted: {self.stats['was_sorted']}, sorting took {self.stats['sort_seconds']} seconds, "
+                f"{self.stats['runs']} runs and {self.stats['bytes_spilled']} bytes spilled in {self.stats['spill_seconds']} seconds"
+            )
+            if not run_files:
+                yield from run_rows
+            elif self.stats['was_sorted']:
+                for run_file in run_files:
+                    yield from read_row_blocks(run_file)
+            else:
+                yield from heapq.merge(*[read_row_blocks(run_file) for run_file in run_files], key=itemgetter(self.key_index))
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def _spill_runs(self, rows, run_files):
+        """
+        Buffers rows into runs, spilling every full run to disk.
+        Returns:
+            The rows of the last run when nothing had to be spilled, otherwise an empty list as the last run is spilled as well
+        """
+        key_index = self.key_index
+        run_rows = list()
+        previous_key = None
+        was_sorted = True
+        for row in rows:
+            key = row[key_index]
+            if was_sorted and previous_key is not None and key < previous_key:
+                was_sorted = False
+            previous_key = key
+            # a full run is only spilled once another row arrives, input of exactly run_size rows stays in memory
+            if len(run_rows) == self.run_size:
+                self.stats['rows'] += len(run_rows)
+                run_files.append(self._write_run(run_rows, was_sorted))
+                run_rows = list()
+            run_rows.append(row)
+        self.stats['rows'] += len(run_rows)
+        self.stats['was_sorted'] = was_sorted
+        if not run_files:
+            if not was_sorted:
+                self._sort_run(run_rows)
+            return run_rows
+        if run_rows:
+            run_files.append(self._write_run(run_rows, was_sorted))
+        return list()
+
+    def _sort_run(self, run_rows):
+        start = timer()
+        run_rows.sort(key=itemgetter(self.key_index))
+        self.stats['sort_seconds'] += timer() - start
+
+    def _write_run(self, run_rows, was_sorted):
+        # runs written while the input was still in order are sorted already
+        if not was_sorted:
+            self._sort_run(run_rows)
+        start = timer()
+        run_file = tempfile.TemporaryFile(dir=self.temp_dir)
+        self.stats['bytes_spilled'] += write_row_blocks(run_rows, run_file)
+        self.stats['runs'] += 1
+        self.stats['spill_seconds'] += timer() - start
+        run_file.seek(0)
+        return run_file
+
+
+class HashPartitioner(object):
+    """
+    Splits a stream of row tuples into partition files by a hash of the key, so every row with the same key lands in the same partition.
+    Partitions can then be processed independently, in any order and in separate processes.
+    crc32 is used rather than hash() as string hashes are salted per process.
+    """
+    rows_per_flush = 1000
+
+    def __init__(self, num_partitions, key_index=0, temp_dir=None):
+        """
+        Args:
+            num_partitions: Number of partition files to write
+            key_index: Position of the partition key in every row
+            temp_dir: Directory the partition files are created in, defaults to the system temp directory
+        """
+        self.num_partitions = num_partitions
+        self.key_index = key_index
+        self.temp_dir = temp_dir
+        self.partition_dir = None
+        self.stats = {
+            'rows': 0,
+            'bytes_spilled': 0,
+            'partition_seconds': 0.0
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def partition(self, rows):
+        """
+        Args:
+            rows: Iterable of tuples
+        Returns:
+            The paths of the non empty partition files, rows in each file keep their input order and can be read back with read_row_blocks
+        """
+        return [partition_path for partition, partition_path in self.partition_segments(rows)]
+
+    def partition_segments(self, rows, segment_rows=None):
+        """
+        Writes each partition as a series of segment files of up to segment_rows rows.  A segment is handed out as soon as it is full,
+        so it can be processed while the rest of the rows are still being partitioned.
+        Args:
+            rows: Iterable of tuples
+            segment_rows: Maximum rows per segment, None writes one segment per partition
+        Returns:
+            A generator of the partition number and path of each non empty segment.  Segments of a partition come in input order, rows in a segment keep their input order.
+        """
+        start = timer()
+        self.partition_dir = tempfile.mkdtemp(prefix='partitions_', dir=self.temp_dir)
+        key_index, num_partitions = self.key_index, self.num_partitions
+        # segment files are opened on their first row so empty partitions leave no file
+        segment_files = [None] * num_partitions
+        segment_counts = [0] * num_partitions
+        segment_sizes = [0] * num_partitions
+        partition_rows = [list() for _ in range(num_partitions)]
+        flush_rows = min(self.rows_per_flush, segment_rows or self.rows_per_flush)
+        try:
+            for row in rows:
+                partition = zlib.crc32(row[key_index].encode("utf-8")) % num_partitions
+                partition_buffer = partition_rows[partition]
+                partition_buffer.append(row)
+                if len(partition_buffer) == flush_rows or (segment_rows and segment_sizes[partition] + len(partition_buffer) == segment_rows):
+                    self._flush_segment(partition, partition_buffer, segment_files, segment_counts, segment_sizes)
+                    if segment_rows and segment_sizes[partition] == segment_rows:
+                        yield partition, self._close_segment(partition, segment_files, segment_sizes)
+            for partition, partition_buffer in enumerate(partition_rows):
+                if partition_buffer:
+                    self._flush_segment(partition, partition_buffer, segment_files, segment_counts, segment_sizes)
+                if segment_files[partition]:
+                    yield partition, self._close_segment(partition, segment_files, segment_sizes)
+        finally:
+            for segment_file in segment_files:
+                if segment_file:
+                    segment_file.close()
+        self.stats['partition_seconds'] = timer() - start
+        logger.info(f"Partitioned {self.stats['rows']} rows into {num_partitions} partitions, {self.stats['bytes_spilled']} bytes spilled in {self.stats['partition_seconds']} seconds")
+
+    def _flush_segment(self, partition, partition_buffer, segment_files, segment_counts, segment_sizes):
+        if not segment_files[partition]:
+            segment_path = os.path.join(self.partition_dir, f"partition_{partition:04d}_{segment_counts[partition]:04d}")
+            segment_files[partition] = open(segment_path, 'wb')
+            segment_counts[partition] += 1
+        segment_sizes[partition] += len(partition_buffer)
+        self._flush(partition_buffer, segment_files[partition])
+
+    @staticmethod
+    def _close_segment(partition, segment_files, segment_sizes):
+        segment_file = segment_files[partition]
+        segment_file.close()
+        segment_files[partition] = None
+        segment_sizes[partition] = 0
+        return segment_file.name
+
+    def _flush(self, partition_buffer, partition_file):
+        self.stats['rows'] += len(partition_buffer)
+        self.stats['bytes_spilled'] += write_row_blocks(partition_buffer, partition_file)
+        partition_buffer.clear()
+
+    def close(self):
+        if self.partition_dir:
+            shutil.rmtree(self.partition_dir, ignore_errors=True)
+            self.partition_dir = None
@@ -0,0 +1,80 @@
+import logging
+
+from aces_pies_data.models import ImportTracking
+
+logger = logging.getLogger("ImportCheckpoint")
+
+
+class CheckpointMismatch(Exception):
+    """
+    The file no longer splits into the chunks its checkpoint recorded, so it has to be stored from the start
+    """
+
+
+class ImportCheckpoint(object):
+    """
+    Records on the ImportTracking row of a file how many of its chunks are committed and the last part number of the last one.
+    Storage commits the checkpoint in the transaction of each chunk, so it never runs ahead of the stored data.
+    A retry builds a new checkpoint from the row and passes over the committed chunks without diffing or storing them again.
+    Chunks are matched by ordinal, the recorded part number confirms the file still splits the same way.
+    """
+    def __init__(self, tracking_record_id):
+        """
+        Args:
+            tracking_record_id: Id of the ImportTracking row of the file being stored
+        """
+        self.tracking_record_id = tracking_record_id
+        self.chunks_committed, self.last_part_number = ImportTracking.objects.filter(id=tracking_record_id).values_list("chunks_committed", "last_part_number").get()
+        self.resume_chunks = self.chunks_committed
+        self.resume_part_number = self.last_part_number
+        self.chunks_skipped = 0
+
+    @classmethod
+    def resume(cls, tracking_record):
+        """
+        Carries the checkpoint of the last failed import of the same content over to tracking_record, see ImportTrackingManager.get_resumable_import
+        Args:
+            tracking_record: ImportTracking of the file being stored, with its content hash set
+        Returns:
+            The ImportCheckpoint of tracking_record
+        """
+        resumable_import = ImportTracking.objects.get_resumable_import(tracking_record.brand_short_name, tracking_record.tracking_type.name, tracking_record.content_hash, tracking_record.id)
+        if resumable_import:
+            logger.info(f"Resuming {tracking_record.file_name} after {resumable_import.chunks_committed} chunks committed by the import of {resumable_import.file_name} started {resumable_import.start_date}")
+            ImportTracking.objects.filter(id=tracking_record.id).update(chunks_committed=resumable_import.chunks_committed, last_part_number=resumable_import.last_part_number)
+        return cls(tracking_record.id)
+
+    def skip_committed(self, chunks, get_last_part_number):
+        """
+        Does not use the database, it runs in the producer thread of a pipelined storage
+        Args:
+            chunks: Chunks of the file in order
+            get_last_part_number: Callable returning the last part number of a chunk
+        Returns:
+            A generator of the chunks after the committed ones, raising CheckpointMismatch if the last committed chunk does not end on the recorded part number
+        """
+        for chunk_ordinal, chunk in enumerate(chunks):
+            if chunk_ordinal < self.resume_chunks:
+                if chunk_ordinal == self.resume_chunks - 1:
+                    last_part_number = get_last_part_number(chunk)
+                    if last_part_number != self.resume_part_number:
+                        raise CheckpointMismatch(f"Chunk {chunk_ordinal} ends on part {last_part_number}, the checkpoint recorded {self.resume_part_number}")
+                    logger.info(f"Skipped {self.resume_chunks} committed chunks")
+                self.chunks_skipped += 1
+                continue
+            yield chunk
+
+    def commit(self, last_part_number):
+        """
+        Records the next chunk as committed, call it in the transaction that stores the chunk
+        """
+        self.chunks_committed += 1
+        self.last_part_number = last_part_number
+        ImportTracking.objects.filter(id=self.tracking_record_id).update(chunks_committed=self.chunks_committed, last_part_number=last_part_number)
+
+    def reset(self):
+        """
+        Drops the checkpoint, the next attempt stores the file from the start
+        """
+        self.chunks_committed, self.last_part_number = 0, None
+        ImportTracking.objects.filter(id=self.tracking_record_id).update(chunks_committed=0, last_part_number=None)
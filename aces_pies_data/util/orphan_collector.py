@@ -0,0 +1,121 @@
+import logging
+import zlib
+from timeit import default_timer as timer
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from aces_pies_data.models import Attribute, AttributeValue, Brand, DigitalAsset, ProductAttribute, ProductDigitalAsset, ProductFitment, Vehicle, VehicleEngine, VehicleYear
+
+logger = logging.getLogger("OrphanCollector")
+
+# Imports hold it shared while they run, the collector only runs when it can take it exclusively
+import_in_progress_lock_key = zlib.crc32(b"import_aces_pies:gc")
+
+
+class ImportInProgressLock(object):
+    """
+    Session level shared PostgreSQL advisory lock telling OrphanCollector an import is in progress, any number of imports hold it at once.
+    Hold it for as long as an import keeps lookup ids in its caches, the collector skips until every holder has let go.
+    The lock lives on a connection of its own, so it is not lost when the import closes and reopens its connection after a database error.
+    Other databases have no advisory locks and nothing is held.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.connection = None
+
+    def __enter__(self):
+        if connections[self.using].vendor == "postgresql":
+            self.connection = connections.create_connection(self.using)
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock_shared(%s)", [import_in_progress_lock_key])
+        return self
+
+    def __exit__(self, *args):
+        if self.connection is not None:
+            # closing the session releases the lock
+            self.connection.close()
+            self.connection = None
+
+
+class OrphanCollector(object):
+    """
+    Deletes lookup rows nothing refers to any more, left behind when products change their attributes, assets or fitment.
+    Each model is cleaned with an anti-join DELETE of at most batch_size rows at a time, repeated until a batch comes back short, so locks are held briefly.
+    Models are cleaned in dependency order, vehicle years and vehicles go before the engines they free up.
+    An import can pick up a row from its lookup caches just before it is collected, so nothing is collected while an import holds ImportInProgressLock.
+    """
+    def __init__(self, batch_size=10000, using=DEFAULT_DB_ALIAS):
+        """
+        Args:
+            batch_size: Maximum number of rows deleted per statement
+            using: Database alias to clean
+        """
+        self.batch_size = batch_size
+        self.using = using
+        self.stats = dict()
+
+    def collect(self):
+        """
+        Returns:
+            The number of rows reclaimed per model name, empty when an import is in progress and nothing was collected
+        """
+        connection = connections[self.using]
+        if connection.vendor != "postgresql":
+            return self._collect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [import_in_progress_lock_key])
+            if not cursor.fetchone()[0]:
+                logger.warning("An import is in progress, skipping the collection of orphaned lookup rows")
+                return dict()
+        try:
+            return self._collect()
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [import_in_progress_lock_key])
+
+    def _collect(self):
+        quote_name = connections[self.using].ops.quote_name
+        fitment_table = quote_name(ProductFitment._meta.db_table)
+        # a vehicle year is used while a fitment range of its vehicle covers it
+        vehicle_year_condition = (
+            f"NOT EXISTS (SELECT 1 FROM {fitment_table} r WHERE r.{quote_name('vehicle_id')} = t.{quote_name('vehicle_id')} "
+            f"AND t.{quote_name('year')} BETWEEN r.{quote_name('start_year')} AND r.{quote_name('end_year')})"
+        )
+        self._delete_orphans(VehicleYear, vehicle_year_condition)
+        self._delete_orphans(Vehicle, self._get_unreferenced_condition((ProductFitment, 'vehicle'), (VehicleYear, 'vehicle')))
+        self._delete_orphans(VehicleEngine, self._get_unreferenced_condition((Vehicle, 'engine')))
+        self._delete_orphans(AttributeValue, self._get_unreferenced_condition((ProductAttribute, 'value')))
+        self._delete_orphans(Attribute, self._get_unreferenced_condition((ProductAttribute, 'attribute'), (AttributeValue, 'attribute')))
+        self._delete_orphans(DigitalAsset, self._get_unreferenced_condition((ProductDigitalAsset, 'digital_asset'), (Brand, 'logo')))
+        return {model_name: model_stats['deleted'] for model_name, model_stats in self.stats.items()}
+
+    def _get_unreferenced_condition(self, *references):
+        """
+        Args:
+            references: Tuples of a referencing model and the name of its foreign key
+        Returns:
+            A condition on the table alias t that holds when no row of any referencing model points at it
+        """
+        quote_name = connections[self.using].ops.quote_name
+        return " AND ".join([
+            f"NOT EXISTS (SELECT 1 FROM {quote_name(model_cls._meta.db_table)} r WHERE r.{quote_name(model_cls._meta.get_field(field_name).column)} = t.{quote_name('id')})"
+            for model_cls, field_name in references
+        ])
+
+    def _delete_orphans(self, model_cls, condition):
+        quote_name = connections[self.using].ops.quote_name
+        table = quote_name(model_cls._meta.db_table)
+        start = timer()
+        num_deleted = 0
+        while True:
+            with transaction.atomic(using=self.using), connections[self.using].cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE {quote_name('id')} IN (SELECT t.{quote_name('id')} FROM {table} t WHERE {condition} LIMIT %s)", [self.batch_size])
+                num_batch_deleted = cursor.rowcount
+            num_deleted += num_batch_deleted
+            if num_batch_deleted < self.batch_size:
+                break
+        self.stats[model_cls.__name__] = {'deleted': num_deleted, 'seconds': timer() - start}
+
+    def log_stats(self, stats_logger=logger):
+        for model_name, model_stats in self.stats.items():
+            stats_logger.info(f"Reclaimed {model_stats['deleted']} orphaned {model_name} rows in {model_stats['seconds']} seconds")
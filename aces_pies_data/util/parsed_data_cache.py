@@ -0,0 +1,180 @@
+import gzip
+import logging
+import os
+import pickle
+import tempfile
+
+from aces_pies_data.models import Brand
+
+logger = logging.getLogger("ParsedDataCache")
+
+
+class ParsedDataCache(object):
+    """
+    Keeps the parsed output of an import file on disk so a retry after a database failure can store from it instead of parsing the file again.
+    There is one entry per brand and import type, tagged with the content hash of the file it was parsed from, a newer file replaces it.
+    Entries are a gzipped stream of pickles.  Records are pickled as soon as they are handed out, storage is free to modify them afterwards.
+    An entry only becomes visible once every record of the file has been written, a partial entry is never read back.
+    """
+    def __init__(self, cache_dir, brand_short_name, import_type, content_hash):
+        """
+        Args:
+            cache_dir: Directory the entries are kept in, None disables caching
+            brand_short_name: Brand the file belongs to
+            import_type: pies_flat, pies or aces
+            content_hash: Hash of the data file the records are parsed from
+        """
+        self.cache_dir = cache_dir
+        self.content_hash = content_hash
+        self.cache_path = os.path.join(cache_dir, f"{brand_short_name}_{import_type}.parsed.gz") if cache_dir else None
+        self._records = None
+        self._cache_file = None
+        self._temp_path = None
+
+    def is_cached(self):
+        """
+        Returns:
+            True if there is a complete entry parsed from the file with this content hash
+        """
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with gzip.open(self.cache_path, 'rb') as cache_file:
+                return pickle.load(cache_file)['content_hash'] == self.content_hash
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            logger.exception(f"Unreadable parsed data cache {self.cache_path}")
+            return False
+
+    def get_records(self):
+        """
+        Returns:
+            The header and a generator of the records of the cached entry
+        """
+        cache_file = gzip.open(self.cache_path, 'rb')
+        header = pickle.load(cache_file)['header']
+        logger.info(f"Reading parsed data from cache {self.cache_path}")
+
+        def records():
+            with cache_file:
+                while True:
+                    try:
+                        yield pickle.load(cache_file)
+                    except EOFError:
+                        return
+        return header, records()
+
+    def cache_records(self, header, records):
+        """
+        Args:
+            header: Picklable data stored once with the entry
+            records: Iterable of picklable records
+        Returns:
+            A generator of records that writes every record to the cache as it is consumed.  Without a cache directory records are passed through untouched.
+        """
+        if not self.cache_path:
+            return iter(records)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_fd, self._temp_path = tempfile.mkstemp(prefix=os.path.basename(self.cache_path), dir=self.cache_dir)
+        self._cache_file = gzip.open(os.fdopen(cache_fd, 'wb'), 'wb', compresslevel=1)
+        pickle.dump({'content_hash': self.content_hash, 'header': header}, self._cache_file, pickle.HIGHEST_PROTOCOL)
+        self._records = iter(records)
+        return self._tee_records()
+
+    def _tee_records(self):
+        try:
+            for record in self._records:
+                pickle.dump(record, self._cache_file, pickle.HIGHEST_PROTOCOL)
+                yield record
+        except GeneratorExit:
+            # The consumer stopped early, finish decides whether the rest gets cached
+            raise
+        except BaseException:
+            # Parsing failed, the entry would be incomplete
+            self.discard()
+            raise
+        self._complete()
+
+    def finish(self):
+        """
+        Parses the records the consumer did not get to into the cache, call when storing fails part way through and will be retried, so the retry does not have to parse.
+        A failure while parsing the rest is logged and leaves no entry.
+        """
+        if not self._cache_file:
+            return
+        try:
+            for record in self._records:
+                pickle.dump(record, self._cache_file, pickle.HIGHEST_PROTOCOL)
+            self._complete()
+        except Exception:
+            logger.exception(f"Could not cache the remaining parsed data for {self.cache_path}")
+            self.discard()
+
+    def clear(self):
+        """
+        Removes the entry, call once the records have been stored
+        """
+        self.discard()
+        if self.cache_path and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def _complete(self):
+        self._cache_file.close()
+        self._cache_file = None
+        os.replace(self._temp_path, self.cache_path)
+        logger.info(f"Cached parsed data in {self.cache_path}, {os.path.getsize(self.cache_path)} bytes")
+
+    def discard(self):
+        """
+        Drops the entry being written without parsing the rest of the file, call when storing fails in a way a retry would not fix
+        """
+        if self._cache_file:
+            self._cache_file.close()
+            self._cache_file = None
+            os.remove(self._temp_path)
+
+
+class CachedAcesFileParser(object):
+    """
+    Stands in for AcesFileParser in AcesDataStorage.
+    Serves the fitment of a cached entry, or parses with aces_file_parser and caches the fitment as it is stored.
+    """
+    def __init__(self, parsed_data_cache, brand_short_name, aces_file_parser=None):
+        """
+        Args:
+            parsed_data_cache: ParsedDataCache for the aces file
+            brand_short_name: Brand the file belongs to
+            aces_file_parser: AcesFileParser for the file, None reads the cached entry
+        """
+        self.parsed_data_cache = parsed_data_cache
+        self.aces_file_parser = aces_file_parser
+        self.brand_record = aces_file_parser.brand_record if aces_file_parser else Brand.objects.get(short_name=brand_short_name)
+
+    def get_fitment_data(self, part_fitment_chunks=10):
+        """
+        part_fitment_chunks only applies when parsing, cached fitment keeps the chunks it was parsed with
+        """
+        if self.aces_file_parser:
+            return self.parsed_data_cache.cache_records(None, self.aces_file_parser.get_fitment_data(part_fitment_chunks))
+        return self._get_cached_fitment_data()
+
+    def _get_cached_fitment_data(self):
+        for fitment_data in self.parsed_data_cache.get_records()[1]:
+            fitment_data.brand_record = self.brand_record
+            yield fitment_data
+
+
+def get_cached_brand_data(parsed_data_cache, pies_file_parser):
+    """
+    Args:
+        parsed_data_cache: ParsedDataCache for the pies file
+        pies_file_parser: PiesFileParser for the file, only used when the file is not cached
+    Returns:
+        Brand data as returned by PiesFileParser.get_brand_data, read from the cache when possible
+    """
+    if parsed_data_cache.is_cached():
+        header, product_data = parsed_data_cache.get_records()
+    else:
+        brand_data = pies_file_parser.get_brand_data()
+        header = {key: value for key, value in brand_data.items() if key != 'product_data'}
+        product_data = parsed_data_cache.cache_records(header, brand_data['product_data'])
+    return dict(header, product_data=product_data)
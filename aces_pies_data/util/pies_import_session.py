@@ -0,0 +1,51 @@
+from aces_pies_data.models import Category, DigitalAssetType, Product, ProductCategoryLookup
+
+
+class PiesImportSession(object):
+    """
+    Brand level lookups for a pies import, loaded once when the import starts instead of in every chunk.
+    Holds the category of every part of the brand, the product id and fingerprint of every part already stored and the digital asset types.
+    Chunks use it to skip category queries entirely, to skip unchanged products and to only query the products and relations of parts that really exist.
+    """
+    def __init__(self, brand_short_name):
+        """
+        Args:
+            brand_short_name: Brand being imported, the brand record may not exist yet
+        """
+        self.brand_short_name = brand_short_name
+        part_category_ids = dict(ProductCategoryLookup.objects.filter(brand_short_name=brand_short_name).values_list("part_number", "category_id"))
+        if not part_category_ids:
+            raise RuntimeError("Cannot parse pies data if no pies categories have been stored")
+        category_records = Category.objects.in_bulk(set(part_category_ids.values()))
+        self.part_categories = {part_number: category_records[category_id] for part_number, category_id in part_category_ids.items()}
+        self.product_ids = dict()
+        self.product_fingerprints = dict()
+        for part_number, product_id, fingerprint in Product.objects.filter(brand__short_name=brand_short_name).values_list("part_number", "id", "fingerprint"):
+            self.product_ids[part_number] = product_id
+            self.product_fingerprints[part_number] = fingerprint
+        self.digital_asset_types = {digital_asset_type_record.name: digital_asset_type_record for digital_asset_type_record in DigitalAssetType.objects.all()}
+
+    def get_part_categories(self, part_numbers):
+        """
+        Returns:
+            Dictionary of part number to category record for the part numbers that have a category
+        """
+        return {part_number: self.part_categories[part_number] for part_number in part_numbers if part_number in self.part_categories}
+
+    def get_product_ids(self, part_numbers):
+        """
+        Returns:
+            The ids of the products already stored for the part numbers
+        """
+        return [self.product_ids[part_number] for part_number in part_numbers if part_number in self.product_ids]
+
+    def is_unchanged(self, product_data):
+        """
+        Returns:
+            True if the product is stored already with the fingerprint of product_data
+        """
+        return self.product_fingerprints.get(product_data['part_number']) == product_data['fingerprint']
+
+    def add_products(self, product_records):
+        for product_record in product_records:
+            self.product_ids[product_record.part_number] = product_record.id
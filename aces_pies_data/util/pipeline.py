@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+from timeit import default_timer as timer
+
+logger = logging.getLogger("Pipeline")
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    Returns:
+        A generator of lists of up to chunk_size items of iterable
+    """
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+class _ProducerFailure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class PipelinedIterator(object):
+    """
+    Iterates an iterable in a producer thread, handing its items to the consumer through a bounded queue.
+    Parsing the next chunk then overlaps with storing the current one: the database round trips of the consumer release the GIL for the producer,
+    and parsers with worker processes keep them busy while the consumer waits on the database.  At most max_size items wait in the queue.
+    Stall time is tracked for both stages: the producer stalls when the queue is full (storage is the bottleneck), the consumer when it is empty (parsing is).
+    An exception in the producer is raised in the consumer.  A consumer that stops early stops the producer after its current item.
+    The producer must not use the database, Django connections are per thread.
+    """
+    _done = object()
+    _put_timeout = 0.1
+
+    def __init__(self, iterable, max_size=4, name="pipeline"):
+        """
+        Args:
+            iterable: Items to produce, iterated in the producer thread
+            max_size: Maximum number of produced items waiting for the consumer
+            name: Name the stats are logged under
+        """
+        self.iterable = iterable
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_size)
+        self.stats = {
+            'items': 0,
+            'producer_stall_seconds': 0.0,
+            'consumer_stall_seconds': 0.0,
+            'total_depth': 0,
+            'max_depth': 0
+        }
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        producer = threading.Thread(target=self._produce, name=f"{self.name} producer", daemon=True)
+        producer.start()
+        try:
+            while True:
+                depth = self.queue.qsize()
+                self.stats['total_depth'] += depth
+                self.stats['max_depth'] = max(self.stats['max_depth'], depth)
+                start = timer()
+                item = self.queue.get()
+                self.stats['consumer_stall_seconds'] += timer() - start
+                if item is self._done:
+                    return
+                if isinstance(item, _ProducerFailure):
+                    raise item.exception
+                self.stats['items'] += 1
+                yield item
+        finally:
+            self._stop.set()
+            producer.join()
+            self.log_stats()
+
+    def _produce(self):
+        iterator = iter(self.iterable)
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+            self._put(self._done)
+        except BaseException as e:
+            self._put(_ProducerFailure(e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def _put(self, item):
+        """
+        Returns:
+            False if the consumer stopped before there was room for item
+        """
+        start = timer()
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=self._put_timeout)
+                self.stats['producer_stall_seconds'] += timer() - start
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def log_stats(self, stats_logger=logger):
+        average_depth = self.stats['total_depth'] / (self.stats['items'] + 1)
+        stats_logger.info(
+            f"Pipeline {self.name}: {self.stats['items']} items, producer stalled {self.stats['producer_stall_seconds']} seconds on a full queue, "
+            f"consumer stalled {self.stats['consumer_stall_seconds']} seconds on an empty queue, queue depth {average_depth:.1f} average, {self.stats['max_depth']} max"
+        )
@@ -0,0 +1,26 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on a connection inside the with block.
+    Unlike CaptureQueriesContext it does not need DEBUG and keeps no sql, so it is cheap enough to leave on during imports.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.num_queries = 0
+        self._wrapper_context = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.num_queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.num_queries = 0
+        self._wrapper_context = connections[self.using].execute_wrapper(self)
+        self._wrapper_context.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._wrapper_context.__exit__(*args)
+        self._wrapper_context = None
@@ -0,0 +1,44 @@
+import os
+import sys
+
+
+def get_current_rss_bytes():
+    """
+    Resident set size of the current process.
+    Linux exposes the current value through /proc, other platforms fall back to the peak value reported by getrusage.
+    Returns:
+        The rss in bytes or None if the platform has no way of reporting it (windows)
+    """
+    try:
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else reports kilobytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class PeakRssTracker(object):
+    """
+    Keeps the highest rss seen across calls to sample.  Sampling is cheap, but still should not be done for every row of a large file.
+    """
+
+    def __init__(self):
+        self.peak_rss_bytes = None
+
+    def sample(self, rss_bytes=None):
+        if rss_bytes is None:
+            rss_bytes = get_current_rss_bytes()
+        if rss_bytes is not None and (self.peak_rss_bytes is None or rss_bytes > self.peak_rss_bytes):
+            self.peak_rss_bytes = rss_bytes
+        return self.peak_rss_bytes
+
+    def get_peak_rss_mb(self):
+        if self.peak_rss_bytes is None:
+            return None
+        return round(self.peak_rss_bytes / (1024 * 1024), 1)
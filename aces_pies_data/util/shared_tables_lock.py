@@ -0,0 +1,20 @@
+import zlib
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Brands share categories, attributes, digital assets and their types, and the vehicle, engine and fuel lookups of fitment
+shared_tables_lock_key = zlib.crc32(b"import_aces_pies:shared_tables")
+
+
+def lock_shared_tables(using=DEFAULT_DB_ALIAS):
+    """
+    Takes the PostgreSQL advisory lock on the lookup tables every brand writes to, call it at the start of the transaction of a chunk.
+    The lock is held until the transaction ends, so the lookup rows one brand creates are committed before another brand looks for them.
+    Workers importing different brands then never race on a get or create, which would duplicate rows whose unique key has a NULL in it or break the MPTT fields of categories.
+    Other databases have no advisory locks, nothing is locked.
+    """
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [shared_tables_lock_key])
@@ -1,26 +1,57 @@
 import os
 import sqlite3
+import tempfile
 
 
 class SqlLiteTempDb(object):
-    def __init__(self):
-        pass
+    """
+    Throw away sqlite database used as scratch storage during an import.
+    Every instance gets its own uniquely named file so concurrent imports do not share a database.
+    The data can always be rebuilt from the import file, so durability is traded for speed: no rollback journal, no fsync, a large page cache and memory mapped reads.
+    """
+    def __init__(self, temp_dir=None, cache_size_mb=256, mmap_size_mb=1024):
+        """
+        Args:
+            temp_dir: Directory for the database file, point this at tmpfs to keep it off disk.  Defaults to the system temp directory
+            cache_size_mb: Size of the sqlite page cache
+            mmap_size_mb: Maximum number of bytes of the database to memory map
+        """
+        self.temp_dir = temp_dir
+        self.cache_size_mb = cache_size_mb
+        self.mmap_size_mb = mmap_size_mb
+        self.sqlite_file = None
+        self.sql = None
+        self.sql_cursor = None
 
     def __enter__(self):
-        self.delete_sql_lite_db()
-        sqlite_file = 'sql_lite_db'
-        sql = sqlite3.connect(sqlite_file)
-        sql.isolation_level = None
-        sql.row_factory = sqlite3.Row
-        self.sql_cursor = sql.cursor()
+        sqlite_fd, self.sqlite_file = tempfile.mkstemp(prefix='sql_lite_db_', suffix='.sqlite3', dir=self.temp_dir)
+        os.close(sqlite_fd)
+        self.sql = sqlite3.connect(self.sqlite_file)
+        self.sql.isolation_level = None
+        self.sql.row_factory = sqlite3.Row
+        self.sql_cursor = self.sql.cursor()
+        self.sql_cursor.execute("PRAGMA journal_mode = OFF")
+        self.sql_cursor.execute("PRAGMA synchronous = OFF")
+        self.sql_cursor.execute("PRAGMA locking_mode = EXCLUSIVE")
+        # negative cache sizes are in KiB rather than pages
+        self.sql_cursor.execute(f"PRAGMA cache_size = -{self.cache_size_mb * 1024}")
+        self.sql_cursor.execute(f"PRAGMA mmap_size = {self.mmap_size_mb * 1024 * 1024}")
         return self.sql_cursor
 
     def __exit__(self, *args):
         self.sql_cursor.close()
+        self.sql.close()
         self.delete_sql_lite_db()
 
+    def get_size_bytes(self):
+        """
+        Returns:
+            Bytes written to the database file so far
+        """
+        return os.path.getsize(self.sqlite_file)
+
     def delete_sql_lite_db(self):
         try:
-            os.remove("sql_lite_db")
-        except:
-            pass
\ No newline at end of file
+            os.remove(self.sqlite_file)
+        except OSError:
+            pass
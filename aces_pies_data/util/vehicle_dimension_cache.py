@@ -0,0 +1,48 @@
+from aces_pies_data.models import Vehicle, VehicleEngine, VehicleMake, VehicleModel, VehicleSubModel
+from aces_pies_data.util.data_retriever import UpsertDataRetriever
+
+
+class VehicleDimensionCache(object):
+    """
+    Ids of the vehicle makes, models, sub models, engines, vehicles and vehicle years for a whole aces import.
+    A brand's parts fit the same few thousand vehicles, so after the first chunks almost every key is already known and the database is only asked for keys not seen yet.
+    Ids are cached as soon as they are inserted, before the chunk commits.  That is safe because a failed chunk ends the import and the cache with it.
+    """
+    def __init__(self):
+        self.makes = UpsertDataRetriever(VehicleMake, None, ('name',))
+        self.models = UpsertDataRetriever(VehicleModel, None, ('make_id', 'name'))
+        self.sub_models = UpsertDataRetriever(VehicleSubModel, None, ('model_id', 'name'))
+        self.engines = UpsertDataRetriever(VehicleEngine, None, ('configuration', 'liters', 'fuel_type_id', 'fuel_delivery_id', 'engine_code', 'aspiration_id'))
+        self.vehicles = UpsertDataRetriever(Vehicle, None, ('make_id', 'model_id', 'sub_model_id', 'engine_id'))
+        self.vehicle_years = set()
+        self.vehicle_year_stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+    def get_new_vehicle_years(self, vehicle_years):
+        """
+        Args:
+            vehicle_years: Iterable of (vehicle id, year) tuples
+        Returns:
+            The distinct vehicle years not stored yet during this import, they are counted as stored from now on
+        """
+        new_vehicle_years = set(vehicle_years) - self.vehicle_years
+        self.vehicle_year_stats['misses'] += len(new_vehicle_years)
+        self.vehicle_year_stats['hits'] += len(vehicle_years) - len(new_vehicle_years)
+        self.vehicle_years.update(new_vehicle_years)
+        return list(new_vehicle_years)
+
+    def get_stats(self):
+        return {
+            'makes': self.makes.stats,
+            'models': self.models.stats,
+            'sub_models': self.sub_models.stats,
+            'engines': self.engines.stats,
+            'vehicles': self.vehicles.stats,
+            'vehicle_years': self.vehicle_year_stats
+        }
+
+    def log_stats(self, logger):
+        for dimension, dimension_stats in self.get_stats().items():
+            logger.info(f"Vehicle dimension cache {dimension}: {dimension_stats['hits']} hits, {dimension_stats['misses']} misses")
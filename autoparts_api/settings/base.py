@@ -141,3 +141,44 @@ CORS_ALLOW_METHODS = (
 )
 GOOGLE_PRIVATE_KEY_PATH = os.environ.get("GOOGLE_PRIVATE_KEY_PATH")
 DATA_EMAIL = os.environ.get("DATA_EMAIL")
+# Worker processes used to parse pies xml files, 1 parses on the main process
+PIES_PARSE_PROCESSES = int(os.environ.get("pies_parse_processes", 1))
+# etree or lxml, unset uses lxml when it is installed
+PIES_XML_ENGINE = os.environ.get("pies_xml_engine")
+# external or sqlite, how aces rows get sorted by part number.  Run size is the number of rows the external sort holds in memory
+ACES_SORT_ENGINE = os.environ.get("aces_sort_engine", "external")
+ACES_SORT_RUN_SIZE = int(os.environ.get("aces_sort_run_size", 500000))
+# Directory the aces sort spills to, point at tmpfs to keep it off disk.  Unset uses the system temp directory
+ACES_SORT_TEMP_DIR = os.environ.get("aces_sort_temp_dir") or None
+# Page cache and memory map sizes of the sqlite sort engine's scratch database
+ACES_SQLITE_CACHE_MB = int(os.environ.get("aces_sqlite_cache_mb", 256))
+ACES_SQLITE_MMAP_MB = int(os.environ.get("aces_sqlite_mmap_mb", 1024))
+# More than 1 hash partitions aces rows by part number and parses the partitions in a process pool
+ACES_PARSE_PROCESSES = int(os.environ.get("aces_parse_processes", 1))
+# Unset uses 8 partitions per process
+ACES_PARSE_PARTITIONS = int(os.environ.get("aces_parse_partitions", 0)) or None
+# dict or columnar, columnar consolidates aces rows with numpy and falls back to dict when numpy is not installed
+ACES_NORMALISER = os.environ.get("aces_normaliser", "dict")
+# Directory parsed pies and aces data is cached in until it has been stored, so retries skip parsing.  Unset disables the cache
+PARSED_DATA_CACHE_DIR = os.environ.get("parsed_data_cache_dir") or None
+# python or set, set diffs the stored fitment of changed parts in the database instead of in python
+ACES_FITMENT_DIFF = os.environ.get("aces_fitment_diff", "python")
+# Rows deleted per statement when orphaned attributes, vehicles and assets are collected after an import, 0 skips the collection
+ORPHAN_GC_BATCH_SIZE = int(os.environ.get("orphan_gc_batch_size", 10000))
+# Brands imported at once by import_aces_pies, each in its own worker process.  1 imports brands one after another.
+# Brands share the category, asset and vehicle lookup tables, so workers take turns storing chunks and only parsing runs in parallel, see lock_shared_tables
+IMPORT_BRAND_PROCESSES = int(os.environ.get("import_brand_processes", 1))
+# Chunks parsed ahead in a producer thread while the previous chunk is stored, 0 parses and stores in lockstep
+IMPORT_PIPELINE_QUEUE_SIZE = int(os.environ.get("import_pipeline_queue_size", 0))
+# Drive files downloaded ahead of the one being imported, and the disk space the downloads waiting to be imported may use.  0 files downloads on demand
+DRIVE_PREFETCH_FILES = int(os.environ.get("drive_prefetch_files", 1))
+DRIVE_PREFETCH_DISK_MB = int(os.environ.get("drive_prefetch_disk_mb", 2048))
+# Directory downloaded zips are spooled to, unset uses the system temp directory
+DRIVE_DOWNLOAD_TEMP_DIR = os.environ.get("drive_download_temp_dir") or None
+# Downloaded zips up to this size stay in memory, larger ones are moved to disk and memory mapped while they are imported
+DRIVE_SPOOL_MAX_MB = int(os.environ.get("drive_spool_max_mb", 64))
+# Retries of each drive api call on rate limits and server errors, googleapiclient backs off exponentially between them
+DRIVE_NUM_RETRIES = int(os.environ.get("drive_num_retries", 5))
+# Attempts at storing a file when the database connection fails, each one resumes after the chunks committed so far.  The wait doubles from IMPORT_STORE_RETRY_SECONDS
+IMPORT_STORE_ATTEMPTS = int(os.environ.get("import_store_attempts", 5))
+IMPORT_STORE_RETRY_SECONDS = float(os.environ.get("import_store_retry_seconds", 5))
@@ -5,4 +5,14 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'testdatabase',
     }
-}
\ No newline at end of file
+}
+# Runs the tests marked postgresql against a PostgreSQL server when test_db_host is set, the test database is created from the db_ variables
+if os.environ.get("test_db_host"):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': os.environ.get("db_name", "autoparts_api"),
+        'USER': os.environ.get("db_user"),
+        'PASSWORD': os.environ.get("db_password"),
+        'HOST': os.environ.get("test_db_host"),
+        'PORT': os.environ.get("db_port"),
+    }